@@ -0,0 +1,71 @@
+from typing import Optional
+from fastapi import Depends, Request
+from .services.storage_service import StorageService
+from .services.content_index import ContentIndex
+from .services.async_storage_service import AsyncStorageService
+from .services.llm_service import LLMService
+from .services.exercise_service import ExerciseService
+from .services.progress_service import ProgressService
+from .services.cultural_service import CulturalService
+from .services.inventory_service import InventoryService
+from .services.job_service import JobService
+from .services.chat_context import ChatContextManager
+
+# Shared services live on app.state for the lifetime of the app (see main.lifespan).
+# Tests replace them with app.dependency_overrides[get_storage_service] etc.
+
+
+def get_storage_service(request: Request) -> StorageService:
+    return request.app.state.storage
+
+
+def get_async_storage_service(
+    request: Request,
+    storage: StorageService = Depends(get_storage_service)
+) -> AsyncStorageService:
+    return AsyncStorageService(storage, request.app.state.storage_executor)
+
+
+def get_llm_service(request: Request) -> LLMService:
+    return request.app.state.llm_service
+
+
+def get_content_index(request: Request) -> Optional[ContentIndex]:
+    return getattr(request.app.state, "content_index", None)
+
+
+def get_exercise_service(
+    storage: StorageService = Depends(get_storage_service),
+    llm_service: LLMService = Depends(get_llm_service),
+    content_index: Optional[ContentIndex] = Depends(get_content_index)
+) -> ExerciseService:
+    return ExerciseService(storage, llm_service, content_index)
+
+
+def get_progress_service(
+    storage: StorageService = Depends(get_storage_service)
+) -> ProgressService:
+    return ProgressService(storage)
+
+
+def get_cultural_service(
+    storage: StorageService = Depends(get_storage_service),
+    llm_service: LLMService = Depends(get_llm_service),
+    content_index: Optional[ContentIndex] = Depends(get_content_index)
+) -> CulturalService:
+    return CulturalService(storage, llm_service, content_index)
+
+
+def get_chat_context_manager(
+    storage: StorageService = Depends(get_storage_service),
+    llm_service: LLMService = Depends(get_llm_service)
+) -> ChatContextManager:
+    return ChatContextManager(storage, llm_service)
+
+
+def get_inventory_service(request: Request) -> Optional[InventoryService]:
+    return getattr(request.app.state, "inventory", None)
+
+
+def get_job_service(request: Request) -> JobService:
+    return request.app.state.jobs
@@ -1,8 +1,20 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+import asyncio
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse
 import logging
 import os
-from .routers import users, exercises, progress, cultural
+from .routers import users, exercises, progress, cultural, chat, admin, jobs, metrics
+from .services.async_storage_service import create_storage_executor
+from .services.codecs import orjson
+from .services.content_index import create_content_index
+from .services.inventory_service import create_inventory_service
+from .services.job_service import create_job_service
+from .services.llm_providers import ProviderNotConfiguredError
+from .services.llm_scheduler import ProviderUnavailableError
+from .services.llm_service import create_llm_service
+from .services.storage_service import create_storage_service
 
 # Configure logging
 logging.basicConfig(
@@ -13,11 +25,45 @@ logging.basicConfig(
 # Create data directory if it doesn't exist
 os.makedirs("data", exist_ok=True)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create the services shared by all requests and release them on shutdown"""
+    app.state.storage = create_storage_service()
+    app.state.storage_executor = create_storage_executor()
+    app.state.llm_service = create_llm_service()
+    app.state.content_index = await asyncio.to_thread(create_content_index, app.state.storage)
+    app.state.inventory = create_inventory_service(
+        app.state.storage, app.state.llm_service, app.state.content_index
+    )
+    refill_worker = None
+    if app.state.inventory is not None:
+        refill_worker = asyncio.create_task(app.state.inventory.run_refill_worker())
+    app.state.jobs = create_job_service(
+        app.state.storage, app.state.llm_service, app.state.inventory, app.state.content_index
+    )
+    await app.state.jobs.start()
+    try:
+        yield
+    finally:
+        await app.state.jobs.stop()
+        if refill_worker is not None:
+            refill_worker.cancel()
+            try:
+                await refill_worker
+            except asyncio.CancelledError:
+                pass
+        await app.state.llm_service.aclose()
+        app.state.storage_executor.shutdown(wait=True)
+        logging.info("Shared services closed")
+
 # Initialize FastAPI app
 app = FastAPI(
+    lifespan=lifespan,
     title="Language Tandem App",
     description="API for language tandem learning application",
     version="1.0.0",
+    # orjson encodes responses several times faster than the stdlib when installed
+    default_response_class=ORJSONResponse if orjson is not None else JSONResponse,
 )
 
 # Add CORS middleware
@@ -27,13 +73,32 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Link"],
 )
 
+@app.exception_handler(ProviderUnavailableError)
+async def provider_unavailable_handler(request: Request, exc: ProviderUnavailableError):
+    """Answer 503 while an LLM provider's circuit breaker is open"""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(max(1, round(exc.retry_after)))},
+    )
+
+@app.exception_handler(ProviderNotConfiguredError)
+async def provider_not_configured_handler(request: Request, exc: ProviderNotConfiguredError):
+    """Answer 503 to requests that need an LLM provider without an API key"""
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
+
 # Include routers
 app.include_router(users.router)
 app.include_router(exercises.router)
 app.include_router(progress.router)
 app.include_router(cultural.router)
+app.include_router(chat.router)
+app.include_router(admin.router)
+app.include_router(jobs.router)
+app.include_router(metrics.router)
 
 @app.get("/")
 async def root():
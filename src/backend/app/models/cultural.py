@@ -10,6 +10,9 @@ class CulturalNote(BaseModel):
     related_vocabulary: Optional[List[str]] = None
     image_url: Optional[str] = None
 
+    class Config:
+        indexes = ("language",)
+
 class Idiom(BaseModel):
     id: str
     language: Language
@@ -19,9 +22,15 @@ class Idiom(BaseModel):
     example_usage: str
     equivalent_idioms: Optional[List[dict]] = None
 
+    class Config:
+        indexes = ("language",)
+
 class CulturalFunFact(BaseModel):
     id: str
     language: Language
     title: str
     content: str
-    image_url: Optional[str] = None 
\ No newline at end of file
+    image_url: Optional[str] = None
+
+    class Config:
+        indexes = ("language",)
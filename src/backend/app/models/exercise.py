@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
 from typing import List, Optional, Dict, Any
 from enum import Enum
 from .user import Language
@@ -26,6 +26,13 @@ class QuizItem(BaseModel):
     correct_answer: int
     explanation: Optional[str] = None
 
+    @validator("correct_answer")
+    def correct_answer_is_an_option(cls, value, values):
+        options = values.get("options")
+        if options is not None and not 0 <= value < len(options):
+            raise ValueError("must be the index of one of the options")
+        return value
+
 class ConversationPrompt(BaseModel):
     prompt: str
     context: Optional[str] = None
@@ -46,8 +53,11 @@ class Exercise(BaseModel):
     difficulty: str
     content: Dict[str, Any]
     status: ExerciseStatus = ExerciseStatus.NEW
+    # Language of the learners it was written for, e.g. of flashcard definitions
+    native_language: Optional[Language] = None
     
     class Config:
+        indexes = ("language", "type", "status", "difficulty")
         schema_extra = {
             "example": {
                 "id": "ex1",
@@ -0,0 +1,29 @@
+from pydantic import BaseModel
+from datetime import datetime
+from .exercise import Exercise, ExerciseType
+from .user import Language, ProficiencyLevel
+
+class StockedExercise(BaseModel):
+    """A ready-made exercise waiting in the inventory to be handed out"""
+    id: str
+    bucket: str
+    language: Language
+    native_language: Language
+    proficiency_level: ProficiencyLevel
+    type: ExerciseType
+    topic: str
+    exercise: Exercise
+    created_at: datetime
+
+    class Config:
+        indexes = ("bucket",)
+
+class RequestedBucket(BaseModel):
+    """An inventory bucket learners have asked for, kept so any process can refill it"""
+    id: str
+    language: Language
+    native_language: Language
+    proficiency_level: ProficiencyLevel
+    type: ExerciseType
+    topic: str
+    requested_at: datetime
@@ -0,0 +1,53 @@
+from pydantic import BaseModel
+from typing import Any, Dict, Optional
+from datetime import datetime
+from enum import Enum
+
+class JobKind(str, Enum):
+    EXERCISES = "exercises"
+    CULTURAL = "cultural"
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+class Job(BaseModel):
+    """A generation request run in the background"""
+    id: str
+    kind: JobKind
+    user_id: Optional[str] = None
+    params: Dict[str, Any] = {}
+    priority: int = 0
+    status: JobStatus = JobStatus.QUEUED
+    result: Optional[Any] = None
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    # Server process that queued or resumed the job and runs it
+    owner: Optional[str] = None
+
+    class Config:
+        indexes = ("status", "user_id")
+        schema_extra = {
+            "example": {
+                "id": "job-1a2b3c4d",
+                "kind": "exercises",
+                "user_id": "user1",
+                "params": {"user_id": "user1", "partner_id": "user2", "count": 3},
+                "priority": 0,
+                "status": "succeeded",
+                "result": [{"id": "ex1", "title": "Basic French Greetings"}],
+                "error": None,
+                "created_at": "2023-06-15T14:30:00",
+                "started_at": "2023-06-15T14:30:01",
+                "finished_at": "2023-06-15T14:30:04"
+            }
+        }
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JobStatus.SUCCEEDED, JobStatus.FAILED, JobStatus.CANCELLED)
@@ -9,4 +9,9 @@ class ChatMessage(BaseModel):
 
 class ChatHistory(BaseModel):
     user_id: str
-    messages: List[ChatMessage] = [] 
\ No newline at end of file
+    messages: List[ChatMessage] = []
+    # Rolling summary of messages[:summarized_count], which are no longer sent to the model
+    summary: Optional[str] = None
+    summarized_count: int = 0 
+class ChatRequest(BaseModel):
+    message: str
@@ -0,0 +1,55 @@
+from fastapi import APIRouter, Depends, HTTPException
+from typing import Any, Dict, Optional
+from starlette.concurrency import run_in_threadpool
+from ..services.content_index import ContentIndex
+from ..services.inventory_service import InventoryService
+from ..services.llm_service import LLMService
+from ..dependencies import get_content_index, get_inventory_service, get_llm_service
+
+router = APIRouter(prefix="/admin", tags=["admin"])
+
+@router.get("/llm-cache")
+async def get_llm_cache_stats(llm_service: LLMService = Depends(get_llm_service)) -> Dict[str, Any]:
+    """Get hit/miss statistics of the LLM response cache"""
+    stats = llm_service.cache_stats()
+    if stats is None:
+        raise HTTPException(status_code=404, detail="LLM response cache is disabled")
+    return stats
+
+@router.get("/llm-providers")
+async def get_llm_provider_stats(llm_service: LLMService = Depends(get_llm_service)) -> Dict[str, Any]:
+    """Get the adaptive concurrency limit, retry counters and circuit breaker state of each LLM provider"""
+    return llm_service.provider_stats()
+
+@router.get("/llm-usage")
+async def get_llm_usage(llm_service: LLMService = Depends(get_llm_service)) -> Dict[str, Any]:
+    """Get LLM calls, cache hits, tokens and estimated cost by call site, language and user"""
+    return llm_service.usage_stats()
+
+@router.delete("/llm-cache")
+async def clear_llm_cache(llm_service: LLMService = Depends(get_llm_service)) -> Dict[str, Any]:
+    """Drop all cached LLM responses"""
+    if llm_service.cache is None:
+        raise HTTPException(status_code=404, detail="LLM response cache is disabled")
+    await run_in_threadpool(llm_service.cache.clear)
+    return {"cleared": True}
+
+
+@router.get("/inventory")
+async def get_inventory_status(
+    inventory: Optional[InventoryService] = Depends(get_inventory_service)
+) -> Dict[str, Any]:
+    """Get stock levels and refill lag of the exercise inventory"""
+    if inventory is None:
+        raise HTTPException(status_code=404, detail="Exercise inventory is disabled")
+    return await run_in_threadpool(inventory.status)
+
+
+@router.get("/content-index")
+async def get_content_index_status(
+    content_index: Optional[ContentIndex] = Depends(get_content_index)
+) -> Dict[str, Any]:
+    """Get the size, duplicate rate and saturation of each near-duplicate pool"""
+    if content_index is None:
+        raise HTTPException(status_code=404, detail="Near-duplicate detection is disabled")
+    return content_index.stats()
@@ -0,0 +1,32 @@
+from fastapi import APIRouter, HTTPException, Depends
+from datetime import datetime
+from ..models.user import User
+from ..models.visitor import ChatHistory, ChatMessage, ChatRequest
+from ..services.async_storage_service import AsyncStorageService
+from ..services.chat_context import ChatContextManager
+from ..dependencies import get_async_storage_service, get_chat_context_manager
+
+router = APIRouter(prefix="/chat", tags=["chat"])
+
+@router.get("/{user_id}", response_model=ChatHistory)
+async def get_chat_history(
+    user_id: str,
+    chat: ChatContextManager = Depends(get_chat_context_manager),
+    storage: AsyncStorageService = Depends(get_async_storage_service)
+):
+    """Get the chat history of a user, with the summary of its older turns"""
+    return await storage.run(chat.get_history, user_id)
+
+@router.post("/{user_id}", response_model=ChatMessage)
+async def send_chat_message(
+    user_id: str,
+    request: ChatRequest,
+    chat: ChatContextManager = Depends(get_chat_context_manager),
+    storage: AsyncStorageService = Depends(get_async_storage_service)
+):
+    """Answer a chat message in the context of the user's conversation"""
+    user = await storage.get_item("users", user_id, User)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    reply = await chat.areply(user_id, request.message)
+    return ChatMessage(role="assistant", content=reply, timestamp=datetime.now())
@@ -1,90 +1,114 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
 from typing import List, Dict, Any, Optional
 from ..models.cultural import CulturalNote, Idiom, CulturalFunFact
 from ..models.user import Language
-from ..services.storage_service import StorageService
+from ..models.job import JobKind
+from ..services.async_storage_service import AsyncStorageService
 from ..services.cultural_service import CulturalService
-from ..services.llm_service import LLMService
-import os
+from ..services.job_service import JobService
+from ..dependencies import get_async_storage_service, get_cultural_service, get_job_service
+from .jobs import accept_job
+from .sse import sse_response
+from .pagination import PageParams, list_items
 
 router = APIRouter(prefix="/cultural", tags=["cultural"])
 
-def get_storage_service():
-    return StorageService()
-
-def get_llm_service():
-    return LLMService(
-        openai_api_key=os.environ.get("OPENAI_API_KEY"),
-        gemini_api_key=os.environ.get("GEMINI_API_KEY")
-    )
-
-def get_cultural_service(
-    storage: StorageService = Depends(get_storage_service),
-    llm_service: LLMService = Depends(get_llm_service)
-):
-    return CulturalService(storage, llm_service)
-
 @router.get("/notes/{language}", response_model=List[CulturalNote])
 async def get_cultural_notes(
+    request: Request,
     language: Language,
-    cultural_service: CulturalService = Depends(get_cultural_service)
+    page: PageParams = Depends(),
+    storage: AsyncStorageService = Depends(get_async_storage_service)
 ):
-    """Get cultural notes for a specific language"""
-    return cultural_service.get_cultural_notes_by_language(language)
+    """Get cultural notes for a specific language, optionally paginated or streamed as NDJSON"""
+    return await list_items(request, storage, "cultural_notes", CulturalNote, page, {"language": language})
 
 @router.get("/notes/detail/{note_id}", response_model=CulturalNote)
 async def get_cultural_note(
     note_id: str,
-    cultural_service: CulturalService = Depends(get_cultural_service)
+    cultural_service: CulturalService = Depends(get_cultural_service),
+    storage: AsyncStorageService = Depends(get_async_storage_service)
 ):
     """Get a cultural note by ID"""
-    note = cultural_service.get_cultural_note(note_id)
+    note = await storage.run(cultural_service.get_cultural_note, note_id)
     if not note:
         raise HTTPException(status_code=404, detail="Cultural note not found")
     return note
 
 @router.get("/idioms/{language}", response_model=List[Idiom])
 async def get_idioms(
+    request: Request,
     language: Language,
-    cultural_service: CulturalService = Depends(get_cultural_service)
+    page: PageParams = Depends(),
+    storage: AsyncStorageService = Depends(get_async_storage_service)
 ):
-    """Get idioms for a specific language"""
-    return cultural_service.get_idioms_by_language(language)
+    """Get idioms for a specific language, optionally paginated or streamed as NDJSON"""
+    return await list_items(request, storage, "idioms", Idiom, page, {"language": language})
 
 @router.get("/idioms/detail/{idiom_id}", response_model=Idiom)
 async def get_idiom(
     idiom_id: str,
-    cultural_service: CulturalService = Depends(get_cultural_service)
+    cultural_service: CulturalService = Depends(get_cultural_service),
+    storage: AsyncStorageService = Depends(get_async_storage_service)
 ):
     """Get an idiom by ID"""
-    idiom = cultural_service.get_idiom(idiom_id)
+    idiom = await storage.run(cultural_service.get_idiom, idiom_id)
     if not idiom:
         raise HTTPException(status_code=404, detail="Idiom not found")
     return idiom
 
 @router.get("/fun-facts/{language}", response_model=List[CulturalFunFact])
 async def get_fun_facts(
+    request: Request,
     language: Language,
-    cultural_service: CulturalService = Depends(get_cultural_service)
+    page: PageParams = Depends(),
+    storage: AsyncStorageService = Depends(get_async_storage_service)
 ):
-    """Get cultural fun facts for a specific language"""
-    return cultural_service.get_fun_facts_by_language(language)
+    """Get cultural fun facts for a specific language, optionally paginated or streamed as NDJSON"""
+    return await list_items(request, storage, "fun_facts", CulturalFunFact, page, {"language": language})
 
 @router.get("/fun-facts/detail/{fact_id}", response_model=CulturalFunFact)
 async def get_fun_fact(
     fact_id: str,
-    cultural_service: CulturalService = Depends(get_cultural_service)
+    cultural_service: CulturalService = Depends(get_cultural_service),
+    storage: AsyncStorageService = Depends(get_async_storage_service)
 ):
     """Get a cultural fun fact by ID"""
-    fact = cultural_service.get_fun_fact(fact_id)
+    fact = await storage.run(cultural_service.get_fun_fact, fact_id)
     if not fact:
         raise HTTPException(status_code=404, detail="Fun fact not found")
     return fact
 
 @router.post("/generate/{language}", response_model=Dict[str, Any])
 async def generate_cultural_content(
+    language: Language,
+    background: bool = False,
+    priority: int = Query(0, ge=-10, le=10),
+    user_id: Optional[str] = None,
+    cultural_service: CulturalService = Depends(get_cultural_service),
+    jobs: JobService = Depends(get_job_service)
+):
+    """Generate new cultural content for a language.
+
+    With ``background=true`` the generation is queued as a job, counted
+    against ``user_id`` if given, and the response is 202 Accepted with the
+    job to poll at ``/jobs/{id}``.
+    """
+    if background:
+        return await accept_job(jobs, JobKind.CULTURAL, {"language": language}, user_id, priority)
+
+    # The LLM calls run concurrently on the async clients
+    return await cultural_service.agenerate_cultural_content(language)
+
+@router.post("/generate/{language}/stream")
+async def stream_generated_cultural_content(
     language: Language,
     cultural_service: CulturalService = Depends(get_cultural_service)
 ):
-    """Generate new cultural content for a language"""
-    return cultural_service.generate_cultural_content(language) 
\ No newline at end of file
+    """Generate new cultural content, streaming it as Server-Sent Events.
+
+    ``delta`` events carry response text as the LLM produces it, and
+    ``note``, ``idiom`` and ``fun_fact`` events carry each item as soon as
+    it is stored.
+    """
+    return sse_response(cultural_service.astream_cultural_content(language))
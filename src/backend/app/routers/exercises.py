@@ -1,53 +1,40 @@
-from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
 from typing import List, Optional
 from ..models.exercise import Exercise, ExerciseType, ExerciseStatus
 from ..models.user import User, Language
-from ..services.storage_service import StorageService
+from ..services.async_storage_service import AsyncStorageService
 from ..services.exercise_service import ExerciseService
-from ..services.llm_service import LLMService
+from ..models.job import JobKind
+from ..services.inventory_service import InventoryService
+from ..services.job_service import JobService
+from ..dependencies import get_async_storage_service, get_exercise_service, get_inventory_service, get_job_service
+from .jobs import accept_job
+from .sse import sse_response
+from .pagination import PageParams, list_items
 
 router = APIRouter(prefix="/exercises", tags=["exercises"])
 
-def get_storage_service():
-    return StorageService()
-
-def get_llm_service():
-    # In a real app, these would be loaded from environment variables
-    return LLMService(openai_api_key="sk-dummy", gemini_api_key="ai-dummy")
-
-def get_exercise_service(
-    storage: StorageService = Depends(get_storage_service),
-    llm_service: LLMService = Depends(get_llm_service)
-):
-    return ExerciseService(storage, llm_service)
-
 @router.get("/", response_model=List[Exercise])
 async def get_exercises(
+    request: Request,
     language: Optional[str] = None,
     type: Optional[str] = None,
     status: Optional[str] = None,
-    storage: StorageService = Depends(get_storage_service)
+    page: PageParams = Depends(),
+    storage: AsyncStorageService = Depends(get_async_storage_service)
 ):
-    """Get exercises with optional filters"""
-    exercises = storage.get_all_items("exercises", Exercise)
-    
-    # Apply filters
-    if language:
-        exercises = [ex for ex in exercises if ex.language == language]
-    if type:
-        exercises = [ex for ex in exercises if ex.type == type]
-    if status:
-        exercises = [ex for ex in exercises if ex.status == status]
-    
-    return exercises
+    """Get exercises with optional filters, optionally paginated or streamed as NDJSON"""
+    filters = {"language": language, "type": type, "status": status}
+    where = {field: value for field, value in filters.items() if value}
+    return await list_items(request, storage, "exercises", Exercise, page, where)
 
 @router.get("/{exercise_id}", response_model=Exercise)
 async def get_exercise(
     exercise_id: str,
-    exercise_service: ExerciseService = Depends(get_exercise_service)
+    storage: AsyncStorageService = Depends(get_async_storage_service)
 ):
     """Get an exercise by ID"""
-    exercise = exercise_service.get_exercise(exercise_id)
+    exercise = await storage.get_item("exercises", exercise_id, Exercise)
     if not exercise:
         raise HTTPException(status_code=404, detail="Exercise not found")
     return exercise
@@ -57,28 +44,67 @@ async def generate_exercises(
     user_id: str, 
     partner_id: str,
     count: int = Query(3, ge=1, le=10),
+    background: bool = False,
+    priority: int = Query(0, ge=-10, le=10),
     exercise_service: ExerciseService = Depends(get_exercise_service),
-    storage: StorageService = Depends(get_storage_service)
+    storage: AsyncStorageService = Depends(get_async_storage_service),
+    inventory: Optional[InventoryService] = Depends(get_inventory_service),
+    jobs: JobService = Depends(get_job_service)
 ):
-    """Generate new exercises for a user and their tandem partner"""
-    user = storage.get_item("users", user_id, User)
-    partner = storage.get_item("users", partner_id, User)
+    """Generate new exercises for a user and their tandem partner.
+
+    With ``background=true`` the generation is queued as a job and the
+    response is 202 Accepted with the job to poll at ``/jobs/{id}``.
+    """
+    user = await storage.get_item("users", user_id, User)
+    partner = await storage.get_item("users", partner_id, User)
     
     if not user or not partner:
         raise HTTPException(status_code=404, detail="User or partner not found")
     
-    exercises = exercise_service.generate_exercises(user, partner, count)
+    if background:
+        params = {"user_id": user_id, "partner_id": partner_id, "count": count}
+        return await accept_job(jobs, JobKind.EXERCISES, params, user_id, priority)
+    
+    if inventory is not None:
+        # Served from pre-generated stock; only out-of-stock exercises are generated live
+        return await inventory.serve_exercises(user, partner, count)
+
+    # The LLM calls run concurrently on the async clients
+    exercises = await exercise_service.agenerate_exercises(user, partner, count)
     return exercises
 
+@router.post("/generate/stream")
+async def stream_generated_exercises(
+    user_id: str,
+    partner_id: str,
+    count: int = Query(3, ge=1, le=10),
+    exercise_service: ExerciseService = Depends(get_exercise_service),
+    storage: AsyncStorageService = Depends(get_async_storage_service)
+):
+    """Generate new exercises, streaming them as Server-Sent Events.
+
+    ``delta`` events carry response text as the LLM produces it and each
+    ``exercise`` event carries an exercise as soon as it is stored.
+    """
+    user = await storage.get_item("users", user_id, User)
+    partner = await storage.get_item("users", partner_id, User)
+    
+    if not user or not partner:
+        raise HTTPException(status_code=404, detail="User or partner not found")
+    
+    return sse_response(exercise_service.astream_exercises(user, partner, count))
+
 @router.put("/{exercise_id}/status", response_model=Exercise)
 async def update_exercise_status(
     exercise_id: str,
     status: ExerciseStatus,
-    exercise_service: ExerciseService = Depends(get_exercise_service)
+    exercise_service: ExerciseService = Depends(get_exercise_service),
+    storage: AsyncStorageService = Depends(get_async_storage_service)
 ):
     """Update the status of an exercise"""
     try:
-        updated_exercise = exercise_service.update_exercise_status(exercise_id, status)
+        updated_exercise = await storage.run(exercise_service.update_exercise_status, exercise_id, status)
         return updated_exercise
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e)) 
\ No newline at end of file
@@ -0,0 +1,56 @@
+from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import JSONResponse
+from typing import Any, Dict, List, Optional
+from ..models.job import Job, JobKind
+from ..services.job_service import JobService, JobLimitError
+from ..dependencies import get_job_service
+
+router = APIRouter(prefix="/jobs", tags=["jobs"])
+
+async def accept_job(jobs: JobService, kind: JobKind, params: Dict[str, Any],
+                     user_id: Optional[str], priority: int) -> JSONResponse:
+    """Queue a generation job and answer 202 Accepted pointing at it"""
+    try:
+        job = await jobs.submit(kind, params, user_id=user_id, priority=priority)
+    except JobLimitError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    return JSONResponse(
+        status_code=202,
+        content={"job_id": job.id, "status": job.status.value, "url": f"/jobs/{job.id}"},
+        headers={"Location": f"/jobs/{job.id}"},
+    )
+
+@router.get("/", response_model=List[Job])
+async def get_jobs(
+    user_id: Optional[str] = None,
+    jobs: JobService = Depends(get_job_service)
+):
+    """List recent generation jobs, optionally for one user"""
+    return jobs.list_jobs(user_id)
+
+@router.get("/stats")
+async def get_job_stats(jobs: JobService = Depends(get_job_service)) -> Dict[str, Any]:
+    """Count jobs by status"""
+    return jobs.stats()
+
+@router.get("/{job_id}", response_model=Job)
+async def get_job(
+    job_id: str,
+    jobs: JobService = Depends(get_job_service)
+):
+    """Get the status of a generation job, and its result once it has finished"""
+    job = await jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router.delete("/{job_id}", response_model=Job)
+async def cancel_job(
+    job_id: str,
+    jobs: JobService = Depends(get_job_service)
+):
+    """Cancel a queued or running generation job"""
+    job = await jobs.cancel(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
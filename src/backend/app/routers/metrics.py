@@ -0,0 +1,14 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+from ..services.llm_service import LLMService
+from ..dependencies import get_llm_service
+
+router = APIRouter(tags=["metrics"])
+
+# Content type of the Prometheus text exposition format
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4"
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(llm_service: LLMService = Depends(get_llm_service)) -> PlainTextResponse:
+    """Get LLM call counts, latency histograms, tokens, cost and provider state for Prometheus to scrape"""
+    return PlainTextResponse(llm_service.render_metrics(), media_type=PROMETHEUS_CONTENT_TYPE)
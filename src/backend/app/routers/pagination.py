@@ -0,0 +1,105 @@
+import base64
+import binascii
+import json
+from typing import Any, AsyncIterator, Dict, List, Optional, Type
+from fastapi import HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from ..services.async_storage_service import AsyncStorageService
+from ..services.codecs import json_codec
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(after: str) -> str:
+    """Encode the last id of a page as an opaque cursor"""
+    payload = json.dumps({"after": after}).encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> str:
+    """Decode a cursor produced by encode_cursor"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        after = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))["after"]
+    except (binascii.Error, ValueError, KeyError, TypeError, UnicodeEncodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(after, str):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return after
+
+
+class PageParams:
+    """Query parameters shared by the paginated list endpoints"""
+
+    def __init__(
+        self,
+        limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Page size; enables pagination"),
+        cursor: Optional[str] = Query(None, description=f"Opaque cursor from the {NEXT_CURSOR_HEADER} header"),
+    ):
+        self.limit = limit
+        self.cursor = cursor
+
+
+def wants_ndjson(request: Request) -> bool:
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+async def _ndjson_lines(items: AsyncIterator[BaseModel]) -> AsyncIterator[bytes]:
+    async for item in items:
+        yield json_codec.dumps(item.dict()) + b"\n"
+
+
+def json_list_response(items: List[BaseModel], headers: Optional[Dict[str, str]] = None) -> Response:
+    """Encode a list of models straight to JSON.
+
+    The models were already validated when read from storage, so this skips
+    FastAPI's jsonable_encoder pass and encodes with the fast JSON codec.
+    """
+    content = json_codec.dumps([item.dict() for item in items])
+    return Response(content=content, media_type="application/json", headers=headers)
+
+
+async def list_items(
+    request: Request,
+    storage: AsyncStorageService,
+    collection: str,
+    model_class: Type[BaseModel],
+    page: PageParams,
+    where: Optional[Dict[str, Any]] = None,
+):
+    """Serve a list endpoint as a full list, a cursor page, or an NDJSON stream.
+
+    Without ``limit`` or ``cursor`` the whole list is returned as before.
+    With ``limit``, items are ordered by id and the cursor of the next page
+    is sent in the X-Next-Cursor and Link headers. Clients that send
+    ``Accept: application/x-ndjson`` get one JSON record per line: a page
+    when they pass ``limit``, otherwise every item after ``cursor``, read
+    from storage a page at a time so memory stays flat.
+    """
+    after = decode_cursor(page.cursor) if page.cursor else None
+    ndjson = wants_ndjson(request)
+
+    if ndjson and page.limit is None:
+        items = storage.iter_items(collection, model_class, where, DEFAULT_PAGE_SIZE, after)
+        return StreamingResponse(_ndjson_lines(items), media_type=NDJSON_MEDIA_TYPE)
+
+    if page.limit is None and after is None:
+        return json_list_response(await storage.find_items(collection, model_class, where=where))
+
+    items, next_after = await storage.page_items(
+        collection, model_class, where, page.limit or DEFAULT_PAGE_SIZE, after
+    )
+    headers = {}
+    if next_after is not None:
+        next_cursor = encode_cursor(next_after)
+        headers[NEXT_CURSOR_HEADER] = next_cursor
+        next_url = request.url.include_query_params(cursor=next_cursor)
+        headers["Link"] = f'<{next_url}>; rel="next"'
+    if ndjson:
+        content = b"".join(json_codec.dumps(item.dict()) + b"\n" for item in items)
+        return Response(content=content, media_type=NDJSON_MEDIA_TYPE, headers=headers)
+    return json_list_response(items, headers)
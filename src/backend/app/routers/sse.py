@@ -0,0 +1,36 @@
+import logging
+from typing import Any, AsyncIterator, Tuple
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from ..services.codecs import json_codec
+
+SSE_MEDIA_TYPE = "text/event-stream"
+
+
+def sse_event(event: str, data: Any) -> bytes:
+    """Encode one Server-Sent Event with a JSON payload"""
+    if isinstance(data, BaseModel):
+        data = data.dict()
+    return b"event: " + event.encode("utf-8") + b"\ndata: " + json_codec.dumps(data) + b"\n\n"
+
+
+async def _sse_stream(events: AsyncIterator[Tuple[str, Any]]) -> AsyncIterator[bytes]:
+    try:
+        async for event, data in events:
+            yield sse_event(event, data)
+    except Exception as e:
+        # Headers are already sent, so failures are reported in the stream
+        logging.error(f"Error while streaming events: {str(e)}")
+        yield sse_event("error", {"detail": str(e)})
+        return
+    yield sse_event("done", {})
+
+
+def sse_response(events: AsyncIterator[Tuple[str, Any]]) -> StreamingResponse:
+    """Stream (event, data) pairs as Server-Sent Events, ending with a ``done`` or ``error`` event"""
+    return StreamingResponse(
+        _sse_stream(events),
+        media_type=SSE_MEDIA_TYPE,
+        # Keep proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
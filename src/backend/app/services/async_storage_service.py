@@ -0,0 +1,97 @@
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple, Type, TypeVar
+from pydantic import BaseModel
+from .storage_service import StorageService, T
+
+R = TypeVar('R')
+
+
+def create_storage_executor() -> ThreadPoolExecutor:
+    """Create the thread pool for storage work, sized by STORAGE_IO_THREADS.
+
+    A dedicated pool keeps file I/O and JSON parsing off the event loop and
+    away from the request thread pool used for LLM calls. The owner shuts it
+    down.
+    """
+    return ThreadPoolExecutor(
+        max_workers=int(os.environ.get("STORAGE_IO_THREADS", 8)),
+        thread_name_prefix="storage-io",
+    )
+
+
+class AsyncStorageService:
+    """Awaitable facade over a StorageService.
+
+    Every call runs on the given storage I/O thread pool with the caller's
+    context copied over, so an active StorageService.batch() still applies.
+    """
+
+    def __init__(self, storage: StorageService, executor: ThreadPoolExecutor):
+        self.storage = storage
+        self.executor = executor
+
+    async def run(self, func: Callable[..., R], *args: Any, **kwargs: Any) -> R:
+        """Run a blocking storage-bound callable on the I/O thread pool"""
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, func, *args, **kwargs)
+        return await loop.run_in_executor(self.executor, call)
+
+    async def get_item(self, collection: str, item_id: str, model_class: Type[T]) -> Optional[T]:
+        """Get an item from a collection"""
+        return await self.run(self.storage.get_item, collection, item_id, model_class)
+
+    async def get_all_items(self, collection: str, model_class: Type[T]) -> List[T]:
+        """Get all items from a collection"""
+        return await self.run(self.storage.get_all_items, collection, model_class)
+
+    async def save_item(self, collection: str, item: BaseModel) -> None:
+        """Save an item to a collection"""
+        await self.run(self.storage.save_item, collection, item)
+
+    async def save_items(self, collection: str, items: Iterable[BaseModel]) -> None:
+        """Save several items to a collection with a single write"""
+        await self.run(self.storage.save_items, collection, list(items))
+
+    async def delete_item(self, collection: str, item_id: str) -> bool:
+        """Delete an item from a collection"""
+        return await self.run(self.storage.delete_item, collection, item_id)
+
+    async def delete_items(self, collection: str, item_ids: Iterable[str]) -> int:
+        """Delete several items from a collection with a single write"""
+        return await self.run(self.storage.delete_items, collection, list(item_ids))
+
+    async def query_items(self, collection: str, model_class: Type[T], query_func=None) -> List[T]:
+        """Query items from a collection using a filter function"""
+        return await self.run(self.storage.query_items, collection, model_class, query_func)
+
+    async def find_items(self, collection: str, model_class: Type[T],
+                         where: Optional[Dict[str, Any]] = None,
+                         sort_by: Optional[str] = None, descending: bool = False,
+                         limit: Optional[int] = None, offset: int = 0) -> List[T]:
+        """Find items whose fields equal the values in ``where``"""
+        return await self.run(
+            self.storage.find_items, collection, model_class,
+            where, sort_by, descending, limit, offset
+        )
+
+    async def page_items(self, collection: str, model_class: Type[T],
+                         where: Optional[Dict[str, Any]] = None, limit: int = 100,
+                         after: Optional[str] = None) -> Tuple[List[T], Optional[str]]:
+        """Get one page of items ordered by id and the id to continue after"""
+        return await self.run(self.storage.page_items, collection, model_class, where, limit, after)
+
+    async def iter_items(self, collection: str, model_class: Type[T],
+                         where: Optional[Dict[str, Any]] = None, page_size: int = 100,
+                         after: Optional[str] = None) -> AsyncIterator[T]:
+        """Iterate over matching items, reading one page at a time off the event loop"""
+        while True:
+            items, after = await self.page_items(collection, model_class, where, page_size, after)
+            for item in items:
+                yield item
+            if after is None:
+                return
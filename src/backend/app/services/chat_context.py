@@ -0,0 +1,113 @@
+import asyncio
+import os
+import logging
+from datetime import datetime
+from typing import List, Optional, Tuple
+from .storage_service import StorageService
+from .llm_metrics import llm_call_context
+from .llm_providers import estimate_tokens
+from .llm_service import LLMService
+from ..models.visitor import ChatHistory, ChatMessage
+
+CHAT_COLLECTION = "chat_histories"
+
+
+def _transcript(messages: List[ChatMessage]) -> str:
+    return "\n".join(f"{message.role}: {message.content}" for message in messages)
+
+
+class ChatContextManager:
+    """Keeps the context sent with each chat turn within a token budget.
+
+    Turns that no longer fit are folded into a rolling summary stored on the
+    ChatHistory, so each model call carries the summary plus recent turns
+    instead of the whole conversation. Folding goes down to half the budget
+    at once, so a summary is only written every few turns and the cost per
+    turn stays flat however long the conversation gets.
+    """
+
+    def __init__(self, storage: StorageService, llm_service: LLMService,
+                 max_tokens: Optional[int] = None, keep_recent: Optional[int] = None):
+        self.storage = storage
+        self.llm_service = llm_service
+        if max_tokens is None:
+            max_tokens = int(os.environ.get("CHAT_CONTEXT_TOKENS", 4000))
+        if keep_recent is None:
+            keep_recent = int(os.environ.get("CHAT_KEEP_RECENT", 6))
+        self.max_tokens = max_tokens
+        self.keep_recent = keep_recent
+
+    def get_history(self, user_id: str) -> ChatHistory:
+        """Get the chat history of a user, or an empty one"""
+        return self.storage.get_item(CHAT_COLLECTION, user_id, ChatHistory) or ChatHistory(user_id=user_id)
+
+    def _context_tokens(self, history: ChatHistory, start: int, prompt: str) -> int:
+        tokens = estimate_tokens(prompt) + (estimate_tokens(history.summary) if history.summary else 0)
+        return tokens + sum(estimate_tokens(message.content) for message in history.messages[start:])
+
+    def _fold_point(self, history: ChatHistory, prompt: str) -> Optional[int]:
+        """Index up to which messages must be summarized, or None if the context fits"""
+        if self._context_tokens(history, history.summarized_count, prompt) <= self.max_tokens:
+            return None
+        newest_kept = max(history.summarized_count, len(history.messages) - self.keep_recent)
+        end = history.summarized_count
+        while end < newest_kept and self._context_tokens(history, end, prompt) > self.max_tokens // 2:
+            end += 1
+        return end if end > history.summarized_count else None
+
+    def _summary_prompt(self, history: ChatHistory, end: int) -> str:
+        previous = f"Summary so far:\n{history.summary}\n\n" if history.summary else ""
+        return (
+            "You are summarizing a language tandem conversation so it can be continued later.\n"
+            f"{previous}"
+            f"New messages:\n{_transcript(history.messages[history.summarized_count:end])}\n\n"
+            "Write an updated summary in under 200 words. Keep names, topics, vocabulary being practiced "
+            "and corrections that were made. Return only the summary."
+        )
+
+    def _apply_summary(self, history: ChatHistory, end: int, summary: str) -> None:
+        logging.info(f"Summarized {end - history.summarized_count} chat messages of {history.user_id}")
+        history.summary = summary.strip()
+        history.summarized_count = end
+
+    def _record(self, history: ChatHistory, prompt: str, reply: str) -> None:
+        now = datetime.now()
+        history.messages.append(ChatMessage(role="user", content=prompt, timestamp=now))
+        history.messages.append(ChatMessage(role="assistant", content=reply, timestamp=datetime.now()))
+        self.storage.save_item(CHAT_COLLECTION, history)
+
+    def context(self, history: ChatHistory, prompt: str) -> Tuple[Optional[str], List[ChatMessage]]:
+        """Summarize old turns if needed and return the summary and messages to send with a prompt"""
+        end = self._fold_point(history, prompt)
+        if end is not None:
+            with llm_call_context(site="chat_summary"):
+                summary = self.llm_service.call_gemini_flash(self._summary_prompt(history, end))
+            self._apply_summary(history, end, summary)
+        return history.summary, history.messages[history.summarized_count:]
+
+    async def acontext(self, history: ChatHistory, prompt: str) -> Tuple[Optional[str], List[ChatMessage]]:
+        """Async variant of context"""
+        end = self._fold_point(history, prompt)
+        if end is not None:
+            with llm_call_context(site="chat_summary"):
+                summary = await self.llm_service.acall_gemini_flash(self._summary_prompt(history, end))
+            self._apply_summary(history, end, summary)
+        return history.summary, history.messages[history.summarized_count:]
+
+    def reply(self, user_id: str, prompt: str) -> str:
+        """Answer a chat message in the context of the user's conversation and record both"""
+        with llm_call_context(site="chat", user=user_id):
+            history = self.get_history(user_id)
+            summary, messages = self.context(history, prompt)
+            reply = self.llm_service.call_gemini_with_history(messages, prompt, summary=summary)
+        self._record(history, prompt, reply)
+        return reply
+
+    async def areply(self, user_id: str, prompt: str) -> str:
+        """Async variant of reply"""
+        with llm_call_context(site="chat", user=user_id):
+            history = await asyncio.to_thread(self.get_history, user_id)
+            summary, messages = await self.acontext(history, prompt)
+            reply = await self.llm_service.acall_gemini_with_history(messages, prompt, summary=summary)
+        await asyncio.to_thread(self._record, history, prompt, reply)
+        return reply
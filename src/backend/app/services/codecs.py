@@ -0,0 +1,127 @@
+import json
+import os
+from typing import Any, Dict, Optional
+from pydantic.json import pydantic_encoder
+
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib encoder
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # MessagePack storage is optional
+    msgpack = None
+
+
+class Codec:
+    """Turns collections into bytes and back"""
+
+    name = "codec"
+    extension = ".json"
+
+    def dumps(self, data: Any) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, raw: bytes) -> Any:
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    """Compact JSON encoded with the standard library"""
+
+    name = "json"
+
+    def __init__(self, indent: Optional[int] = None):
+        self.indent = indent
+        self.separators = None if indent is not None else (",", ":")
+
+    def dumps(self, data: Any) -> bytes:
+        text = json.dumps(
+            data, ensure_ascii=False, indent=self.indent,
+            separators=self.separators, default=pydantic_encoder
+        )
+        return text.encode("utf-8")
+
+    def loads(self, raw: bytes) -> Any:
+        return json.loads(raw)
+
+
+class OrjsonCodec(Codec):
+    """Compact JSON encoded with orjson"""
+
+    name = "orjson"
+
+    def dumps(self, data: Any) -> bytes:
+        # Non-string keys cover str enums used as dict keys, which the stdlib accepts too
+        return orjson.dumps(data, default=pydantic_encoder, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, raw: bytes) -> Any:
+        return orjson.loads(raw)
+
+
+class MsgpackCodec(Codec):
+    """MessagePack binary encoding"""
+
+    name = "msgpack"
+    extension = ".msgpack"
+
+    def dumps(self, data: Any) -> bytes:
+        return msgpack.packb(data, default=pydantic_encoder, use_bin_type=True)
+
+    def loads(self, raw: bytes) -> Any:
+        try:
+            return msgpack.unpackb(raw, raw=False)
+        except msgpack.UnpackException as e:
+            raise ValueError(str(e)) from e
+
+
+def fast_json_codec() -> Codec:
+    """Get the fastest available compact JSON codec"""
+    return OrjsonCodec() if orjson is not None else JsonCodec()
+
+
+# Shared JSON codec for documents that must stay JSON (journals, SQLite rows)
+json_codec = fast_json_codec()
+
+_CODECS = {
+    "json": fast_json_codec,
+    "json-pretty": lambda: JsonCodec(indent=2),
+    "msgpack": MsgpackCodec,
+}
+
+
+def get_codec(name: Optional[str] = None) -> Codec:
+    """Get a codec by name, defaulting to the STORAGE_CODEC environment variable"""
+    name = name or os.environ.get("STORAGE_CODEC", "json")
+    factory = _CODECS.get(name)
+    if factory is None:
+        raise ValueError(f"Unknown storage codec: {name}")
+    if name == "msgpack" and msgpack is None:
+        raise ValueError("The msgpack codec requires the msgpack package")
+    return factory()
+
+
+def detect_codec(raw: bytes) -> Codec:
+    """Pick the codec that can read ``raw`` by looking at its first byte.
+
+    JSON documents start with '{' or '[' (possibly after whitespace or a
+    BOM); anything else is taken to be MessagePack.
+    """
+    head = raw.lstrip(b"\xef\xbb\xbf \t\r\n")[:1]
+    if head in (b"{", b"[") or not head:
+        return json_codec
+    if msgpack is None:
+        raise ValueError("Data is not JSON and msgpack is not installed")
+    return MsgpackCodec()
+
+
+def decode(raw: bytes) -> Dict:
+    """Decode a collection file written with any codec"""
+    if raw.startswith(b"\xef\xbb\xbf"):
+        raw = raw[3:]
+    return detect_codec(raw).loads(raw)
+
+
+# File extensions of all formats a collection may be stored in
+KNOWN_EXTENSIONS = (JsonCodec.extension, MsgpackCodec.extension)
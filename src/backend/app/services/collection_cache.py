@@ -0,0 +1,156 @@
+import os
+import threading
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, Any
+from .indexing import CollectionIndexes
+
+# (inode, mtime in nanoseconds, size in bytes) of a collection file
+FileStamp = Tuple[int, int, int]
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def file_stamp(file_path: str) -> Optional[FileStamp]:
+    """Get the validation stamp of a file, or None if it does not exist"""
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class _CacheEntry:
+    __slots__ = ("stamp", "data", "weight", "indexes", "sorted_ids")
+
+    def __init__(self, stamp: FileStamp, data: Dict[str, Any], weight: int):
+        self.stamp = stamp
+        self.data = data
+        self.weight = weight
+        self.indexes: Optional[CollectionIndexes] = None
+        self.sorted_ids: Optional[List[str]] = None
+
+
+class CollectionCache:
+    """In-memory LRU cache of parsed collections shared across StorageService instances.
+
+    Entries are keyed by file path and are only served while the file's
+    stamp (inode, mtime, size) is unchanged, so writes from other processes
+    are picked up on the next read. The memory budget is measured in bytes
+    of the source file and the least recently used collections are evicted
+    first once it is exceeded.
+
+    Cached dicts are shared between callers and must be treated as read-only;
+    writers replace them with a new dict via put().
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, file_path: str, stamp: FileStamp) -> Optional[Dict[str, Any]]:
+        """Get a cached collection if it is still valid for the given stamp"""
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is None or entry.stamp != stamp:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(file_path)
+            self.hits += 1
+            return entry.data
+
+    def put(self, file_path: str, stamp: FileStamp, data: Dict[str, Any],
+            indexes: Optional[CollectionIndexes] = None) -> None:
+        """Store a parsed collection, evicting least recently used entries if needed"""
+        weight = stamp[2]
+        with self._lock:
+            self._discard(file_path)
+            if weight > self.max_bytes:
+                return
+            entry = _CacheEntry(stamp, data, weight)
+            entry.indexes = indexes
+            self._entries[file_path] = entry
+            self._total_bytes += weight
+            while self._total_bytes > self.max_bytes:
+                evicted_path, _ = next(iter(self._entries.items()))
+                self._discard(evicted_path)
+                self.evictions += 1
+                logging.debug(f"Evicted {evicted_path} from collection cache")
+
+    def indexes(self, file_path: str, data: Dict[str, Any]) -> Optional[CollectionIndexes]:
+        """Get the secondary indexes attached to a cached collection.
+
+        Indexes are created on first use and live as long as the cached dict
+        they describe; None is returned if ``data`` is no longer the cached
+        version of the collection.
+        """
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is None or entry.data is not data:
+                return None
+            if entry.indexes is None:
+                entry.indexes = CollectionIndexes()
+            return entry.indexes
+
+    def sorted_ids(self, file_path: str, data: Dict[str, Any]) -> Optional[List[str]]:
+        """Get the ids of a cached collection in order, sorted once per cached version.
+
+        None is returned if ``data`` is not the cached version of the collection.
+        """
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is None or entry.data is not data:
+                return None
+            if entry.sorted_ids is not None:
+                return entry.sorted_ids
+        ids = sorted(data)
+        with self._lock:
+            if self._entries.get(file_path) is entry:
+                entry.sorted_ids = ids
+        return ids
+
+    def attach_indexes(self, file_path: str, data: Dict[str, Any], indexes: CollectionIndexes) -> None:
+        """Attach already maintained indexes to a cached collection"""
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is not None and entry.data is data:
+                entry.indexes = indexes
+
+    def invalidate(self, file_path: str) -> None:
+        """Drop a collection from the cache"""
+        with self._lock:
+            self._discard(file_path)
+
+    def clear(self) -> None:
+        """Drop all cached collections"""
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Get cache counters"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _discard(self, file_path: str) -> None:
+        entry = self._entries.pop(file_path, None)
+        if entry is not None:
+            self._total_bytes -= entry.weight
+
+
+# Process-wide cache used by StorageService unless another one is injected
+shared_cache = CollectionCache(
+    int(os.environ.get("STORAGE_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+)
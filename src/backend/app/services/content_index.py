@@ -0,0 +1,306 @@
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+import unicodedata
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+from .storage_service import StorageService
+from ..models.cultural import CulturalNote, CulturalFunFact, Idiom
+from ..models.exercise import Exercise, ExerciseType
+
+# A pool of comparable content, e.g. ("idiom", "spanish") or ("flashcard", "french", "english", "beginner")
+Pool = Tuple[str, ...]
+
+# MinHash bins per signature and the LSH bands they are split into
+NUM_BINS = 64
+BANDS = 16
+ROWS = NUM_BINS // BANDS
+
+# Texts with fewer words are shingled by characters, longer ones by words
+WORD_SHINGLE_MIN = 8
+# Hashes taken of each character shingle, so that short texts still fill most bins
+CHAR_SHINGLE_HASHES = 4
+
+_HASH_MASK = 0xFFFFFFFF
+# Added per step when an empty bin borrows the value of a later one, so borrowed values never tie with real ones
+_BORROW_OFFSET = (_HASH_MASK // NUM_BINS) + 1
+
+# Collection, model and compared text of each kind of cultural content
+CULTURAL_KINDS = {
+    "note": ("cultural_notes", CulturalNote, lambda note: f"{note.title} {note.content}"),
+    "idiom": ("idioms", Idiom, lambda idiom: idiom.original_phrase),
+    "fun_fact": ("fun_facts", CulturalFunFact, lambda fact: f"{fact.title} {fact.content}"),
+}
+
+
+def pool_of(kind: str, *scope: Any) -> Pool:
+    """The pool of a kind of content, scoped by languages or levels (enums are taken by value)"""
+    return (kind,) + tuple(str(getattr(part, "value", part)) for part in scope)
+
+
+def flashcard_pool(language: Any, native_language: Any, level: Any) -> Pool:
+    # Definitions are written in the native language, so terms are only duplicates for the same learners
+    return pool_of(ExerciseType.FLASHCARD.value, language, native_language, level)
+
+
+def normalize(text: str) -> List[str]:
+    """Lower-case words of a text without accents or punctuation"""
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(char if char.isalnum() else " " for char in text if not unicodedata.combining(char))
+    return text.split()
+
+
+def shingles(text: str) -> Set[int]:
+    """Hashed shingles of a text: word trigrams of long texts, character trigrams of short ones"""
+    words = normalize(text)
+    if len(words) >= WORD_SHINGLE_MIN:
+        return {hash(" ".join(words[index:index + 3])) & _HASH_MASK for index in range(len(words) - 2)}
+    joined = f" {' '.join(words)} "
+    return {
+        hash((joined[index:index + 3], seed)) & _HASH_MASK
+        for index in range(max(1, len(joined) - 2)) for seed in range(CHAR_SHINGLE_HASHES)
+    }
+
+
+def signature(hashes: Iterable[int]) -> Tuple[int, ...]:
+    """One-permutation MinHash signature of a set of shingle hashes.
+
+    Each hash lands in one of NUM_BINS bins, which keeps its smallest value,
+    so a signature costs one pass over the shingles instead of one per bin.
+    Empty bins borrow the value of the next filled bin (densification), so
+    the share of equal bins of two signatures still estimates the Jaccard
+    similarity of their sets.
+    """
+    bins: List[Optional[int]] = [None] * NUM_BINS
+    for value in hashes:
+        index = value % NUM_BINS
+        value //= NUM_BINS
+        current = bins[index]
+        if current is None or value < current:
+            bins[index] = value
+    if all(value is None for value in bins):
+        return (0,) * NUM_BINS
+
+    dense: List[int] = []
+    for index, value in enumerate(bins):
+        distance = 0
+        while value is None:
+            distance += 1
+            value = bins[(index + distance) % NUM_BINS]
+        dense.append(value + distance * _BORROW_OFFSET)
+    return tuple(dense)
+
+
+def similarity(first: Tuple[int, ...], second: Tuple[int, ...]) -> float:
+    """Estimated Jaccard similarity of the shingle sets of two signatures"""
+    return sum(a == b for a, b in zip(first, second)) / NUM_BINS
+
+
+class Match(NamedTuple):
+    """An indexed item found to be a near-duplicate"""
+    item_id: str
+    similarity: float
+
+
+class _PoolIndex:
+    """Signatures of one pool and their LSH buckets"""
+
+    def __init__(self, window: int):
+        self.signatures: Dict[str, List[Tuple[int, ...]]] = {}
+        self.buckets: List[Dict[Tuple[int, ...], List[str]]] = [{} for _ in range(BANDS)]
+        # Recent check outcomes, True for a duplicate
+        self.outcomes: Deque[bool] = deque(maxlen=window)
+        self.last_check = 0.0
+        self.checks = 0
+        self.duplicates = 0
+
+    def find(self, sig: Tuple[int, ...], threshold: float) -> Optional[Match]:
+        best: Optional[Match] = None
+        seen = set()
+        for band, bucket in enumerate(self.buckets):
+            for item_id in bucket.get(sig[band * ROWS:(band + 1) * ROWS], ()):
+                if item_id in seen:
+                    continue
+                seen.add(item_id)
+                score = max(similarity(sig, other) for other in self.signatures[item_id])
+                if score >= threshold and (best is None or score > best.similarity):
+                    best = Match(item_id, score)
+        return best
+
+    def add(self, item_id: str, sig: Tuple[int, ...]) -> None:
+        # An item may hold several texts, such as the terms of a flashcard exercise
+        self.signatures.setdefault(item_id, []).append(sig)
+        for band, bucket in enumerate(self.buckets):
+            items = bucket.setdefault(sig[band * ROWS:(band + 1) * ROWS], [])
+            if item_id not in items:
+                items.append(item_id)
+
+
+class ContentIndex:
+    """Near-duplicate index of generated content, one pool per kind and language.
+
+    Texts are compared by MinHash signatures of their shingles, looked up
+    through LSH buckets, so a check touches only the few items that share a
+    band with the new text. Items at or above ``threshold`` estimated Jaccard
+    similarity are near-duplicates.
+
+    A pool is saturated when at least ``saturation_rate`` of its last
+    ``saturation_window`` checks found a duplicate; services then serve
+    existing content instead of generating more. Saturation lapses after
+    ``saturation_ttl`` seconds without checks, so one generation probes the
+    pool again.
+    """
+
+    def __init__(self, threshold: Optional[float] = None, saturation_window: Optional[int] = None,
+                 saturation_rate: Optional[float] = None, saturation_ttl: Optional[float] = None,
+                 seed: Optional[int] = None):
+        if threshold is None:
+            threshold = float(os.environ.get("DEDUP_THRESHOLD", 0.7))
+        if saturation_window is None:
+            saturation_window = int(os.environ.get("DEDUP_SATURATION_WINDOW", 10))
+        if saturation_rate is None:
+            saturation_rate = float(os.environ.get("DEDUP_SATURATION_RATE", 0.6))
+        if saturation_ttl is None:
+            saturation_ttl = float(os.environ.get("DEDUP_SATURATION_TTL", 3600))
+        self.threshold = threshold
+        self.saturation_window = saturation_window
+        self.saturation_rate = saturation_rate
+        self.saturation_ttl = saturation_ttl
+        self._pools: Dict[Pool, _PoolIndex] = {}
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+
+    def _pool(self, pool: Pool) -> _PoolIndex:
+        index = self._pools.get(pool)
+        if index is None:
+            index = self._pools[pool] = _PoolIndex(self.saturation_window)
+        return index
+
+    def add(self, pool: Pool, item_id: str, text: str) -> None:
+        """Index a text of an item without checking it"""
+        sig = signature(shingles(text))
+        with self._lock:
+            self._pool(pool).add(item_id, sig)
+
+    def find(self, pool: Pool, text: str) -> Optional[Match]:
+        """The most similar near-duplicate of a text in a pool, if any"""
+        sig = signature(shingles(text))
+        with self._lock:
+            return self._pool(pool).find(sig, self.threshold)
+
+    def check(self, pool: Pool, item_id: str, text: str) -> Optional[Match]:
+        """Index a new text unless it is a near-duplicate, returning the match that rejected it.
+
+        The check and the insert are one step, so two generations of the same
+        item that finish together do not both get in. The outcome counts
+        towards the pool's saturation.
+        """
+        sig = signature(shingles(text))
+        with self._lock:
+            index = self._pool(pool)
+            match = index.find(sig, self.threshold)
+            if match is None:
+                index.add(item_id, sig)
+            index.outcomes.append(match is not None)
+            index.last_check = time.monotonic()
+            index.checks += 1
+            index.duplicates += match is not None
+        return match
+
+    def saturated(self, pool: Pool) -> bool:
+        """Whether recent generations for a pool have mostly been duplicates"""
+        with self._lock:
+            index = self._pools.get(pool)
+            if index is None or not index.signatures or len(index.outcomes) < self.saturation_window:
+                return False
+            if time.monotonic() - index.last_check > self.saturation_ttl:
+                return False
+            return sum(index.outcomes) >= self.saturation_rate * self.saturation_window
+
+    def sample(self, pool: Pool, exclude: Iterable[str] = ()) -> Optional[str]:
+        """The id of a random item of a pool other than ``exclude``, None if there is none"""
+        exclude = set(exclude)
+        with self._lock:
+            index = self._pools.get(pool)
+            if index is None:
+                return None
+            candidates = [item_id for item_id in index.signatures if item_id not in exclude]
+            return self._random.choice(candidates) if candidates else None
+
+    def size(self, pool: Pool) -> int:
+        with self._lock:
+            index = self._pools.get(pool)
+            return len(index.signatures) if index is not None else 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Items, checks, duplicates and saturation of every pool"""
+        with self._lock:
+            pools = sorted(self._pools.items())
+        return {
+            "threshold": self.threshold,
+            "pools": [
+                {
+                    "pool": "/".join(pool),
+                    "items": len(index.signatures),
+                    "checks": index.checks,
+                    "duplicates": index.duplicates,
+                    "recent_duplicate_rate": round(sum(index.outcomes) / len(index.outcomes), 2) if index.outcomes else 0.0,
+                    "saturated": self.saturated(pool),
+                }
+                for pool, index in pools
+            ],
+        }
+
+    def load(self, storage: StorageService) -> int:
+        """Index the stored cultural content and the terms of stocked and served flashcards, returning the number of texts indexed"""
+        # Imported here: the inventory service depends on the exercise service, which uses this index
+        from .inventory_service import INVENTORY_COLLECTION
+        from ..models.inventory import StockedExercise
+
+        count = 0
+        for kind, (collection, model, text) in CULTURAL_KINDS.items():
+            for item in storage.iter_items(collection, model):
+                self.add(pool_of(kind, item.language), item.id, text(item))
+                count += 1
+        stocked = (
+            (item.exercise, item.native_language)
+            for item in storage.iter_items(INVENTORY_COLLECTION, StockedExercise, where={"type": ExerciseType.FLASHCARD})
+        )
+        # Exercises stored before they recorded the learners' native language cannot be placed in a pool
+        served = (
+            (exercise, exercise.native_language)
+            for exercise in storage.iter_items("exercises", Exercise, where={"type": ExerciseType.FLASHCARD})
+            if exercise.native_language is not None
+        )
+        # A stocked exercise is stored again once served
+        indexed = set()
+        for exercise, native_language in itertools.chain(stocked, served):
+            if exercise.id in indexed:
+                continue
+            indexed.add(exercise.id)
+            for term in flashcard_terms(exercise):
+                self.add(flashcard_pool(exercise.language, native_language, exercise.difficulty), exercise.id, term)
+                count += 1
+        return count
+
+
+def flashcard_terms(exercise: Exercise) -> List[str]:
+    """Terms of the flashcards of an exercise"""
+    return [
+        item["term"] for item in exercise.content.get("items", [])
+        if isinstance(item, dict) and isinstance(item.get("term"), str)
+    ]
+
+
+def create_content_index(storage: StorageService) -> Optional[ContentIndex]:
+    """Create the near-duplicate index configured by the DEDUP_* environment variables, None if disabled"""
+    if os.environ.get("DEDUP_ENABLED", "1").lower() in ("0", "false", "no"):
+        return None
+    index = ContentIndex()
+    started = time.perf_counter()
+    count = index.load(storage)
+    logging.info(f"Indexed {count} texts for near-duplicate detection in {time.perf_counter() - started:.2f}s")
+    return index
@@ -1,16 +1,35 @@
-from typing import List, Optional
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+import asyncio
+import logging
 import uuid
+from pydantic import BaseModel
 from .storage_service import StorageService
-from .llm_service import LLMService
+from .content_index import CULTURAL_KINDS, ContentIndex, pool_of
+from .llm_metrics import labelled, llm_call_context
+from .llm_service import LLMService, gather_limited, merge_limited
+from .single_flight import SingleFlight
+from .structured_output import RepairRequest, StructuredOutputError, arepair, parse_item, repair
 from ..models.cultural import CulturalNote, Idiom, CulturalFunFact
 from ..models.user import Language
 
+# Cultural content generations in flight, shared by all service instances
+_generations = SingleFlight()
+
+# List fields merged into a stored item from the near-duplicates of it that get generated
+MERGED_FIELDS = ("related_vocabulary", "equivalent_idioms")
+
+# A parsed item, or the request to repair it
+Parsed = Tuple[Optional[BaseModel], Optional[RepairRequest]]
+
 class CulturalService:
     """Service to handle cultural learning content"""
     
-    def __init__(self, storage: StorageService, llm_service: LLMService):
+    def __init__(self, storage: StorageService, llm_service: LLMService,
+                 content_index: Optional[ContentIndex] = None):
         self.storage = storage
         self.llm_service = llm_service
+        # Without an index generated content is stored without near-duplicate checks
+        self.content_index = content_index
     
     def get_cultural_note(self, note_id: str) -> Optional[CulturalNote]:
         """Get a cultural note by id"""
@@ -18,11 +37,7 @@ class CulturalService:
     
     def get_cultural_notes_by_language(self, language: Language) -> List[CulturalNote]:
         """Get cultural notes for a specific language"""
-        return self.storage.query_items(
-            "cultural_notes",
-            CulturalNote,
-            lambda note: note.language == language
-        )
+        return self.storage.find_items("cultural_notes", CulturalNote, where={"language": language})
     
     def get_idiom(self, idiom_id: str) -> Optional[Idiom]:
         """Get an idiom by id"""
@@ -30,11 +45,7 @@ class CulturalService:
     
     def get_idioms_by_language(self, language: Language) -> List[Idiom]:
         """Get idioms for a specific language"""
-        return self.storage.query_items(
-            "idioms",
-            Idiom,
-            lambda idiom: idiom.language == language
-        )
+        return self.storage.find_items("idioms", Idiom, where={"language": language})
     
     def get_fun_fact(self, fact_id: str) -> Optional[CulturalFunFact]:
         """Get a cultural fun fact by id"""
@@ -42,15 +53,10 @@ class CulturalService:
     
     def get_fun_facts_by_language(self, language: Language) -> List[CulturalFunFact]:
         """Get cultural fun facts for a specific language"""
-        return self.storage.query_items(
-            "fun_facts",
-            CulturalFunFact,
-            lambda fact: fact.language == language
-        )
+        return self.storage.find_items("fun_facts", CulturalFunFact, where={"language": language})
     
-    def generate_cultural_content(self, language: Language) -> dict:
-        """Generate cultural content for a language"""
-        # Generate Cultural Note
+    def _note_messages(self, language: Language) -> List[Dict[str, str]]:
+        """Build the LLM messages for a cultural note"""
         note_prompt = f"""
         Generate a cultural note about {language} language countries. Include:
         - A title for the cultural note
@@ -65,12 +71,13 @@ class CulturalService:
         }}
         """
         
-        note_response = self.llm_service.call_openai_llm([
+        return [
             {"role": "system", "content": "You are a cultural expert for language learning"},
             {"role": "user", "content": note_prompt}
-        ])
-        
-        # Generate Idiom
+        ]
+    
+    def _idiom_prompt(self, language: Language) -> str:
+        """Build the LLM prompt for an idiom"""
         idiom_prompt = f"""
         Generate an interesting idiom in {language}. Include:
         - The original phrase in {language}
@@ -91,9 +98,10 @@ class CulturalService:
         }}
         """
         
-        idiom_response = self.llm_service.call_gemini_flash(idiom_prompt)
-        
-        # Generate Fun Fact
+        return idiom_prompt
+    
+    def _fact_prompt(self, language: Language) -> str:
+        """Build the LLM prompt for a cultural fun fact"""
         fact_prompt = f"""
         Generate an interesting cultural fun fact about {language}-speaking countries. Include:
         - A catchy title
@@ -106,47 +114,251 @@ class CulturalService:
         }}
         """
         
-        fact_response = self.llm_service.call_gemini_flash(fact_prompt)
-        
-        # Process and store the generated content
-        import json
-        
-        # Cultural Note
-        note_data = json.loads(note_response)
-        note = CulturalNote(
-            id=f"note-{uuid.uuid4().hex[:8]}",
-            language=language,
-            title=note_data.get("title", f"Cultural Note about {language.capitalize()}"),
-            content=note_data.get("content", ""),
-            related_vocabulary=note_data.get("related_vocabulary", [])
+        return fact_prompt
+    
+    def _cultural_note(self, language: Language, response: str) -> Parsed:
+        """Read an LLM response into a cultural note"""
+        return parse_item(
+            CulturalNote, response, "note",
+            fixed={"id": f"note-{uuid.uuid4().hex[:8]}", "language": language},
+            defaults={"title": f"Cultural Note about {language.capitalize()}", "related_vocabulary": []},
+            hint="cultural note"
         )
-        self.storage.save_item("cultural_notes", note)
-        
-        # Idiom
-        idiom_data = json.loads(idiom_response)
-        idiom = Idiom(
-            id=f"idiom-{uuid.uuid4().hex[:8]}",
-            language=language,
-            original_phrase=idiom_data.get("original_phrase", ""),
-            literal_translation=idiom_data.get("literal_translation", ""),
-            meaning=idiom_data.get("meaning", ""),
-            example_usage=idiom_data.get("example_usage", ""),
-            equivalent_idioms=idiom_data.get("equivalent_idioms", [])
+    
+    def _idiom(self, language: Language, response: str) -> Parsed:
+        """Read an LLM response into an idiom"""
+        return parse_item(
+            Idiom, response, "idiom",
+            fixed={"id": f"idiom-{uuid.uuid4().hex[:8]}", "language": language},
+            defaults={"equivalent_idioms": []},
+            hint=f"idiom in {Language(language).value}"
         )
-        self.storage.save_item("idioms", idiom)
-        
-        # Fun Fact
-        fact_data = json.loads(fact_response)
-        fun_fact = CulturalFunFact(
-            id=f"fact-{uuid.uuid4().hex[:8]}",
-            language=language,
-            title=fact_data.get("title", f"Fun Fact about {language.capitalize()}"),
-            content=fact_data.get("content", "")
+    
+    def _fun_fact(self, language: Language, response: str) -> Parsed:
+        """Read an LLM response into a cultural fun fact"""
+        return parse_item(
+            CulturalFunFact, response, "fun_fact",
+            fixed={"id": f"fact-{uuid.uuid4().hex[:8]}", "language": language},
+            defaults={"title": f"Fun Fact about {language.capitalize()}"},
+            hint="cultural fun fact"
         )
-        self.storage.save_item("fun_facts", fun_fact)
+    
+    def _parse_content(self, language: Language, responses: Dict[str, str]) -> Dict[str, Parsed]:
+        """Read the response of each generated kind of item"""
+        parsers = {"note": self._cultural_note, "idiom": self._idiom, "fun_fact": self._fun_fact}
+        return {kind: parsers[kind](language, response) for kind, response in responses.items()}
+    
+    def _repair_context(self, language: Language) -> str:
+        return f"These are cultural learning items about {Language(language).value}-speaking countries."
+    
+    def _finish(self, parsed: Dict[str, Parsed], repaired: Dict[str, BaseModel]) -> Dict[str, BaseModel]:
+        """Take the repaired items in place of the invalid ones, failing if one could not be repaired"""
+        content = {}
+        for kind, (item, request) in parsed.items():
+            item = item if item is not None else repaired.get(request.ref)
+            if item is None:
+                raise StructuredOutputError(f"Could not generate a valid {kind.replace('_', ' ')}")
+            content[kind] = item
+        return content
+    
+    def _complete(self, language: Language, parsed: Dict[str, Parsed]) -> Dict[str, BaseModel]:
+        """Re-ask the model for the invalid fields of the parsed items, all in one call"""
+        requests = [request for _, request in parsed.values() if request is not None]
+        with llm_call_context(site="cultural_repair", language=language):
+            repaired = repair(
+                lambda prompt, variant: self.llm_service.call_gemini_flash(prompt, variant=variant, json_mode=True),
+                requests, self._repair_context(language)
+            ) if requests else {}
+        return self._finish(parsed, repaired)
+    
+    async def _acomplete(self, language: Language, parsed: Dict[str, Parsed]) -> Dict[str, BaseModel]:
+        """Async variant of _complete"""
+        requests = [request for _, request in parsed.values() if request is not None]
+        with llm_call_context(site="cultural_repair", language=language):
+            repaired = await arepair(
+                lambda prompt, variant: self.llm_service.acall_gemini_flash(prompt, variant=variant, json_mode=True),
+                requests, self._repair_context(language)
+            ) if requests else {}
+        return self._finish(parsed, repaired)
+    
+    def _merge(self, existing: BaseModel, duplicate: BaseModel) -> BaseModel:
+        """Add the list entries a near-duplicate brings, such as new vocabulary, to the stored item"""
+        updates = {}
+        for field in MERGED_FIELDS:
+            if field not in existing.__fields__:
+                continue
+            entries = getattr(existing, field) or []
+            new = [entry for entry in getattr(duplicate, field) or [] if entry not in entries]
+            if new:
+                updates[field] = entries + new
+        return existing.copy(update=updates) if updates else existing
+    
+    def _accept(self, language: Language, kind: str, item: BaseModel) -> Tuple[BaseModel, bool]:
+        """Check a generated item against the near-duplicate index: (item to serve, whether to save it).
+
+        A near-duplicate of a stored item is rejected and the stored item is
+        served in its place, merged with the duplicate's new list entries.
+        """
+        if self.content_index is None:
+            return item, True
+        collection, model, text = CULTURAL_KINDS[kind]
+        pool = pool_of(kind, language)
+        match = self.content_index.check(pool, item.id, text(item))
+        existing = self.storage.get_item(collection, match.item_id, model) if match is not None else None
+        if existing is None:
+            if match is not None:
+                # The matched item is gone from storage: keep the new one instead
+                self.content_index.add(pool, item.id, text(item))
+            return item, True
+        logging.info(
+            f"Generated {kind} for {Language(language).value} repeats {existing.id} "
+            f"(similarity {match.similarity:.2f}), serving the stored one"
+        )
+        merged = self._merge(existing, item)
+        return merged, merged is not existing
+    
+    def _pooled(self, language: Language) -> Dict[str, BaseModel]:
+        """Stored items served instead of generating the kinds whose pool is saturated for a language"""
+        if self.content_index is None:
+            return {}
+        pooled = {}
+        for kind, (collection, model, _) in CULTURAL_KINDS.items():
+            pool = pool_of(kind, language)
+            if not self.content_index.saturated(pool):
+                continue
+            item_id = self.content_index.sample(pool)
+            item = self.storage.get_item(collection, item_id, model) if item_id is not None else None
+            if item is not None:
+                pooled[kind] = item
+        if pooled:
+            logging.info(f"Serving stored {', '.join(pooled)} for {Language(language).value}: pool saturated")
+        return pooled
+    
+    def _store_cultural_content(self, language: Language, content: Dict[str, BaseModel],
+                                pooled: Optional[Dict[str, BaseModel]] = None) -> dict:
+        """Store generated items that are not near-duplicates and return them with the pooled ones"""
+        served = dict(pooled or {})
+        changed = []
+        for kind, item in content.items():
+            served[kind], save = self._accept(language, kind, item)
+            if save:
+                changed.append((CULTURAL_KINDS[kind][0], served[kind]))
+        # Store the items together so a failure leaves no partial set behind
+        with self.storage.batch():
+            for collection, item in changed:
+                self.storage.save_item(collection, item)
         
-        return {
-            "note": note,
-            "idiom": idiom,
-            "fun_fact": fun_fact
-        } 
\ No newline at end of file
+        return {kind: served[kind] for kind in CULTURAL_KINDS}
+    
+    def _generation_key(self, language: Language) -> Tuple[int, str]:
+        return id(self.storage), Language(language).value
+    
+    def generate_cultural_content(self, language: Language) -> dict:
+        """Generate cultural content for a language.
+
+        Requests for the same language that arrive while a generation is in
+        flight get that generation's content instead of starting their own.
+        """
+        return _generations.do(self._generation_key(language), lambda: self._generate_cultural_content(language))
+    
+    def _generate_cultural_content(self, language: Language) -> dict:
+        # Every generation must bring new content, so it skips the response cache; repairs are cached
+        pooled = self._pooled(language)
+        calls = {
+            "note": lambda: self.llm_service.call_openai_llm(
+                self._note_messages(language), use_cache=False, json_mode=True
+            ),
+            "idiom": lambda: self.llm_service.call_gemini_flash(
+                self._idiom_prompt(language), use_cache=False, json_mode=True
+            ),
+            "fun_fact": lambda: self.llm_service.call_gemini_flash(
+                self._fact_prompt(language), use_cache=False, json_mode=True
+            ),
+        }
+        responses = {}
+        for kind, call in calls.items():
+            if kind not in pooled:
+                with llm_call_context(site=kind, language=language):
+                    responses[kind] = call()
+        content = self._complete(language, self._parse_content(language, responses))
+        return self._store_cultural_content(language, content, pooled)
+    
+    async def agenerate_cultural_content(self, language: Language) -> dict:
+        """Generate cultural content for a language, running the LLM calls concurrently.
+
+        Concurrent requests for the same language share one generation, as
+        in generate_cultural_content.
+        """
+        return await _generations.ado(
+            self._generation_key(language), lambda: self._agenerate_cultural_content(language)
+        )
+    
+    async def _agenerate_cultural_content(self, language: Language) -> dict:
+        pooled = await asyncio.to_thread(self._pooled, language)
+        calls = {
+            "note": lambda: self.llm_service.acall_openai_llm(
+                self._note_messages(language), use_cache=False, json_mode=True
+            ),
+            "idiom": lambda: self.llm_service.acall_gemini_flash(
+                self._idiom_prompt(language), use_cache=False, json_mode=True
+            ),
+            "fun_fact": lambda: self.llm_service.acall_gemini_flash(
+                self._fact_prompt(language), use_cache=False, json_mode=True
+            ),
+        }
+        kinds = [kind for kind in calls if kind not in pooled]
+        responses = await gather_limited([labelled(calls[kind](), site=kind, language=language) for kind in kinds])
+        content = await self._acomplete(language, self._parse_content(language, dict(zip(kinds, responses))))
+        return await asyncio.to_thread(self._store_cultural_content, language, content, pooled)
+    
+    async def _astream_item(self, language: Language, kind: str, deltas: AsyncIterator[str],
+                            build: Callable[[str], Parsed]) -> AsyncIterator[Tuple[str, Any]]:
+        """Stream one cultural item: its response text as it is generated, then the stored item"""
+        parts = []
+        async for delta in deltas:
+            parts.append(delta)
+            yield "delta", {"kind": kind, "text": delta}
+        item = (await self._acomplete(language, {kind: build("".join(parts))}))[kind]
+        item, save = await asyncio.to_thread(self._accept, language, kind, item)
+        if save:
+            await asyncio.to_thread(self.storage.save_item, CULTURAL_KINDS[kind][0], item)
+        yield kind, item
+    
+    async def astream_cultural_content(self, language: Language) -> AsyncIterator[Tuple[str, Any]]:
+        """Generate cultural content, yielding ("delta", chunk) events and each item once stored.
+
+        Unlike generate_cultural_content, every item is stored on its own as
+        soon as it is ready. Items of saturated pools come first, from storage.
+        """
+        pooled = await asyncio.to_thread(self._pooled, language)
+        for kind, item in pooled.items():
+            yield kind, item
+        calls = {
+            "note": (
+                lambda: self.llm_service.astream_openai_llm(
+                    self._note_messages(language), use_cache=False, json_mode=True
+                ),
+                lambda response: self._cultural_note(language, response)
+            ),
+            "idiom": (
+                lambda: self.llm_service.astream_gemini_flash(
+                    self._idiom_prompt(language), use_cache=False, json_mode=True
+                ),
+                lambda response: self._idiom(language, response)
+            ),
+            "fun_fact": (
+                lambda: self.llm_service.astream_gemini_flash(
+                    self._fact_prompt(language), use_cache=False, json_mode=True
+                ),
+                lambda response: self._fun_fact(language, response)
+            ),
+        }
+        streams = []
+        for kind, (stream, build) in calls.items():
+            if kind in pooled:
+                continue
+            with llm_call_context(site=kind, language=language):
+                deltas = stream()
+            streams.append(self._astream_item(language, kind, deltas, build))
+        async for _, event in merge_limited(streams):
+            yield event
@@ -1,20 +1,84 @@
-from typing import List, Dict, Any, Optional
+from typing import AsyncIterator, List, Dict, Any, NamedTuple, Optional, Set, Tuple
+import asyncio
+import os
 import uuid
+import logging
 from datetime import datetime
 from .storage_service import StorageService
-from .llm_service import LLMService
+from pydantic import BaseModel
+from .content_index import ContentIndex, Pool, flashcard_pool
+from .llm_metrics import llm_call_context
+from .llm_service import LLMService, gather_limited, merge_limited
+from .structured_output import RepairRequest, StructuredOutputError, arepair, extract_json, repair, validate
 from ..models.exercise import (
     Exercise, ExerciseType, ExerciseStatus,
     FlashcardItem, QuizItem, ConversationPrompt, PronunciationItem
 )
 from ..models.user import User, Language, ProficiencyLevel
 
+# Topics for generated exercises: flashcards and quizzes take turns walking through them
+TOPICS = ["travel", "food", "daily life", "hobbies", "culture"]
+
+# Ask for all exercises of a request in one structured LLM call instead of one call each
+BATCH_GENERATION = os.environ.get("EXERCISE_BATCH_GENERATION", "1").lower() not in ("0", "false", "no")
+# Calls made for a batch: the first one plus re-requests of the exercises that failed validation
+BATCH_ATTEMPTS = int(os.environ.get("EXERCISE_BATCH_ATTEMPTS", 3))
+# Stored exercises drawn from a saturated pool for one slot while looking for one on its topic
+POOLED_CANDIDATES = 5
+
+# Item model and Exercise.content key of each generated exercise type
+ITEM_MODELS = {
+    ExerciseType.FLASHCARD: (FlashcardItem, "items"),
+    ExerciseType.QUIZ: (QuizItem, "questions"),
+    ExerciseType.CONVERSATION: (ConversationPrompt, "prompts"),
+}
+
+# Items asked for in an exercise of each type
+ITEM_COUNTS = {
+    ExerciseType.FLASHCARD: 5,
+    ExerciseType.QUIZ: 5,
+    ExerciseType.CONVERSATION: 3,
+}
+
+# How each type is described to the model in a batched request
+BATCH_ITEM_FORMATS = {
+    ExerciseType.FLASHCARD: (
+        '5 flashcards, each {{"term": "word in {target}", "definition": "definition in {native}", '
+        '"example": "example sentence in {target}"}}'
+    ),
+    ExerciseType.QUIZ: (
+        '5 multiple-choice questions, each {{"question": "question text", "options": ["4 options"], '
+        '"correct_answer": 0, "explanation": "why this is correct"}} where correct_answer is the index (0-3) of the right option'
+    ),
+    ExerciseType.CONVERSATION: (
+        '3 conversation prompts for the tandem partners, each {{"prompt": "prompt text", '
+        '"context": "context information", "suggested_vocabulary": ["5 useful words"]}}'
+    ),
+}
+
+
+class ExerciseSlot(NamedTuple):
+    """Type and topic of one exercise to generate"""
+    type: ExerciseType
+    topic: str
+
+
+class ExerciseDraft(NamedTuple):
+    """An exercise read from a response; ``items`` holds None for the invalid items listed in ``failures``"""
+    slot: ExerciseSlot
+    title: Optional[str]
+    items: List[Optional[BaseModel]]
+    failures: List[RepairRequest]
+
 class ExerciseService:
     """Service to handle exercise generation and management"""
     
-    def __init__(self, storage: StorageService, llm_service: LLMService):
+    def __init__(self, storage: StorageService, llm_service: LLMService,
+                 content_index: Optional[ContentIndex] = None):
         self.storage = storage
         self.llm_service = llm_service
+        # Without an index flashcards are not checked for terms the learners' pool already has
+        self.content_index = content_index
     
     def get_exercise(self, exercise_id: str) -> Optional[Exercise]:
         """Get an exercise by id"""
@@ -22,15 +86,40 @@ class ExerciseService:
     
     def get_exercises_for_user(self, user: User) -> List[Exercise]:
         """Get exercises for a specific user based on their target language and level"""
-        exercises = self.storage.query_items(
-            "exercises", 
+        return self.storage.find_items(
+            "exercises",
             Exercise,
-            lambda ex: ex.language == user.target_language
+            where={"language": user.target_language}
+        )
+    
+    def _new_exercise(self, user: User, slot: ExerciseSlot, title: Optional[str],
+                      content: Dict[str, Any]) -> Exercise:
+        """Create an exercise for a user, with a default title if the model gave none"""
+        language = user.target_language
+        if slot.type == ExerciseType.FLASHCARD:
+            default_title = f"{language.capitalize()} Flashcards: {slot.topic}"
+            description = f"Practice {language} vocabulary about {slot.topic}"
+        elif slot.type == ExerciseType.QUIZ:
+            default_title = f"{language.capitalize()} Quiz: {slot.topic}"
+            description = f"Test your {language} knowledge about {slot.topic}"
+        else:
+            default_title = f"Conversation Practice: {slot.topic}"
+            description = f"Practice conversation with your tandem partner about {slot.topic}"
+        
+        return Exercise(
+            id=f"ex-{uuid.uuid4().hex[:8]}",
+            title=title or default_title,
+            description=description,
+            type=slot.type,
+            language=language,
+            difficulty=user.proficiency_level,
+            content=content,
+            status=ExerciseStatus.NEW,
+            native_language=user.native_language
         )
-        return exercises
     
-    def _generate_flashcard_exercise(self, user: User, topic: str) -> Exercise:
-        """Generate a flashcard exercise using LLM"""
+    def _flashcard_messages(self, user: User, topic: str) -> List[Dict[str, str]]:
+        """Build the LLM messages for a flashcard exercise"""
         prompt = f"""
         Generate a set of 5 flashcards for learning {user.target_language} at {user.proficiency_level} level.
         Topic: {topic}
@@ -49,30 +138,13 @@ class ExerciseService:
         }}
         """
         
-        response = self.llm_service.call_openai_llm([
+        return [
             {"role": "system", "content": "You are a language learning assistant"},
             {"role": "user", "content": prompt}
-        ])
-        
-        # Assume the response is valid JSON
-        import json
-        content = json.loads(response)
-        
-        exercise_id = f"ex-{uuid.uuid4().hex[:8]}"
-        
-        return Exercise(
-            id=exercise_id,
-            title=content.get("title", f"{user.target_language.capitalize()} Flashcards: {topic}"),
-            description=f"Practice {user.target_language} vocabulary about {topic}",
-            type=ExerciseType.FLASHCARD,
-            language=user.target_language,
-            difficulty=user.proficiency_level,
-            content={"items": content.get("items", [])},
-            status=ExerciseStatus.NEW
-        )
+        ]
     
-    def _generate_quiz_exercise(self, user: User, topic: str) -> Exercise:
-        """Generate a quiz exercise using LLM"""
+    def _quiz_messages(self, user: User, topic: str) -> List[Dict[str, str]]:
+        """Build the LLM messages for a quiz exercise"""
         prompt = f"""
         Generate a quiz with 5 multiple-choice questions for learning {user.target_language} 
         at {user.proficiency_level} level. Topic: {topic}
@@ -98,34 +170,22 @@ class ExerciseService:
         }}
         """
         
-        response = self.llm_service.call_openai_llm([
+        return [
             {"role": "system", "content": "You are a language learning assistant"},
             {"role": "user", "content": prompt}
-        ])
-        
-        # Assume the response is valid JSON
-        import json
-        content = json.loads(response)
-        
-        exercise_id = f"ex-{uuid.uuid4().hex[:8]}"
-        
-        return Exercise(
-            id=exercise_id,
-            title=content.get("title", f"{user.target_language.capitalize()} Quiz: {topic}"),
-            description=f"Test your {user.target_language} knowledge about {topic}",
-            type=ExerciseType.QUIZ,
-            language=user.target_language,
-            difficulty=user.proficiency_level,
-            content={"questions": content.get("questions", [])},
-            status=ExerciseStatus.NEW
-        )
+        ]
     
-    def _generate_conversation_exercise(self, user: User, partner: User) -> Exercise:
-        """Generate conversation prompts based on shared interests"""
-        # Find shared interests
-        shared_interests = set(user.interests).intersection(set(partner.interests))
-        interest = next(iter(shared_interests)) if shared_interests else user.interests[0]
-        
+    def _conversation_interest(self, user: User, partner: User) -> str:
+        """Pick the topic of a conversation exercise"""
+        return self._conversation_interests(user, partner)[0]
+    
+    def _conversation_interests(self, user: User, partner: User) -> List[str]:
+        """Interests to talk about: the shared ones in the user's order, or all of the user's"""
+        shared_interests = [interest for interest in user.interests if interest in partner.interests]
+        return shared_interests or user.interests
+    
+    def _conversation_messages(self, user: User, partner: User, interest: str) -> List[Dict[str, str]]:
+        """Build the LLM messages for conversation prompts"""
         prompt = f"""
         Generate 3 conversation prompts for language tandem practice between:
         - Person 1: Native {user.native_language} speaker learning {user.target_language} at {user.proficiency_level} level
@@ -152,52 +212,435 @@ class ExerciseService:
         }}
         """
         
-        response = self.llm_service.call_openai_llm([
+        return [
             {"role": "system", "content": "You are a language learning assistant"},
             {"role": "user", "content": prompt}
-        ])
+        ]
+    
+    def _exercise_plan(self, user: User, partner: User, count: int) -> List[ExerciseSlot]:
+        """Pick the type and topic of each of ``count`` exercises.
+
+        Types take turns (flashcard, quiz, conversation); flashcards and
+        quizzes walk through TOPICS and conversations through the learners'
+        interests.
+        """
+        interests = self._conversation_interests(user, partner)
+        slots = []
+        for index in range(count):
+            round_, position = divmod(index, 3)
+            if position == 0:
+                slots.append(ExerciseSlot(ExerciseType.FLASHCARD, TOPICS[(2 * round_) % len(TOPICS)]))
+            elif position == 1:
+                slots.append(ExerciseSlot(ExerciseType.QUIZ, TOPICS[(2 * round_ + 1) % len(TOPICS)]))
+            else:
+                slots.append(ExerciseSlot(ExerciseType.CONVERSATION, interests[round_ % len(interests)]))
+        return slots
+    
+    def _slot_messages(self, user: User, partner: User, slot: ExerciseSlot) -> List[Dict[str, str]]:
+        """Build the LLM messages for a single exercise"""
+        if slot.type == ExerciseType.FLASHCARD:
+            return self._flashcard_messages(user, slot.topic)
+        if slot.type == ExerciseType.QUIZ:
+            return self._quiz_messages(user, slot.topic)
+        return self._conversation_messages(user, partner, slot.topic)
+    
+    def _parse_entry(self, slot: ExerciseSlot, entry: Dict[str, Any]) -> ExerciseDraft:
+        """Validate the items of one exercise in a response, raising ValueError if none is usable"""
+        if entry.get("type", slot.type.value) != slot.type.value:
+            raise ValueError(f"expected a {slot.type.value} exercise, got {entry.get('type')!r}")
+        item_model, content_key = ITEM_MODELS[slot.type]
+        # Single answers list items under the content key, batched ones under "items"
+        items = entry.get(content_key) if content_key in entry else entry.get("items")
+        if not isinstance(items, list) or not items:
+            raise ValueError("no items")
         
-        # Assume the response is valid JSON
-        import json
-        content = json.loads(response)
+        validated, failures = [], []
+        for position, raw in enumerate(items, 1):
+            item, errors = validate(item_model, raw)
+            validated.append(item)
+            if item is None:
+                failures.append(RepairRequest(
+                    str(position), item_model, raw, errors, hint=f"{slot.type.value} item about {slot.topic}"
+                ))
+        if len(failures) == len(items):
+            raise ValueError(f"no valid items: {failures[0].errors}")
         
-        exercise_id = f"ex-{uuid.uuid4().hex[:8]}"
+        title = entry.get("title") if isinstance(entry.get("title"), str) else None
+        return ExerciseDraft(slot, title, validated, failures)
+    
+    def _slot_draft(self, slot: ExerciseSlot, response: str) -> ExerciseDraft:
+        """Read the response to a single-exercise prompt.
+
+        An unusable answer gives a draft whose items are all missing, so they
+        are asked for again by the repair call like any invalid item.
+        """
+        try:
+            content = extract_json(response)
+            if not isinstance(content, dict):
+                raise StructuredOutputError("expected a JSON object")
+            return self._parse_entry(slot, content)
+        except ValueError as e:
+            logging.warning(f"Unusable {slot.type.value} exercise, asking for its items again: {str(e)}")
+        item_model, _ = ITEM_MODELS[slot.type]
+        failures = [
+            RepairRequest(
+                str(position), item_model, None, {"__root__": "missing"}, hint=f"{slot.type.value} item about {slot.topic}"
+            )
+            for position in range(1, ITEM_COUNTS[slot.type] + 1)
+        ]
+        return ExerciseDraft(slot, None, [None] * len(failures), failures)
+    
+    def _batch_messages(self, user: User, partner: User, slots: List[ExerciseSlot]) -> List[Dict[str, str]]:
+        """Build the LLM messages asking for several exercises at once"""
+        # Enum values, not their reprs, in the prompt
+        target, native = Language(user.target_language).value, Language(user.native_language).value
+        exercises = "\n".join(
+            f"{index}. {slot.type.value}, topic: {slot.topic}" for index, slot in enumerate(slots, 1)
+        )
+        formats = "\n".join(
+            f"- {exercise_type.value}: " + BATCH_ITEM_FORMATS[exercise_type].format(
+                target=target, native=native
+            )
+            for exercise_type in ITEM_MODELS if any(slot.type == exercise_type for slot in slots)
+        )
+        partner_line = ""
+        if any(slot.type == ExerciseType.CONVERSATION for slot in slots):
+            partner_line = (
+                f"The tandem partner is a native {Language(partner.native_language).value} speaker learning "
+                f"{Language(partner.target_language).value} at {ProficiencyLevel(partner.proficiency_level).value} level.\n"
+            )
+        prompt = (
+            f"Generate {len(slots)} exercises for a native {native} speaker learning "
+            f"{target} at {ProficiencyLevel(user.proficiency_level).value} level.\n"
+            f"{partner_line}\n"
+            f"Exercises:\n{exercises}\n\n"
+            f"Items of each exercise type:\n{formats}\n\n"
+            "Return as JSON in this format, one entry per exercise in the same order:\n"
+            '{"exercises": [{"index": 1, "type": "flashcard", "title": "Exercise title", "items": [...]}, ...]}'
+        )
+        return [
+            {"role": "system", "content": "You are a language learning assistant"},
+            {"role": "user", "content": prompt}
+        ]
+    
+    def _parse_batch(self, slots: List[ExerciseSlot], response: str) -> Dict[int, ExerciseDraft]:
+        """Read a batched LLM response into drafts by slot position, leaving out unusable entries"""
+        try:
+            entries = extract_json(response)["exercises"]
+        except (ValueError, KeyError, TypeError):
+            logging.warning("Batched exercise response holds no exercises")
+            return {}
         
-        return Exercise(
-            id=exercise_id,
-            title=content.get("title", f"Conversation Practice: {interest}"),
-            description=f"Practice conversation with your tandem partner about {interest}",
-            type=ExerciseType.CONVERSATION,
-            language=user.target_language,
-            difficulty=user.proficiency_level,
-            content={"prompts": content.get("prompts", [])},
-            status=ExerciseStatus.NEW
+        drafts = {}
+        for position, entry in enumerate(entries if isinstance(entries, list) else []):
+            if not isinstance(entry, dict):
+                continue
+            index = entry.get("index", position + 1)
+            if not isinstance(index, int) or not 1 <= index <= len(slots) or index - 1 in drafts:
+                continue
+            try:
+                drafts[index - 1] = self._parse_entry(slots[index - 1], entry)
+            except ValueError as e:
+                logging.warning(f"Invalid {slots[index - 1].type.value} exercise in batched response: {str(e)}")
+        return drafts
+    
+    def _repair_requests(self, drafts: Dict[int, ExerciseDraft]) -> List[RepairRequest]:
+        """The invalid items of the drafts, with refs of the form <slot>.<item>"""
+        return [
+            failure._replace(ref=f"{index + 1}.{failure.ref}")
+            for index, draft in sorted(drafts.items()) for failure in draft.failures
+        ]
+    
+    def _repair_messages(self, user: User, prompt: str) -> List[Dict[str, str]]:
+        """Build the LLM messages re-asking for invalid exercise items"""
+        context = (
+            f"These are items of exercises for a native {Language(user.native_language).value} speaker learning "
+            f"{Language(user.target_language).value} at {ProficiencyLevel(user.proficiency_level).value} level."
+        )
+        return [
+            {"role": "system", "content": "You are a language learning assistant"},
+            {"role": "user", "content": f"{context}\n\n{prompt}"}
+        ]
+    
+    def _finish(self, user: User, drafts: Dict[int, ExerciseDraft],
+                repaired: Dict[str, BaseModel]) -> Dict[int, Exercise]:
+        """Build the exercises of the drafts by position, leaving out the items that could not be repaired.
+
+        A draft left without any item is dropped; ValueError is raised if that leaves no exercise.
+        """
+        exercises = {}
+        for index, draft in sorted(drafts.items()):
+            items = [
+                item if item is not None else repaired.get(f"{index + 1}.{position}")
+                for position, item in enumerate(draft.items, 1)
+            ]
+            items = [item for item in items if item is not None]
+            if not items:
+                logging.warning(f"Dropped {draft.slot.type.value} exercise about {draft.slot.topic}: no item could be repaired")
+                with llm_call_context(site=draft.slot.type):
+                    self.llm_service.metrics.record_dropped()
+                continue
+            _, content_key = ITEM_MODELS[draft.slot.type]
+            exercise = self._new_exercise(
+                user, draft.slot, draft.title, {content_key: [item.dict() for item in items]}
+            )
+            if draft.slot.type == ExerciseType.FLASHCARD:
+                exercise = self._distinct_flashcards(user, exercise)
+            exercises[index] = exercise
+        if drafts and not exercises:
+            raise ValueError(f"Could not generate any of {len(drafts)} exercises")
+        return exercises
+    
+    def _distinct_flashcards(self, user: User, exercise: Exercise) -> Exercise:
+        """Drop the flashcards whose term near-duplicates one the learners' pool already has, or an earlier card's"""
+        if self.content_index is None:
+            return exercise
+        pool = flashcard_pool(user.target_language, user.native_language, user.proficiency_level)
+        cards = exercise.content["items"]
+        kept = [card for card in cards if self.content_index.check(pool, exercise.id, card["term"]) is None]
+        if len(kept) == len(cards):
+            return exercise
+        if not kept:
+            # Every card repeats a known term: hand the set out whole rather than empty
+            logging.info(f"All flashcards of {exercise.id} repeat known terms")
+            return exercise
+        logging.info(f"Dropped {len(cards) - len(kept)} flashcards of {exercise.id} repeating known terms")
+        return exercise.copy(update={"content": {**exercise.content, "items": kept}})
+    
+    def _pool_saturated(self, user: User, slot: ExerciseSlot) -> bool:
+        """Whether new exercises of a slot would mostly repeat stored content for these learners"""
+        if self.content_index is None or slot.type != ExerciseType.FLASHCARD:
+            return False
+        return self.content_index.saturated(
+            flashcard_pool(user.target_language, user.native_language, user.proficiency_level)
+        )
+    
+    def _pooled_exercises(self, user: User, slots: List[ExerciseSlot]) -> Dict[int, Exercise]:
+        """Stored exercises served, by slot position, instead of generating the slots whose pool is saturated.
+
+        An exercise is served at most once per request.
+        """
+        pooled = {}
+        served: Set[str] = set()
+        for index, slot in enumerate(slots):
+            if not self._pool_saturated(user, slot):
+                continue
+            exercise = self._pooled_exercise(
+                flashcard_pool(user.target_language, user.native_language, user.proficiency_level), slot, served
+            )
+            if exercise is not None:
+                pooled[index] = exercise
+                served.add(exercise.id)
+        if pooled:
+            logging.info(f"Serving {len(pooled)} stored exercises for {user.id}: flashcard pool saturated")
+        return pooled
+    
+    def _pooled_exercise(self, pool: Pool, slot: ExerciseSlot, served: Set[str]) -> Optional[Exercise]:
+        """A stored exercise of a pool other than ``served``, on the slot's topic if one of a few drawn is"""
+        drawn = set(served)
+        fallback = None
+        for _ in range(POOLED_CANDIDATES):
+            exercise_id = self.content_index.sample(pool, exclude=drawn)
+            if exercise_id is None:
+                break
+            drawn.add(exercise_id)
+            # Stocked exercises are indexed too but are not handed out from here
+            exercise = self.get_exercise(exercise_id)
+            if exercise is None:
+                continue
+            # The description names the topic the exercise was generated for
+            if slot.topic.casefold() in exercise.description.casefold():
+                return exercise
+            fallback = fallback or exercise
+        return fallback
+    
+    def _complete(self, user: User, drafts: Dict[int, ExerciseDraft]) -> Dict[int, Exercise]:
+        """Re-ask the model for the invalid items of the drafts, all in one call, and build the exercises"""
+        requests = self._repair_requests(drafts)
+        with llm_call_context(site="exercise_repair"):
+            repaired = repair(
+                lambda prompt, variant: self.llm_service.call_openai_llm(
+                    self._repair_messages(user, prompt), variant=variant, json_mode=True
+                ),
+                requests
+            ) if requests else {}
+        return self._finish(user, drafts, repaired)
+    
+    async def _acomplete(self, user: User, drafts: Dict[int, ExerciseDraft]) -> Dict[int, Exercise]:
+        """Async variant of _complete"""
+        requests = self._repair_requests(drafts)
+        with llm_call_context(site="exercise_repair"):
+            repaired = await arepair(
+                lambda prompt, variant: self.llm_service.acall_openai_llm(
+                    self._repair_messages(user, prompt), variant=variant, json_mode=True
+                ),
+                requests
+            ) if requests else {}
+        return self._finish(user, drafts, repaired)
+    
+    def _drop_unusable(self, slots: List[ExerciseSlot], pending: List[int]) -> None:
+        """Log and count the slots still unusable after every attempt, raising ValueError if no slot is left"""
+        if not pending:
+            return
+        if len(pending) == len(slots):
+            raise ValueError(f"Could not generate any of {len(slots)} exercises after {BATCH_ATTEMPTS} attempts")
+        logging.warning(
+            f"Dropped {len(pending)} of {len(slots)} exercises still unusable after {BATCH_ATTEMPTS} attempts: "
+            + ", ".join(f"{slots[index].type.value} about {slots[index].topic}" for index in pending)
         )
+        self.llm_service.metrics.record_dropped(len(pending))
+    
+    def _generate_batch(self, user: User, partner: User, slots: List[ExerciseSlot]) -> Dict[int, Exercise]:
+        """Generate several exercises in one LLM call, returning them by slot position.
+
+        Exercises that come back unusable are requested again; invalid items
+        of the others are repaired on their own afterwards. Slots still
+        unusable after BATCH_ATTEMPTS calls are left out. Generation skips
+        the response cache, as every request must get new exercises; repairs
+        of the same items are cached.
+        """
+        drafts: Dict[int, ExerciseDraft] = {}
+        pending = list(range(len(slots)))
+        for _ in range(BATCH_ATTEMPTS):
+            subset = [slots[index] for index in pending]
+            with llm_call_context(site="exercise_batch"):
+                response = self.llm_service.call_openai_llm(
+                    self._batch_messages(user, partner, subset), use_cache=False, json_mode=True
+                )
+            for position, draft in self._parse_batch(subset, response).items():
+                drafts[pending[position]] = draft
+            pending = [index for index in pending if index not in drafts]
+            if not pending:
+                break
+        with llm_call_context(site="exercise_batch"):
+            self._drop_unusable(slots, pending)
+        return self._complete(user, drafts)
+    
+    async def _agenerate_batch(self, user: User, partner: User, slots: List[ExerciseSlot]) -> Dict[int, Exercise]:
+        """Async variant of _generate_batch"""
+        drafts: Dict[int, ExerciseDraft] = {}
+        pending = list(range(len(slots)))
+        for _ in range(BATCH_ATTEMPTS):
+            subset = [slots[index] for index in pending]
+            with llm_call_context(site="exercise_batch"):
+                response = await self.llm_service.acall_openai_llm(
+                    self._batch_messages(user, partner, subset), use_cache=False, json_mode=True
+                )
+            for position, draft in self._parse_batch(subset, response).items():
+                drafts[pending[position]] = draft
+            pending = [index for index in pending if index not in drafts]
+            if not pending:
+                break
+        with llm_call_context(site="exercise_batch"):
+            self._drop_unusable(slots, pending)
+        return await self._acomplete(user, drafts)
+    
+    def _generate_slots(self, user: User, partner: User, slots: List[ExerciseSlot],
+                        from_pool: bool = True) -> Dict[int, Exercise]:
+        """Get the exercises of the given slots by position; slots that could not be generated are left out.
+
+        With ``from_pool``, slots whose pool is saturated get a stored exercise;
+        the others are generated.
+        """
+        pooled = self._pooled_exercises(user, slots) if from_pool else {}
+        pending = [index for index in range(len(slots)) if index not in pooled]
+        generated = self._generate_new(user, partner, [slots[index] for index in pending]) if pending else {}
+        return self._merge_slots(pooled, pending, generated)
+    
+    @staticmethod
+    def _merge_slots(pooled: Dict[int, Exercise], pending: List[int],
+                     generated: Dict[int, Exercise]) -> Dict[int, Exercise]:
+        """Pooled exercises and those generated for the ``pending`` slot positions, in slot order"""
+        exercises = {**pooled, **{pending[position]: exercise for position, exercise in generated.items()}}
+        return dict(sorted(exercises.items()))
+    
+    def _generate_new(self, user: User, partner: User, slots: List[ExerciseSlot]) -> Dict[int, Exercise]:
+        """Generate the exercises of the given slots by position, batched or with one call each"""
+        with llm_call_context(user=user.id, language=user.target_language):
+            if BATCH_GENERATION:
+                return self._generate_batch(user, partner, slots)
+            drafts = {}
+            for index, slot in enumerate(slots):
+                with llm_call_context(site=slot.type):
+                    response = self.llm_service.call_openai_llm(
+                        self._slot_messages(user, partner, slot), use_cache=False, json_mode=True
+                    )
+                drafts[index] = self._slot_draft(slot, response)
+            return self._complete(user, drafts)
+    
+    async def _agenerate_slot(self, user: User, partner: User, slot: ExerciseSlot) -> ExerciseDraft:
+        with llm_call_context(site=slot.type):
+            response = await self.llm_service.acall_openai_llm(
+                self._slot_messages(user, partner, slot), use_cache=False, json_mode=True
+            )
+        return self._slot_draft(slot, response)
+    
+    async def _agenerate_slots(self, user: User, partner: User, slots: List[ExerciseSlot],
+                               from_pool: bool = True) -> Dict[int, Exercise]:
+        """Async variant of _generate_slots"""
+        pooled = await asyncio.to_thread(self._pooled_exercises, user, slots) if from_pool else {}
+        pending = [index for index in range(len(slots)) if index not in pooled]
+        generated = await self._agenerate_new(user, partner, [slots[index] for index in pending]) if pending else {}
+        return self._merge_slots(pooled, pending, generated)
+    
+    async def _agenerate_new(self, user: User, partner: User, slots: List[ExerciseSlot]) -> Dict[int, Exercise]:
+        """Async variant of _generate_new; unbatched calls run concurrently"""
+        with llm_call_context(user=user.id, language=user.target_language):
+            if BATCH_GENERATION:
+                return await self._agenerate_batch(user, partner, slots)
+            drafts = await gather_limited([self._agenerate_slot(user, partner, slot) for slot in slots])
+            return await self._acomplete(user, dict(enumerate(drafts)))
     
     def generate_exercises(self, user: User, partner: User, count: int = 3) -> List[Exercise]:
-        """Generate a set of exercises for a user"""
-        exercises = []
-        
-        # Generate one of each type
-        topics = ["travel", "food", "daily life", "hobbies", "culture"]
-        
-        # Flashcards
-        flashcard_ex = self._generate_flashcard_exercise(user, topics[0])
-        self.storage.save_item("exercises", flashcard_ex)
-        exercises.append(flashcard_ex)
+        """Generate a set of ``count`` exercises of mixed types for a user"""
+        exercises = list(self._generate_slots(user, partner, self._exercise_plan(user, partner, count)).values())
         
-        # Quiz
-        quiz_ex = self._generate_quiz_exercise(user, topics[1])
-        self.storage.save_item("exercises", quiz_ex)
-        exercises.append(quiz_ex)
-        
-        # Conversation
-        conv_ex = self._generate_conversation_exercise(user, partner)
-        self.storage.save_item("exercises", conv_ex)
-        exercises.append(conv_ex)
+        # Store all generated exercises with a single write
+        self.storage.save_items("exercises", exercises)
+        return exercises
+    
+    async def agenerate_exercises(self, user: User, partner: User, count: int = 3) -> List[Exercise]:
+        """Generate a set of ``count`` exercises for a user without blocking the event loop"""
+        exercises = list((await self._agenerate_slots(user, partner, self._exercise_plan(user, partner, count))).values())
         
+        # Store all generated exercises with a single write, off the event loop
+        await asyncio.to_thread(self.storage.save_items, "exercises", exercises)
         return exercises
     
+    async def _astream_exercise(self, index: int, user: User, partner: User,
+                                slot: ExerciseSlot) -> AsyncIterator[Tuple[str, Any]]:
+        """Stream one exercise: its response text as it is generated, then the stored exercise"""
+        parts = []
+        # The labels are taken when the stream is created; a generator cannot hold a context across its yields
+        with llm_call_context(site=slot.type, user=user.id, language=user.target_language):
+            deltas = self.llm_service.astream_openai_llm(
+                self._slot_messages(user, partner, slot), use_cache=False, json_mode=True
+            )
+        async for delta in deltas:
+            parts.append(delta)
+            yield "delta", {"index": index, "text": delta}
+        with llm_call_context(user=user.id, language=user.target_language):
+            exercise, = (await self._acomplete(user, {index: self._slot_draft(slot, "".join(parts))})).values()
+        await asyncio.to_thread(self.storage.save_item, "exercises", exercise)
+        yield "exercise", exercise
+    
+    async def astream_exercises(self, user: User, partner: User, count: int = 3) -> AsyncIterator[Tuple[str, Any]]:
+        """Generate a set of exercises, yielding ("delta", chunk) events and each ("exercise", exercise) once stored.
+
+        Every exercise is its own call here, so each one can be sent as soon
+        as it is ready.
+        """
+        slots = self._exercise_plan(user, partner, count)
+        pooled = await asyncio.to_thread(self._pooled_exercises, user, slots)
+        for exercise in pooled.values():
+            yield "exercise", exercise
+        streams = [
+            self._astream_exercise(index, user, partner, slot)
+            for index, slot in enumerate(slots) if index not in pooled
+        ]
+        async for _, event in merge_limited(streams):
+            yield event
+    
     def update_exercise_status(self, exercise_id: str, status: ExerciseStatus) -> Exercise:
         """Update the status of an exercise"""
         exercise = self.get_exercise(exercise_id)
@@ -0,0 +1,245 @@
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+from .llm_providers import Completion, estimate_tokens, LLMProvider, Messages
+
+_WORDS = (
+    "bonjour merci maison chat livre ville marché voyage musique soleil jardin ami famille cuisine "
+    "fromage train plage montagne fête chanson théâtre café rue école travail temps histoire"
+).split()
+
+_BATCH_SLOT = re.compile(r"^\s*(\d+)\. (\w+), topic: (.+)$", re.M)
+_REPAIR_REF = re.compile(r'- ref "([^"]+)"')
+_FIELD = re.compile(r'"(\w+)" \(([^,)]+)(, optional)?\)')
+
+
+class FakeProviderError(Exception):
+    """An injected provider failure, with the HTTP status the scheduler reacts to"""
+
+    def __init__(self, provider: str, status_code: int):
+        super().__init__(f"Injected {provider} error {status_code}")
+        self.status_code = status_code
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """Parse a latency distribution in seconds.
+
+    ``0.5`` is a fixed latency, ``uniform:LOW:HIGH`` a uniform one,
+    ``lognormal:MEDIAN:SIGMA`` a long-tailed one and ``exponential:MEAN``
+    a memoryless one.
+    """
+    kind, _, rest = spec.partition(":")
+    args = [float(value) for value in rest.split(":")] if rest else []
+    if not rest:
+        fixed = float(kind)
+        return lambda rng: fixed
+    if kind == "uniform":
+        return lambda rng: rng.uniform(args[0], args[1])
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(math.log(args[0]), args[1])
+    if kind == "exponential":
+        return lambda rng: rng.expovariate(1 / args[0])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class FakeProvider(LLMProvider):
+    """A local stand-in for an LLM API, for development and load tests.
+
+    Answers every prompt of the app with schema-valid JSON (or text for
+    chat) built from a seeded random generator, so runs are reproducible.
+    Each call takes a latency drawn from ``latency`` plus
+    ``completion_tokens / tokens_per_second``; a share ``error_rate`` of
+    calls fail with 429, 500 or 503 and a share ``invalid_rate`` of JSON
+    answers come back with one invalid item. With ``completion_tokens`` set,
+    answers are padded to about that many tokens.
+    """
+
+    def __init__(self, name: str, latency: str = "lognormal:0.8:0.5", error_rate: float = 0.0,
+                 invalid_rate: float = 0.0, completion_tokens: Optional[int] = None,
+                 tokens_per_second: float = 0.0, seed: Optional[int] = None):
+        self.name = name
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.invalid_rate = invalid_rate
+        self.completion_tokens = completion_tokens
+        self.tokens_per_second = tokens_per_second
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    # Answers
+
+    def _words(self, count: int) -> str:
+        return " ".join(self._random.choice(_WORDS) for _ in range(count))
+
+    def _flashcard(self, topic: str) -> Dict[str, Any]:
+        return {"term": self._words(1), "definition": f"a word about {topic}", "example": self._words(6)}
+
+    def _question(self, topic: str) -> Dict[str, Any]:
+        return {
+            "question": f"Which word is about {topic}?",
+            "options": [self._words(1) for _ in range(4)],
+            "correct_answer": self._random.randrange(4),
+            "explanation": self._words(8),
+        }
+
+    def _prompt(self, topic: str) -> Dict[str, Any]:
+        return {
+            "prompt": f"Talk about {topic}: {self._words(5)}?",
+            "context": self._words(12),
+            "suggested_vocabulary": [self._words(1) for _ in range(5)],
+        }
+
+    def _exercise_items(self, exercise_type: str, topic: str) -> List[Dict[str, Any]]:
+        if exercise_type == "quiz":
+            return [self._question(topic) for _ in range(5)]
+        if exercise_type == "conversation":
+            return [self._prompt(topic) for _ in range(3)]
+        return [self._flashcard(topic) for _ in range(5)]
+
+    def _field_value(self, kind: str) -> Any:
+        if kind == "integer":
+            return 0
+        if kind.startswith("array"):
+            return [self._words(1) for _ in range(4)]
+        return self._words(4)
+
+    def _repair(self, prompt: str) -> Dict[str, Any]:
+        """Answer a structured_output repair prompt with every required field of each ref"""
+        items = []
+        for line in prompt.splitlines():
+            ref = _REPAIR_REF.match(line)
+            if ref:
+                items.append({"ref": ref.group(1)})
+            # Each ref lists the item fields on its own line or the next one
+            if items and "fields: " in line:
+                for name, kind, optional in _FIELD.findall(line.rsplit("fields: ", 1)[1]):
+                    if not optional:
+                        items[-1][name] = self._field_value(kind)
+        return {"items": items}
+
+    def _json_answer(self, prompt: str) -> Optional[Dict[str, Any]]:
+        """The JSON answer to one of the app's generation prompts, None for free text"""
+        if "previous answer were invalid" in prompt:
+            return self._repair(prompt)
+        if '"exercises"' in prompt:
+            return {"exercises": [
+                {"index": int(index), "type": exercise_type, "title": f"{exercise_type.capitalize()}: {topic}",
+                 "items": self._exercise_items(exercise_type, topic)}
+                for index, exercise_type, topic in _BATCH_SLOT.findall(prompt)
+            ]}
+        topic = re.search(r"(?:Topic|Topic of shared interest): (.+)", prompt)
+        topic = topic.group(1).strip() if topic else "daily life"
+        if '"questions"' in prompt:
+            return {"title": f"Quiz: {topic}", "questions": self._exercise_items("quiz", topic)}
+        if '"prompts"' in prompt:
+            return {"title": f"Conversation: {topic}", "prompts": self._exercise_items("conversation", topic)}
+        if '"items"' in prompt:
+            return {"title": f"Flashcards: {topic}", "items": self._exercise_items("flashcard", topic)}
+        if '"related_vocabulary"' in prompt:
+            return {
+                "title": self._words(3).capitalize(),
+                "content": self._words(220),
+                "related_vocabulary": [self._words(1) for _ in range(5)],
+            }
+        if '"original_phrase"' in prompt:
+            return {
+                "original_phrase": self._words(4),
+                "literal_translation": self._words(4),
+                "meaning": self._words(6),
+                "example_usage": self._words(10),
+                "equivalent_idioms": [{"language": "english", "phrase": self._words(4)}],
+            }
+        if '"title"' in prompt and '"content"' in prompt:
+            return {"title": self._words(3).capitalize(), "content": self._words(120)}
+        return None
+
+    def _damage(self, data: Dict[str, Any]) -> None:
+        """Blank the first item of an answer, or drop a required field of a single item"""
+        if data.get("exercises"):
+            data = data["exercises"][0]
+        for key in ("items", "questions", "prompts"):
+            if data.get(key):
+                data[key][0] = {}
+                return
+        data.pop("meaning" if "meaning" in data else "content", None)
+
+    def _answer(self, messages: Messages, json_mode: bool) -> str:
+        prompt = messages[-1]["content"]
+        with self._lock:
+            data = self._json_answer(prompt)
+            if data is None and json_mode:
+                data = {"text": self._words(40)}
+            repair = "previous answer were invalid" in prompt
+            if data is not None and not repair and self._random.random() < self.invalid_rate:
+                self._damage(data)
+            if data is None:
+                text = "summary: " + self._words(60) if "summarizing" in prompt else self._words(40)
+            else:
+                text = json.dumps(data, ensure_ascii=False)
+            if self.completion_tokens and estimate_tokens(text) < self.completion_tokens:
+                padding = self._words(self.completion_tokens - estimate_tokens(text))
+                if data is not None:
+                    data["notes"] = padding
+                    text = json.dumps(data, ensure_ascii=False)
+                else:
+                    text = f"{text} {padding}"
+        return text
+
+    # Calls
+
+    def _plan(self, messages: Messages, json_mode: bool) -> Tuple[float, Optional[int], Completion]:
+        """Draw the latency and outcome of a call: (seconds, injected error status, completion)"""
+        with self._lock:
+            latency = self.latency(self._random)
+            error = self._random.choice((429, 500, 503)) if self._random.random() < self.error_rate else None
+        text = self._answer(messages, json_mode)
+        completion = Completion(text, sum(estimate_tokens(str(m["content"])) for m in messages), estimate_tokens(text))
+        if self.tokens_per_second:
+            latency += completion.completion_tokens / self.tokens_per_second
+        return latency, error, completion
+
+    def complete(self, messages: Messages, model: str, json_mode: bool = False) -> Completion:
+        latency, error, completion = self._plan(messages, json_mode)
+        time.sleep(latency)
+        if error is not None:
+            raise FakeProviderError(self.name, error)
+        return completion
+
+    async def acomplete(self, messages: Messages, model: str, json_mode: bool = False) -> Completion:
+        latency, error, completion = self._plan(messages, json_mode)
+        await asyncio.sleep(latency)
+        if error is not None:
+            raise FakeProviderError(self.name, error)
+        return completion
+
+    async def astream(self, messages: Messages, model: str, json_mode: bool = False) -> AsyncIterator[str]:
+        latency, error, completion = self._plan(messages, json_mode)
+        chunks = [completion.text[i:i + 40] for i in range(0, len(completion.text), 40)]
+        if error is not None:
+            await asyncio.sleep(latency)
+            raise FakeProviderError(self.name, error)
+        for chunk in chunks:
+            await asyncio.sleep(latency / len(chunks))
+            yield chunk
+
+
+def create_fake_provider(name: str) -> FakeProvider:
+    """Create a fake provider configured by the FAKE_LLM_* environment variables"""
+    completion_tokens = os.environ.get("FAKE_LLM_COMPLETION_TOKENS")
+    seed = os.environ.get("FAKE_LLM_SEED")
+    return FakeProvider(
+        name,
+        latency=os.environ.get("FAKE_LLM_LATENCY", "lognormal:0.8:0.5"),
+        error_rate=float(os.environ.get("FAKE_LLM_ERROR_RATE", 0)),
+        invalid_rate=float(os.environ.get("FAKE_LLM_INVALID_RATE", 0)),
+        completion_tokens=int(completion_tokens) if completion_tokens else None,
+        tokens_per_second=float(os.environ.get("FAKE_LLM_TOKENS_PER_SECOND", 0)),
+        # Each provider draws its own sequence from the seed
+        seed=int(seed) + sum(map(ord, name)) if seed else None,
+    )
@@ -0,0 +1,62 @@
+import os
+import threading
+from contextlib import contextmanager, ExitStack
+from typing import IO, Dict, Iterable, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: only threads of this process are serialized
+    fcntl = None
+
+_thread_locks: Dict[str, threading.Lock] = {}
+_thread_locks_guard = threading.Lock()
+
+
+def _thread_lock(path: str) -> threading.Lock:
+    with _thread_locks_guard:
+        lock = _thread_locks.get(path)
+        if lock is None:
+            lock = _thread_locks[path] = threading.Lock()
+        return lock
+
+
+@contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    """Hold an exclusive advisory lock on ``path`` across threads and processes"""
+    path = os.path.abspath(path)
+    with _thread_lock(path):
+        if fcntl is None:
+            yield
+            return
+        with open(path, 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def file_locks(paths: Iterable[str]) -> Iterator[None]:
+    """Lock several paths, always in the same order to avoid deadlocks"""
+    with ExitStack() as stack:
+        for path in sorted(set(os.path.abspath(p) for p in paths)):
+            stack.enter_context(file_lock(path))
+        yield
+
+
+def try_hold_lock(path: str) -> Optional[IO]:
+    """Take an exclusive advisory lock on ``path`` without waiting.
+
+    Returns the open file holding the lock, which is released when the file
+    is closed or the process exits, or None if the lock is held elsewhere.
+    """
+    f = open(os.path.abspath(path), 'a')
+    if fcntl is None:
+        return f
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
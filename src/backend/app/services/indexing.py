@@ -0,0 +1,142 @@
+import heapq
+import threading
+from bisect import bisect_right
+from enum import Enum
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Type
+from pydantic import BaseModel
+
+
+def indexed_fields(model_class: Type[BaseModel]) -> Tuple[str, ...]:
+    """Get the fields a model declares as indexed through ``Config.indexes``"""
+    return tuple(getattr(model_class.__config__, "indexes", ()))
+
+
+def normalize_value(value: Any) -> Any:
+    """Normalize a field value so enums and their stored strings compare equal"""
+    if isinstance(value, Enum):
+        return value.value
+    return value
+
+
+def normalize_where(where: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    return {field: normalize_value(value) for field, value in (where or {}).items()}
+
+
+def matches(doc: Dict[str, Any], where: Dict[str, Any]) -> bool:
+    """Check a raw document against normalized equality conditions"""
+    for field, value in where.items():
+        if normalize_value(doc.get(field)) != value:
+            return False
+    return True
+
+
+def sort_key(field: str):
+    """Get a sort key for raw documents that puts missing values last"""
+    def key(doc: Dict[str, Any]):
+        value = normalize_value(doc.get(field))
+        return (value is None, value)
+    return key
+
+
+class CollectionIndexes:
+    """Secondary hash indexes (field -> value -> ids) over one collection.
+
+    Indexes are built lazily from a collection dict the first time a field is
+    queried and are then kept up to date by the writer through add() and
+    remove(). Lookups only return candidate ids; callers re-check candidates
+    against their own snapshot of the collection, so a reader holding an older
+    snapshot never sees a record that does not match.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._fields: Dict[str, Dict[Any, Set[str]]] = {}
+
+    def ensure(self, fields: Iterable[str], data: Dict[str, Dict[str, Any]]) -> None:
+        """Build indexes for the given fields if they do not exist yet"""
+        with self.lock:
+            for field in fields:
+                if field in self._fields:
+                    continue
+                index: Dict[Any, Set[str]] = {}
+                for item_id, doc in data.items():
+                    index.setdefault(normalize_value(doc.get(field)), set()).add(item_id)
+                self._fields[field] = index
+
+    def add(self, item_id: str, doc: Dict[str, Any]) -> None:
+        with self.lock:
+            for field, index in self._fields.items():
+                index.setdefault(normalize_value(doc.get(field)), set()).add(item_id)
+
+    def remove(self, item_id: str, doc: Dict[str, Any]) -> None:
+        with self.lock:
+            for field, index in self._fields.items():
+                value = normalize_value(doc.get(field))
+                ids = index.get(value)
+                if ids is not None:
+                    ids.discard(item_id)
+                    if not ids:
+                        del index[value]
+
+    def candidates(self, where: Dict[str, Any]) -> Optional[Set[str]]:
+        """Get the ids matching all indexed conditions, or None if no condition is indexed"""
+        with self.lock:
+            buckets = [
+                self._fields[field].get(value, set())
+                for field, value in where.items()
+                if field in self._fields
+            ]
+            if not buckets:
+                return None
+            buckets.sort(key=len)
+            result = set(buckets[0])
+            for bucket in buckets[1:]:
+                result &= bucket
+            return result
+
+
+def select_documents(data: Dict[str, Dict[str, Any]], where: Dict[str, Any],
+                     indexes: Optional[CollectionIndexes] = None) -> List[Dict[str, Any]]:
+    """Select the raw documents matching normalized equality conditions"""
+    if not where:
+        return list(data.values())
+
+    candidate_ids = indexes.candidates(where) if indexes is not None else None
+    if candidate_ids is None:
+        return [doc for doc in data.values() if matches(doc, where)]
+
+    selected = []
+    for item_id in sorted(candidate_ids):
+        doc = data.get(item_id)
+        if doc is not None and matches(doc, where):
+            selected.append(doc)
+    return selected
+
+
+def page_documents(data: Dict[str, Dict[str, Any]], sorted_ids: List[str], where: Dict[str, Any],
+                   limit: int, after: Optional[str],
+                   indexes: Optional[CollectionIndexes] = None) -> List[Dict[str, Any]]:
+    """Select up to ``limit`` matching documents ordered by id, after the id ``after``.
+
+    ``sorted_ids`` are the ids of ``data`` in order. The page starts where
+    ``after`` bisects into them and stops once it is full, so reading a
+    collection page by page costs one pass overall. Indexed conditions only
+    look at their candidates.
+    """
+    candidate_ids = indexes.candidates(where) if where and indexes is not None else None
+    if candidate_ids is not None:
+        selected = (
+            item_id for item_id in candidate_ids
+            if (after is None or item_id > after) and item_id in data and matches(data[item_id], where)
+        )
+        return [data[item_id] for item_id in heapq.nsmallest(limit, selected)]
+
+    page = []
+    start = bisect_right(sorted_ids, after) if after is not None else 0
+    for index in range(start, len(sorted_ids)):
+        doc = data[sorted_ids[index]]
+        if matches(doc, where):
+            page.append(doc)
+            if len(page) == limit:
+                break
+    return page
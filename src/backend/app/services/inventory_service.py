@@ -0,0 +1,383 @@
+import asyncio
+import os
+import threading
+import time
+import logging
+from collections import Counter
+from datetime import datetime
+from typing import IO, Any, Dict, List, NamedTuple, Optional, Tuple, Union
+from .storage_service import StorageService, VersionConflictError
+from .content_index import ContentIndex
+from .exercise_service import BATCH_GENERATION, ExerciseService, ExerciseSlot
+from .file_lock import try_hold_lock
+from ..models.exercise import Exercise, ExerciseType
+from ..models.inventory import RequestedBucket, StockedExercise
+from ..models.user import User, Language, ProficiencyLevel
+
+INVENTORY_COLLECTION = "exercise_inventory"
+# Buckets learners asked for, so the refilling process knows them whichever process served the request
+REQUESTED_BUCKETS_COLLECTION = "exercise_inventory_buckets"
+
+
+class InventoryBucket(NamedTuple):
+    """Exercises that can be handed to any learner with the same profile"""
+    language: Language
+    native_language: Language
+    proficiency_level: ProficiencyLevel
+    type: ExerciseType
+    topic: str
+
+    @property
+    def key(self) -> str:
+        return "|".join([
+            Language(self.language).value, Language(self.native_language).value,
+            ProficiencyLevel(self.proficiency_level).value, ExerciseType(self.type).value, self.topic,
+        ])
+
+    @property
+    def slot(self) -> ExerciseSlot:
+        return ExerciseSlot(self.type, self.topic)
+
+    @classmethod
+    def of(cls, stored: Union[StockedExercise, RequestedBucket]) -> "InventoryBucket":
+        return cls(stored.language, stored.native_language, stored.proficiency_level,
+                   stored.type, stored.topic)
+
+    def learners(self) -> Tuple[User, User]:
+        """Build a learner and a tandem partner matching the bucket for generating stock.
+
+        The partner is assumed to be the mirror of the learner: a native
+        speaker of the target language learning the learner's language.
+        """
+        user = User(
+            id="inventory", name="Inventory", native_language=self.native_language,
+            target_language=self.language, proficiency_level=self.proficiency_level,
+            interests=[self.topic],
+        )
+        partner = User(
+            id="inventory-partner", name="Inventory partner", native_language=self.language,
+            target_language=self.native_language, proficiency_level=self.proficiency_level,
+            interests=[self.topic],
+        )
+        return user, partner
+
+
+class RateBudget:
+    """Token bucket limiting how many LLM calls the refill worker may start"""
+
+    def __init__(self, per_minute: float, burst: Optional[int] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = float(burst if burst is not None else max(1, int(per_minute)))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        """Take one call from the budget if there is one left"""
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def available(self) -> float:
+        with self._lock:
+            self._refill()
+            return self.tokens
+
+
+class _BucketState:
+    __slots__ = ("bucket", "refilling", "below_since", "last_refill", "refills", "failures", "last_error")
+
+    def __init__(self, bucket: InventoryBucket):
+        self.bucket = bucket
+        self.refilling = False
+        self.below_since: Optional[float] = None
+        self.last_refill: Optional[float] = None
+        self.refills = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+
+
+class InventoryService:
+    """Keeps a stock of ready-made exercises so generate requests need no LLM call.
+
+    Stock lives in the ``exercise_inventory`` collection, one bucket per
+    (language, native language, level, type, topic). Serving an exercise moves
+    it into the ``exercises`` collection. A background worker tops up every
+    bucket that has been asked for once it falls below ``low_water``, back to
+    ``target_stock``, spending at most the LLM calls its rate budget allows.
+
+    Every server process runs the worker, but only the one holding the
+    refill lock file refills, so the budget holds for the whole deployment
+    and processes do not overfill the buckets they share. The others take
+    over if it exits.
+    """
+
+    def __init__(self, storage: StorageService, exercise_service: ExerciseService,
+                 target_stock: Optional[int] = None, low_water: Optional[int] = None,
+                 refill_per_minute: Optional[float] = None, interval: Optional[float] = None):
+        self.storage = storage
+        self.exercise_service = exercise_service
+        if target_stock is None:
+            target_stock = int(os.environ.get("INVENTORY_TARGET_STOCK", 5))
+        if low_water is None:
+            low_water = int(os.environ.get("INVENTORY_LOW_WATER", 2))
+        if refill_per_minute is None:
+            refill_per_minute = float(os.environ.get("INVENTORY_REFILL_PER_MINUTE", 30))
+        if interval is None:
+            interval = float(os.environ.get("INVENTORY_REFILL_INTERVAL", 5))
+        self.target_stock = target_stock
+        self.low_water = low_water
+        self.interval = interval
+        self.budget = RateBudget(refill_per_minute)
+        self._states: Dict[str, _BucketState] = {}
+        self._states_lock = threading.Lock()
+        self._wake: Optional[asyncio.Event] = None
+        self._started = False
+        self.lock_path = os.path.join(storage.storage_dir, f"{INVENTORY_COLLECTION}.refill.lock")
+        # Open while this process holds the refill lock
+        self._refill_lock: Optional[IO] = None
+
+    # Buckets
+
+    def bucket_for(self, user: User, slot: ExerciseSlot) -> InventoryBucket:
+        return InventoryBucket(user.target_language, user.native_language, user.proficiency_level,
+                               slot.type, slot.topic)
+
+    def _plan(self, user: User, partner: User, count: int) -> List[InventoryBucket]:
+        """Buckets of the exercise set handed out by one generate request"""
+        return [self.bucket_for(user, slot) for slot in self.exercise_service._exercise_plan(user, partner, count)]
+
+    def _state(self, bucket: InventoryBucket) -> _BucketState:
+        with self._states_lock:
+            state = self._states.get(bucket.key)
+            if state is None:
+                state = self._states[bucket.key] = _BucketState(bucket)
+            return state
+
+    # Stock
+
+    def stock_levels(self) -> Dict[str, int]:
+        """Count the stocked exercises of every bucket, registering buckets found in storage"""
+        levels: Counter = Counter()
+        for stocked in self.storage.find_items(INVENTORY_COLLECTION, StockedExercise):
+            levels[stocked.bucket] += 1
+            if stocked.bucket not in self._states:
+                self._state(InventoryBucket.of(stocked))
+        for requested in self.storage.find_items(REQUESTED_BUCKETS_COLLECTION, RequestedBucket):
+            if requested.id not in self._states:
+                self._state(InventoryBucket.of(requested))
+        return dict(levels)
+
+    def request_buckets(self, buckets: List[InventoryBucket]) -> None:
+        """Register buckets asked for, storing the ones new to this process for the refilling process"""
+        with self._states_lock:
+            new = {bucket.key: bucket for bucket in buckets if bucket.key not in self._states}
+        for bucket in buckets:
+            self._state(bucket)
+        if new:
+            self.storage.save_items(REQUESTED_BUCKETS_COLLECTION, [
+                RequestedBucket(
+                    id=key, language=bucket.language, native_language=bucket.native_language,
+                    proficiency_level=bucket.proficiency_level, type=bucket.type, topic=bucket.topic,
+                    requested_at=datetime.now(),
+                )
+                for key, bucket in new.items()
+            ])
+
+    def take(self, bucket: InventoryBucket) -> Optional[Exercise]:
+        """Move the oldest stocked exercise of a bucket into the exercises collection.
+
+        Saving it with expected version 0 makes the move a compare-and-swap:
+        if a concurrent request already took the same exercise, the next one
+        is tried instead.
+        """
+        stock = self.storage.find_items(
+            INVENTORY_COLLECTION, StockedExercise, where={"bucket": bucket.key}, sort_by="created_at"
+        )
+        for stocked in stock:
+            try:
+                with self.storage.batch():
+                    self.storage.save_item("exercises", stocked.exercise, expected_version=0)
+                    self.storage.delete_item(INVENTORY_COLLECTION, stocked.id)
+            except VersionConflictError:
+                continue
+            return stocked.exercise
+        return None
+
+    def stock(self, bucket: InventoryBucket, exercise: Exercise) -> None:
+        """Add a generated exercise to a bucket"""
+        self.storage.save_item(INVENTORY_COLLECTION, StockedExercise(
+            id=exercise.id,
+            bucket=bucket.key,
+            language=bucket.language,
+            native_language=bucket.native_language,
+            proficiency_level=bucket.proficiency_level,
+            type=bucket.type,
+            topic=bucket.topic,
+            exercise=exercise,
+            created_at=datetime.now(),
+        ))
+
+    # Serving
+
+    async def serve_exercises(self, user: User, partner: User, count: int = 3) -> List[Exercise]:
+        """Hand out a set of ``count`` exercises from stock, generating only what is out of stock"""
+        plan = self._plan(user, partner, count)
+        await asyncio.to_thread(self.request_buckets, plan)
+        exercises: List[Optional[Exercise]] = [
+            await asyncio.to_thread(self.take, bucket) for bucket in plan
+        ]
+
+        missing = [index for index, exercise in enumerate(exercises) if exercise is None]
+        if missing:
+            generated = await self.exercise_service._agenerate_slots(
+                user, partner, [plan[index].slot for index in missing]
+            )
+            await asyncio.to_thread(self.storage.save_items, "exercises", list(generated.values()))
+            for position, exercise in generated.items():
+                exercises[missing[position]] = exercise
+            logging.info(f"Inventory missed {len(missing)} of {len(plan)} exercises for {user.id}")
+
+        self.wake()
+        # Slots that could not be generated are left out
+        return [exercise for exercise in exercises if exercise is not None]
+
+    # Refill worker
+
+    def wake(self) -> None:
+        """Make the refill worker check stock levels now"""
+        if self._wake is not None:
+            self._wake.set()
+
+    async def refill_once(self) -> int:
+        """Top up buckets below their low-water mark; returns the number of exercises stocked"""
+        levels = await asyncio.to_thread(self.stock_levels)
+        now = time.time()
+        with self._states_lock:
+            states = list(self._states.values())
+        # Emptiest buckets first
+        states.sort(key=lambda state: levels.get(state.bucket.key, 0))
+
+        stocked = 0
+        for state in states:
+            level = levels.get(state.bucket.key, 0)
+            if level < self.low_water:
+                state.refilling = True
+                if state.below_since is None:
+                    state.below_since = now
+            if not state.refilling:
+                continue
+
+            user, partner = state.bucket.learners()
+            if self.exercise_service._pool_saturated(user, state.bucket.slot):
+                # New exercises would mostly repeat stored ones; requests are served from the pool meanwhile
+                state.refilling = False
+                state.below_since = None
+                continue
+            while level < self.target_stock:
+                if not self.budget.try_acquire():
+                    return stocked
+                # With batched generation one call fills the whole gap
+                needed = self.target_stock - level if BATCH_GENERATION else 1
+                try:
+                    exercises = list((await self.exercise_service._agenerate_slots(
+                        user, partner, [state.bucket.slot] * needed, from_pool=False
+                    )).values())
+                    for exercise in exercises:
+                        await asyncio.to_thread(self.stock, state.bucket, exercise)
+                except Exception as e:
+                    state.failures += 1
+                    state.last_error = str(e)
+                    logging.error(f"Error refilling inventory bucket {state.bucket.key}: {str(e)}")
+                    break
+                level += len(exercises)
+                stocked += len(exercises)
+                state.refills += len(exercises)
+                state.last_refill = time.time()
+
+            if level >= self.target_stock:
+                state.refilling = False
+                state.below_since = None
+        return stocked
+
+    def _hold_refill_lock(self) -> bool:
+        """Whether this process is the one that refills, taking the refill lock if it is free"""
+        if self._refill_lock is None:
+            self._refill_lock = try_hold_lock(self.lock_path)
+            if self._refill_lock is not None:
+                logging.info("This process refills the exercise inventory")
+        return self._refill_lock is not None
+
+    async def run_refill_worker(self) -> None:
+        """Refill buckets until cancelled, every ``interval`` seconds or when woken.
+
+        Until this process holds the refill lock the worker only tries to
+        take it, once per interval.
+        """
+        self._wake = asyncio.Event()
+        self._started = True
+        logging.info("Inventory refill worker started")
+        try:
+            while True:
+                try:
+                    if await asyncio.to_thread(self._hold_refill_lock):
+                        await self.refill_once()
+                except Exception as e:
+                    logging.error(f"Error in inventory refill worker: {str(e)}")
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+        finally:
+            if self._refill_lock is not None:
+                self._refill_lock.close()
+                self._refill_lock = None
+
+    def status(self) -> Dict[str, Any]:
+        """Stock levels and refill lag of every bucket"""
+        levels = self.stock_levels()
+        now = time.time()
+        with self._states_lock:
+            states = sorted(self._states.values(), key=lambda state: state.bucket.key)
+        return {
+            "worker_running": self._started,
+            "refilling_process": self._refill_lock is not None,
+            "target_stock": self.target_stock,
+            "low_water": self.low_water,
+            "budget_available": round(self.budget.available(), 2),
+            "budget_per_minute": self.budget.rate * 60,
+            "buckets": [
+                {
+                    "bucket": state.bucket.key,
+                    "stock": levels.get(state.bucket.key, 0),
+                    "refilling": state.refilling,
+                    # Seconds the bucket has been waiting for a refill to complete
+                    "refill_lag": round(now - state.below_since, 1) if state.below_since else 0.0,
+                    "last_refill": datetime.fromtimestamp(state.last_refill) if state.last_refill else None,
+                    "refills": state.refills,
+                    "failures": state.failures,
+                    "last_error": state.last_error,
+                }
+                for state in states
+            ],
+        }
+
+
+def create_inventory_service(storage: StorageService, llm_service,
+                             content_index: Optional[ContentIndex] = None) -> Optional[InventoryService]:
+    """Create the exercise inventory configured by the INVENTORY_* environment variables.
+
+    It is off unless INVENTORY_ENABLED is set, as refilling spends LLM calls in the background.
+    """
+    if os.environ.get("INVENTORY_ENABLED", "0").lower() in ("0", "false", "no"):
+        return None
+    return InventoryService(storage, ExerciseService(storage, llm_service, content_index))
@@ -0,0 +1,377 @@
+import asyncio
+import itertools
+import os
+import time
+import uuid
+import logging
+from datetime import datetime
+from enum import Enum
+from typing import IO, Any, Awaitable, Callable, Dict, List, Optional
+from pydantic import BaseModel
+from .file_lock import try_hold_lock
+from .storage_service import StorageService, VersionConflictError
+from .llm_service import LLMService
+from .content_index import ContentIndex
+from .exercise_service import ExerciseService
+from .cultural_service import CulturalService
+from .inventory_service import InventoryService
+from ..models.job import Job, JobKind, JobStatus
+from ..models.user import User, Language
+
+JOBS_COLLECTION = "jobs"
+# Seconds between sweeps of finished jobs past their retention out of storage
+STORED_PRUNE_INTERVAL = 60
+
+JobHandler = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+class JobLimitError(Exception):
+    """Raised when a job cannot be queued because a queue limit is reached"""
+
+
+def jsonable(value: Any) -> Any:
+    """Turn models and enums in a job result into plain JSON values"""
+    if isinstance(value, BaseModel):
+        return jsonable(value.dict())
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {key: jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [jsonable(item) for item in value]
+    return value
+
+
+class JobService:
+    """Runs generation jobs on a bounded pool of asyncio workers.
+
+    Jobs wait in a priority queue (higher ``priority`` first, then oldest
+    first) and each user may have at most ``max_per_user`` jobs queued or
+    running. With ``persist`` on, every state change is written to the
+    ``jobs`` collection and unfinished jobs are queued again after a restart;
+    otherwise jobs only live in memory. Finished jobs are forgotten after
+    ``retention`` seconds, in memory and in storage.
+
+    Every persisted job records the process that owns it. A process holds a
+    lock file for its lifetime, so on start it only takes over the jobs of
+    processes whose lock is free, that is which are gone; jobs of live
+    processes are left to them.
+    """
+
+    def __init__(self, storage: StorageService, workers: Optional[int] = None,
+                 max_per_user: Optional[int] = None, max_queued: Optional[int] = None,
+                 persist: Optional[bool] = None, retention: Optional[float] = None):
+        self.storage = storage
+        if workers is None:
+            workers = int(os.environ.get("JOBS_WORKERS", 4))
+        if max_per_user is None:
+            max_per_user = int(os.environ.get("JOBS_MAX_PER_USER", 3))
+        if max_queued is None:
+            max_queued = int(os.environ.get("JOBS_MAX_QUEUED", 100))
+        if persist is None:
+            persist = os.environ.get("JOBS_PERSIST", "0").lower() in ("1", "true", "yes")
+        if retention is None:
+            retention = float(os.environ.get("JOBS_RETENTION", 3600))
+        self.workers = workers
+        self.max_per_user = max_per_user
+        self.max_queued = max_queued
+        self.persist = persist
+        self.retention = retention
+        self._handlers: Dict[JobKind, JobHandler] = {}
+        self._jobs: Dict[str, Job] = {}
+        self._finished_at: Dict[str, float] = {}
+        self._running: Dict[str, asyncio.Task] = {}
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._sequence = itertools.count()
+        self._tasks: List[asyncio.Task] = []
+        self._pruned_at = 0.0
+        self.owner = uuid.uuid4().hex
+        # Open while this process runs, telling other processes its jobs are taken care of
+        self._owner_lock: Optional[IO] = None
+
+    def register(self, kind: JobKind, handler: JobHandler) -> None:
+        """Set the coroutine function that runs jobs of a kind"""
+        self._handlers[kind] = handler
+
+    # Lifecycle
+
+    def _owner_lock_path(self, owner: str) -> str:
+        return os.path.join(self.storage.storage_dir, f"{JOBS_COLLECTION}.{owner}.lock")
+
+    def _take_over_jobs(self) -> List[Job]:
+        """Claim the unfinished jobs of processes that are gone, oldest first.
+
+        A job is claimed by saving this process as its owner with a
+        compare-and-swap, so two processes starting together never both run it.
+        """
+        stored = sorted(self._stored_active(), key=lambda job: job.created_at)
+        # Lock files of gone owners, held while their jobs are claimed
+        gone: Dict[Optional[str], Optional[IO]] = {None: None}
+        alive = set()
+        claimed = []
+        try:
+            for job in stored:
+                if job.finished or job.owner in alive:
+                    continue
+                if job.owner not in gone:
+                    lock = try_hold_lock(self._owner_lock_path(job.owner))
+                    if lock is None:
+                        alive.add(job.owner)
+                        continue
+                    gone[job.owner] = lock
+                job, version = self.storage.get_item_with_version(JOBS_COLLECTION, job.id, Job)
+                if job is None or job.finished or job.owner not in gone:
+                    continue
+                job.status = JobStatus.QUEUED
+                job.started_at = None
+                job.owner = self.owner
+                try:
+                    self.storage.save_item(JOBS_COLLECTION, job, expected_version=version)
+                except VersionConflictError:
+                    continue
+                claimed.append(job)
+        finally:
+            for owner, lock in gone.items():
+                if lock is not None:
+                    os.remove(self._owner_lock_path(owner))
+                    lock.close()
+        return claimed
+
+    async def start(self) -> None:
+        """Start the workers, queuing again the unfinished jobs of processes that are gone"""
+        self._queue = asyncio.PriorityQueue()
+        if self.persist:
+            self._owner_lock = await asyncio.to_thread(try_hold_lock, self._owner_lock_path(self.owner))
+            resumed = await asyncio.to_thread(self._take_over_jobs)
+            for job in resumed:
+                self._jobs[job.id] = job
+                self._enqueue(job)
+            if resumed:
+                logging.info(f"Resumed {len(resumed)} queued jobs")
+            await self._prune()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logging.info(f"Started {self.workers} job workers")
+
+    async def stop(self) -> None:
+        """Stop the workers; running jobs are cancelled and, if persisted, resumed by the next process to start"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._owner_lock is not None:
+            os.remove(self._owner_lock_path(self.owner))
+            self._owner_lock.close()
+            self._owner_lock = None
+
+    # Queue
+
+    def _enqueue(self, job: Job) -> None:
+        self._queue.put_nowait((-job.priority, next(self._sequence), job.id))
+
+    def _active(self, user_id: Optional[str] = None) -> List[Job]:
+        return [
+            job for job in self._jobs.values()
+            if not job.finished and (user_id is None or job.user_id == user_id)
+        ]
+
+    async def _count_active(self, user_id: Optional[str] = None) -> int:
+        """Count queued and running jobs, across every process when persisted"""
+        if not self.persist:
+            return len(self._active(user_id))
+        stored = await asyncio.to_thread(self._stored_active, user_id)
+        return len(stored)
+
+    async def _save(self, job: Job) -> None:
+        if self.persist:
+            await asyncio.to_thread(self._store, job)
+
+    def _store(self, job: Job) -> None:
+        """Save a job with a compare-and-swap, unless another process already finished it.
+
+        A job cancelled through another process keeps its stored outcome, which
+        is copied onto ``job`` instead of being overwritten.
+        """
+        while True:
+            stored, version = self.storage.get_item_with_version(JOBS_COLLECTION, job.id, Job)
+            if stored is not None and stored.finished:
+                job.status = stored.status
+                job.result = stored.result
+                job.error = stored.error
+                job.finished_at = stored.finished_at
+                self._finished_at.setdefault(job.id, time.time())
+                return
+            try:
+                self.storage.save_item(JOBS_COLLECTION, job, expected_version=version)
+                return
+            except VersionConflictError:
+                continue
+
+    def _stored_active(self, user_id: Optional[str] = None) -> List[Job]:
+        """Read the queued and running jobs of every process from storage"""
+        where = {"user_id": user_id} if user_id is not None else {}
+        return [
+            job
+            for status in (JobStatus.QUEUED, JobStatus.RUNNING)
+            for job in self.storage.find_items(JOBS_COLLECTION, Job, where={**where, "status": status})
+        ]
+
+    def _prune_stored(self, cutoff: datetime) -> int:
+        """Delete the stored jobs that finished before ``cutoff``, returning how many"""
+        expired = [
+            job.id
+            for status in (JobStatus.SUCCEEDED, JobStatus.FAILED, JobStatus.CANCELLED)
+            for job in self.storage.find_items(JOBS_COLLECTION, Job, where={"status": status})
+            if job.finished_at is not None and job.finished_at < cutoff
+        ]
+        return self.storage.delete_items(JOBS_COLLECTION, expired) if expired else 0
+
+    async def _prune(self) -> None:
+        """Forget finished jobs past their retention, in memory and, at most once a minute, in storage"""
+        now = time.time()
+        cutoff = now - self.retention
+        for job_id, finished_at in list(self._finished_at.items()):
+            if finished_at < cutoff:
+                del self._finished_at[job_id]
+                self._jobs.pop(job_id, None)
+        if self.persist and now - self._pruned_at >= STORED_PRUNE_INTERVAL:
+            self._pruned_at = now
+            pruned = await asyncio.to_thread(self._prune_stored, datetime.fromtimestamp(cutoff))
+            if pruned:
+                logging.info(f"Deleted {pruned} finished jobs past their retention")
+
+    async def submit(self, kind: JobKind, params: Dict[str, Any], user_id: Optional[str] = None,
+                     priority: int = 0) -> Job:
+        """Queue a job, raising JobLimitError if the user or the queue is full"""
+        if kind not in self._handlers:
+            raise ValueError(f"No handler for {kind} jobs")
+        await self._prune()
+        if await self._count_active() >= self.max_queued:
+            raise JobLimitError("Too many queued jobs, try again later")
+        if user_id is not None and await self._count_active(user_id) >= self.max_per_user:
+            raise JobLimitError(f"User {user_id} already has {self.max_per_user} jobs queued or running")
+
+        job = Job(
+            id=f"job-{uuid.uuid4().hex[:8]}",
+            kind=kind,
+            user_id=user_id,
+            params=jsonable(params),
+            priority=priority,
+            created_at=datetime.now(),
+            owner=self.owner if self.persist else None,
+        )
+        self._jobs[job.id] = job
+        await self._save(job)
+        self._enqueue(job)
+        return job
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        """Get a job by ID"""
+        job = self._jobs.get(job_id)
+        if job is None and self.persist:
+            job = await asyncio.to_thread(self.storage.get_item, JOBS_COLLECTION, job_id, Job)
+        return job
+
+    def list_jobs(self, user_id: Optional[str] = None) -> List[Job]:
+        """List the jobs held in memory, newest first"""
+        jobs = [job for job in self._jobs.values() if user_id is None or job.user_id == user_id]
+        return sorted(jobs, key=lambda job: job.created_at, reverse=True)
+
+    async def cancel(self, job_id: str) -> Optional[Job]:
+        """Cancel a queued or running job; finished jobs are returned unchanged"""
+        job = await self.get(job_id)
+        if job is None or job.finished:
+            return job
+        task = self._running.get(job_id)
+        if task is not None:
+            task.cancel()
+        # A queued job stays in the queue and is skipped when a worker picks it up
+        await self._finish(job, JobStatus.CANCELLED)
+        return job
+
+    async def _finish(self, job: Job, status: JobStatus, result: Any = None,
+                      error: Optional[str] = None) -> None:
+        job.status = status
+        job.result = result
+        job.error = error
+        job.finished_at = datetime.now()
+        self._finished_at[job.id] = time.time()
+        await self._save(job)
+
+    # Workers
+
+    async def _worker(self) -> None:
+        while True:
+            _, _, job_id = await self._queue.get()
+            job = self._jobs.get(job_id)
+            if job is None or job.status != JobStatus.QUEUED:
+                continue
+            await self._run(job)
+
+    async def _run(self, job: Job) -> None:
+        job.status = JobStatus.RUNNING
+        job.started_at = datetime.now()
+        await self._save(job)
+        if job.finished:
+            # Cancelled through another process while it was queued
+            return
+
+        task = asyncio.create_task(self._handlers[job.kind](job.params))
+        self._running[job.id] = task
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            if job.status != JobStatus.CANCELLED:
+                # The worker itself is being stopped
+                raise
+            logging.info(f"Cancelled job {job.id}")
+            return
+        except Exception as e:
+            logging.error(f"Error running job {job.id}: {str(e)}")
+            await self._finish(job, JobStatus.FAILED, error=str(e))
+            return
+        finally:
+            self._running.pop(job.id, None)
+
+        if job.status == JobStatus.RUNNING:
+            # Saving keeps a cancellation made meanwhile through another process
+            await self._finish(job, JobStatus.SUCCEEDED, result=jsonable(result))
+
+    def stats(self) -> Dict[str, Any]:
+        """Count jobs by status"""
+        counts: Dict[str, int] = {status.value: 0 for status in JobStatus}
+        for job in self._jobs.values():
+            counts[job.status.value] += 1
+        return {
+            "workers": self.workers,
+            "queue_size": self._queue.qsize() if self._queue is not None else 0,
+            "max_per_user": self.max_per_user,
+            "persist": self.persist,
+            "jobs": counts,
+        }
+
+
+def create_job_service(storage: StorageService, llm_service: LLMService,
+                       inventory: Optional[InventoryService] = None,
+                       content_index: Optional[ContentIndex] = None) -> JobService:
+    """Create the job service configured by the JOBS_* environment variables with the generation jobs"""
+    jobs = JobService(storage)
+    exercise_service = ExerciseService(storage, llm_service, content_index)
+    cultural_service = CulturalService(storage, llm_service, content_index)
+
+    async def generate_exercises(params: Dict[str, Any]) -> Any:
+        user = await asyncio.to_thread(storage.get_item, "users", params["user_id"], User)
+        partner = await asyncio.to_thread(storage.get_item, "users", params["partner_id"], User)
+        if not user or not partner:
+            raise ValueError("User or partner not found")
+        if inventory is not None:
+            return await inventory.serve_exercises(user, partner, params.get("count", 3))
+        return await exercise_service.agenerate_exercises(user, partner, params.get("count", 3))
+
+    async def generate_cultural_content(params: Dict[str, Any]) -> Any:
+        return await cultural_service.agenerate_cultural_content(Language(params["language"]))
+
+    jobs.register(JobKind.EXERCISES, generate_exercises)
+    jobs.register(JobKind.CULTURAL, generate_cultural_content)
+    return jobs
@@ -0,0 +1,264 @@
+import os
+import threading
+import logging
+from contextlib import ExitStack
+from typing import Dict, List, Optional, Type, Any
+from pydantic import BaseModel
+from .codecs import decode, json_codec
+from .storage_service import (
+    StorageService, StorageError, Changes, ExpectedVersions, check_versions, versioned
+)
+from .indexing import CollectionIndexes, indexed_fields, page_documents, select_documents
+
+DEFAULT_COMPACT_THRESHOLD = 4 * 1024 * 1024
+
+
+class _JournalCollection:
+    """In-memory state of one collection backed by a snapshot plus a journal.
+
+    The snapshot is a regular ``<collection>.json`` file, so it stays readable
+    by the plain JSON engine. Every put/delete is appended as one JSON line to
+    ``<collection>.journal``. Once the journal grows past the compaction
+    threshold it is rotated to ``<collection>.journal.compacting`` and a new
+    snapshot is written in a background thread. Replaying the rotated journal
+    on top of a snapshot that already contains it is harmless, so a crash at
+    any point of compaction loses nothing.
+    """
+
+    def __init__(self, base_path: str, compact_threshold: int):
+        self.snapshot_path = f"{base_path}.json"
+        self.journal_path = f"{base_path}.journal"
+        self.compacting_path = f"{base_path}.journal.compacting"
+        self.compact_threshold = compact_threshold
+        self.lock = threading.RLock()
+        self.data: Dict[str, Any] = {}
+        self.indexes = CollectionIndexes()
+        # Ids in order, rebuilt after items are added or removed
+        self._sorted_ids: Optional[List[str]] = None
+        self.compacting = False
+        self._compaction: Optional[threading.Thread] = None
+        self._recover()
+        self._journal = open(self.journal_path, 'ab')
+        self.journal_bytes = self._journal.tell()
+
+    def _recover(self) -> None:
+        """Rebuild state from the snapshot and the journal tail"""
+        if os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, 'rb') as f:
+                    self.data = decode(f.read())
+            except ValueError as e:
+                logging.error(f"Error decoding {self.snapshot_path}")
+                raise StorageError(f"Snapshot {self.snapshot_path} is corrupt") from e
+
+        replayed_rotated = os.path.exists(self.compacting_path)
+        if replayed_rotated:
+            self._replay(self.compacting_path)
+        self._replay(self.journal_path)
+
+        if replayed_rotated:
+            # A previous compaction did not finish; fold everything into the snapshot now
+            self._write_snapshot(self.data)
+            os.remove(self.compacting_path)
+            open(self.journal_path, 'wb').close()
+
+    def _replay(self, path: str) -> None:
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            lines = f.readlines()
+        for line_number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json_codec.loads(line)
+            except ValueError:
+                if line_number == len(lines) and not line.endswith(b"\n"):
+                    logging.warning(f"Ignoring truncated last record in {path}")
+                else:
+                    logging.error(f"Skipping corrupt record {line_number} in {path}")
+                continue
+            self._apply(record)
+
+    def _apply(self, record: Dict[str, Any]) -> None:
+        item_id = record["id"]
+        previous = self.data.get(item_id)
+        if previous is not None:
+            self.indexes.remove(item_id, previous)
+        if previous is None or record["op"] == "del":
+            self._sorted_ids = None
+        if record["op"] == "put":
+            self.data[item_id] = record["item"]
+            self.indexes.add(item_id, record["item"])
+        elif record["op"] == "del":
+            self.data.pop(item_id, None)
+
+    def sorted_ids(self) -> List[str]:
+        """Ids of the collection in order (lock held)"""
+        if self._sorted_ids is None:
+            self._sorted_ids = sorted(self.data)
+        return self._sorted_ids
+
+    @staticmethod
+    def encode(records: List[Dict[str, Any]]) -> bytes:
+        """Serialize records to journal lines"""
+        return b"".join(json_codec.dumps(record) + b"\n" for record in records)
+
+    def append(self, records: List[Dict[str, Any]], payload: Optional[bytes] = None) -> None:
+        """Append records to the journal with a single write and apply them in memory"""
+        if payload is None:
+            payload = self.encode(records)
+        with self.lock:
+            self._journal.write(payload)
+            self._journal.flush()
+            self.journal_bytes = self._journal.tell()
+            for record in records:
+                self._apply(record)
+            if self.journal_bytes >= self.compact_threshold and not self.compacting:
+                self._start_compaction()
+
+    def _start_compaction(self) -> threading.Thread:
+        """Rotate the journal and write a new snapshot in the background (lock held)"""
+        self.compacting = True
+        self._journal.close()
+        os.replace(self.journal_path, self.compacting_path)
+        self._journal = open(self.journal_path, 'ab')
+        self.journal_bytes = 0
+        snapshot = dict(self.data)
+        self._compaction = threading.Thread(
+            target=self._compact, args=(snapshot,), name="journal-compaction", daemon=True
+        )
+        self._compaction.start()
+        return self._compaction
+
+    def _compact(self, snapshot: Dict[str, Any]) -> None:
+        try:
+            self._write_snapshot(snapshot)
+            os.remove(self.compacting_path)
+            logging.info(f"Compacted {self.snapshot_path} ({len(snapshot)} items)")
+        except Exception as e:
+            logging.error(f"Error compacting {self.snapshot_path}: {str(e)}")
+        finally:
+            with self.lock:
+                self.compacting = False
+
+    def _write_snapshot(self, snapshot: Dict[str, Any]) -> None:
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(json_codec.dumps(snapshot))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+    def compact(self) -> None:
+        """Fold the journal into a new snapshot and wait until it is written"""
+        with self.lock:
+            running = self._compaction if self.compacting else None
+        if running is not None:
+            # A running compaction only covers the journal it rotated
+            running.join()
+        with self.lock:
+            thread = self._compaction if self.compacting else self._start_compaction()
+        thread.join()
+
+
+# Collections are shared by every JournalStorageService pointing at the same directory
+_collections: Dict[str, _JournalCollection] = {}
+_collections_lock = threading.Lock()
+
+
+class JournalStorageService(StorageService):
+    """Storage engine that appends each write to a per-collection journal.
+
+    Writes cost O(record) instead of rewriting the whole collection. State is
+    rebuilt on startup by replaying the snapshot plus the journal tail and the
+    journal is compacted into a new snapshot in the background. The engine
+    keeps collections in memory and assumes a single writer process.
+    """
+
+    def __init__(self, storage_dir: str = "data", compact_threshold: Optional[int] = None):
+        super().__init__(storage_dir)
+        if compact_threshold is None:
+            compact_threshold = int(
+                os.environ.get("JOURNAL_COMPACT_THRESHOLD", DEFAULT_COMPACT_THRESHOLD)
+            )
+        self.compact_threshold = compact_threshold
+
+    def _collection(self, collection: str) -> _JournalCollection:
+        base_path = os.path.abspath(os.path.join(self.storage_dir, collection))
+        state = _collections.get(base_path)
+        if state is None:
+            with _collections_lock:
+                state = _collections.get(base_path)
+                if state is None:
+                    state = _JournalCollection(base_path, self.compact_threshold)
+                    _collections[base_path] = state
+        return state
+
+    def _load_collection(self, collection: str) -> Dict:
+        """Get a point-in-time copy of a collection"""
+        state = self._collection(collection)
+        with state.lock:
+            return dict(state.data)
+
+    def _save_collection(self, collection: str, data: Dict) -> None:
+        """Replace a whole collection by journaling the differences"""
+        current = self._load_collection(collection)
+        changes: Dict[str, Optional[Dict]] = {item_id: None for item_id in current if item_id not in data}
+        changes.update(data)
+        self._commit_changes({collection: changes})
+
+    def _get_document(self, collection: str, item_id: str) -> Optional[Dict]:
+        return self._collection(collection).data.get(item_id)
+
+    def _all_documents(self, collection: str) -> List[Dict]:
+        state = self._collection(collection)
+        with state.lock:
+            return list(state.data.values())
+
+    def _find_documents(self, collection: str, model_class: Type[BaseModel],
+                        where: Dict[str, Any]) -> List[Dict]:
+        state = self._collection(collection)
+        with state.lock:
+            state.indexes.ensure(indexed_fields(model_class), state.data)
+            return select_documents(state.data, where, state.indexes)
+
+    def _page_documents(self, collection: str, model_class: Type[BaseModel],
+                        where: Dict[str, Any], limit: int, after: Optional[str]) -> List[Dict]:
+        if self._pending(collection):
+            return self._smallest_documents(collection, model_class, where, limit, after)
+        state = self._collection(collection)
+        with state.lock:
+            state.indexes.ensure(indexed_fields(model_class), state.data)
+            return page_documents(state.data, state.sorted_ids(), where, limit, after, state.indexes)
+
+    def _commit_changes(self, changes: Changes, expected: Optional[ExpectedVersions] = None) -> None:
+        """Append one journal record per changed item.
+
+        The affected collections stay locked while versions are checked and
+        records are appended. All records are serialized before anything is
+        written and each collection's records go out in a single write; a torn
+        last record is discarded on replay.
+        """
+        expected = expected or {}
+        states = {collection: self._collection(collection) for collection in changes}
+        with ExitStack() as stack:
+            for collection in sorted(states):
+                stack.enter_context(states[collection].lock)
+
+            encoded = []
+            for collection, collection_changes in changes.items():
+                state = states[collection]
+                check_versions(collection, state.data, expected.get(collection))
+                records = [
+                    {"op": "del", "id": item_id} if doc is None else
+                    {"op": "put", "id": item_id, "item": versioned(doc, state.data.get(item_id))}
+                    for item_id, doc in collection_changes.items()
+                ]
+                encoded.append((state, records, _JournalCollection.encode(records)))
+            for state, records, payload in encoded:
+                state.append(records, payload)
+
+    def compact(self, collection: str) -> None:
+        """Fold the journal of a collection into its snapshot"""
+        self._collection(collection).compact()
@@ -0,0 +1,236 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+from .codecs import json_codec
+
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+DEFAULT_MEMORY_ENTRIES = 512
+
+
+def normalize_text(text: str) -> str:
+    """Drop indentation and surrounding blank space so reformatted prompts share a key"""
+    return "\n".join(line.strip() for line in text.strip().splitlines())
+
+
+def normalize_payload(payload: Any) -> Any:
+    """Normalize a prompt or a list of chat messages for hashing"""
+    if isinstance(payload, str):
+        return normalize_text(payload)
+    if isinstance(payload, dict):
+        return {key: normalize_payload(value) for key, value in sorted(payload.items())}
+    if isinstance(payload, (list, tuple)):
+        return [normalize_payload(value) for value in payload]
+    return payload
+
+
+class LLMCache:
+    """Content-addressed cache of LLM responses.
+
+    Responses are keyed by a hash of the model, the normalized prompt or
+    messages, the call parameters and a variant slot. Entries are kept in an
+    in-memory LRU in front of one file per entry under ``cache_dir``. Entries
+    older than ``ttl_seconds`` are ignored and removed, and once the files
+    exceed ``max_bytes`` the least recently used ones are deleted.
+    """
+
+    def __init__(self, cache_dir: str, ttl_seconds: float = DEFAULT_TTL_SECONDS,
+                 max_bytes: int = DEFAULT_MAX_BYTES, memory_entries: int = DEFAULT_MEMORY_ENTRIES):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes: Optional[int] = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(model: str, payload: Any, params: Optional[Dict[str, Any]] = None, variant: int = 0) -> str:
+        """Hash a call into a cache key"""
+        material = {
+            "model": model,
+            "payload": normalize_payload(payload),
+            "params": normalize_payload(params or {}),
+            "variant": variant,
+        }
+        return hashlib.sha256(json_codec.dumps(material)).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _fresh(self, created: float) -> bool:
+        return time.time() - created < self.ttl_seconds
+
+    def get(self, key: str) -> Optional[str]:
+        """Get a cached response, or None if it is missing or expired"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if self._fresh(entry[0]):
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry[1]
+                del self._memory[key]
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                record = json_codec.loads(f.read())
+        except FileNotFoundError:
+            record = None
+        except ValueError:
+            logging.warning(f"Dropping unreadable LLM cache entry {path}")
+            self._remove(path)
+            record = None
+
+        if record is not None and not self._fresh(record["created"]):
+            self._remove(path)
+            with self._lock:
+                self.expired += 1
+            record = None
+
+        if record is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        try:
+            os.utime(path)  # Recently used entries survive eviction longer
+        except OSError:
+            pass
+        with self._lock:
+            self.disk_hits += 1
+            self._remember(key, record["created"], record["response"])
+        return record["response"]
+
+    def put(self, key: str, response: str, model: Optional[str] = None) -> None:
+        """Store a response"""
+        created = time.time()
+        with self._lock:
+            self._remember(key, created, response)
+
+        path = self._path(key)
+        raw = json_codec.dumps({"created": created, "model": model, "response": response})
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(raw)
+                os.replace(tmp_path, path)
+            except OSError:
+                self._remove(tmp_path)
+                raise
+        except OSError as e:
+            # The response is still served from memory; the cache never fails a call
+            logging.warning(f"Error writing LLM cache entry {path}: {str(e)}")
+            return
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan()[1]
+            else:
+                self._disk_bytes += len(raw)
+            over_budget = self._disk_bytes > self.max_bytes
+        if over_budget:
+            self._evict()
+
+    def _remember(self, key: str, created: float, response: str) -> None:
+        """Add an entry to the in-memory LRU (lock held)"""
+        self._memory[key] = (created, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _scan(self) -> Tuple[list, int]:
+        """List (mtime, size, path) of all entry files and their total size"""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries, sum(size for _, size, _ in entries)
+
+    def _evict(self) -> None:
+        """Delete least recently used files until the cache is below 90% of its budget"""
+        entries, total = self._scan()
+        entries.sort()
+        target = self.max_bytes * 0.9
+        evicted = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            self._remove(path)
+            total -= size
+            evicted += 1
+        with self._lock:
+            self._disk_bytes = total
+            self.evictions += evicted
+        logging.info(f"Evicted {evicted} LLM cache entries")
+
+    def clear(self) -> None:
+        """Drop all cached responses"""
+        with self._lock:
+            self._memory.clear()
+        for _, _, path in self._scan()[0]:
+            self._remove(path)
+        with self._lock:
+            self._disk_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Get cache counters"""
+        if self._disk_bytes is None:
+            disk_bytes = self._scan()[1]
+            with self._lock:
+                if self._disk_bytes is None:
+                    self._disk_bytes = disk_bytes
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "hits": hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "hit_ratio": hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_bytes": self._disk_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+def create_llm_cache(cache_dir: Optional[str] = None) -> Optional[LLMCache]:
+    """Create the response cache configured by the LLM_CACHE_* environment variables"""
+    if os.environ.get("LLM_CACHE_ENABLED", "1").lower() in ("0", "false", "no"):
+        return None
+    return LLMCache(
+        cache_dir or os.environ.get("LLM_CACHE_DIR", os.path.join("data", "llm_cache")),
+        ttl_seconds=float(os.environ.get("LLM_CACHE_TTL", DEFAULT_TTL_SECONDS)),
+        max_bytes=int(os.environ.get("LLM_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+        memory_entries=int(os.environ.get("LLM_CACHE_MEMORY_ENTRIES", DEFAULT_MEMORY_ENTRIES)),
+    )
@@ -0,0 +1,311 @@
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Dict, Iterator, List, Optional, Tuple, TypeVar
+from .llm_providers import Completion
+
+R = TypeVar('R')
+
+# Upper bounds in seconds of the call latency histogram
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+
+# USD per million prompt and completion tokens; override or extend with LLM_PRICES='{"model": [in, out]}'
+DEFAULT_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gemini-2.0-flash": (0.10, 0.40),
+}
+
+# Distinct users tracked in the per-user breakdown; the rest are counted as "other"
+MAX_USERS = int(os.environ.get("LLM_METRICS_MAX_USERS", 10000))
+
+# Labels of the LLM calls made in the current context: site, user and language
+_call_labels: ContextVar[Dict[str, str]] = ContextVar("llm_call_labels", default={})
+
+call_log = logging.getLogger("llm.calls")
+
+
+@contextmanager
+def llm_call_context(**labels: Any) -> Iterator[None]:
+    """Label the LLM calls made inside the block, e.g. ``site="quiz"``, ``user=...``, ``language=...``.
+
+    Labels nest: inner blocks add to or override the outer ones. They follow
+    the code into awaited coroutines, tasks created inside the block and
+    asyncio.to_thread, but not across the yields of a generator.
+    """
+    values = {key: str(getattr(value, "value", value)) for key, value in labels.items() if value is not None}
+    token = _call_labels.set({**_call_labels.get(), **values})
+    try:
+        yield
+    finally:
+        _call_labels.reset(token)
+
+
+async def labelled(call: Awaitable[R], **labels: Any) -> R:
+    """Await a call under llm_call_context, so calls gathered together get their own labels"""
+    with llm_call_context(**labels):
+        return await call
+
+
+def current_labels() -> Dict[str, str]:
+    return _call_labels.get()
+
+
+def _load_prices() -> Dict[str, Tuple[float, float]]:
+    prices = dict(DEFAULT_PRICES)
+    for model, (prompt_price, completion_price) in json.loads(os.environ.get("LLM_PRICES", "{}")).items():
+        prices[model] = (float(prompt_price), float(completion_price))
+    return prices
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _series(name: str, labels: Dict[str, str], value: float) -> str:
+    if labels:
+        label_text = ",".join(f'{key}="{_escape(str(label))}"' for key, label in labels.items())
+        return f"{name}{{{label_text}}} {value:g}"
+    return f"{name} {value:g}"
+
+
+class _Usage:
+    __slots__ = ("calls", "cache_hits", "prompt_tokens", "completion_tokens", "cost")
+
+    def __init__(self):
+        self.calls = 0
+        self.cache_hits = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+
+    def add(self, cached: bool, prompt_tokens: int, completion_tokens: int, cost: float) -> None:
+        self.calls += 1
+        self.cache_hits += cached
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.cost += cost
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "cache_hits": self.cache_hits,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost_usd": round(self.cost, 6),
+        }
+
+
+class LLMMetrics:
+    """Counts LLM calls by call site, provider, model and cache outcome.
+
+    Each call records its latency, token usage, estimated cost and retries,
+    taking the site, user and language from llm_call_context. Prometheus
+    series are labelled by site, provider and model, plus language for the
+    per-language totals; per-user totals are only kept for usage(), as a
+    label per user would make too many series. Every call is also logged as
+    one JSON line on the ``llm.calls`` logger.
+    """
+
+    def __init__(self, prices: Optional[Dict[str, Tuple[float, float]]] = None, log_calls: Optional[bool] = None):
+        if prices is None:
+            prices = _load_prices()
+        if log_calls is None:
+            log_calls = os.environ.get("LLM_CALL_LOG", "1").lower() not in ("0", "false", "no")
+        self.prices = prices
+        self.log_calls = log_calls
+        self._lock = threading.Lock()
+        self._calls: Dict[Tuple[str, ...], int] = {}
+        self._latency: Dict[Tuple[str, ...], List[float]] = {}
+        self._tokens: Dict[Tuple[str, ...], int] = {}
+        self._cost: Dict[Tuple[str, ...], float] = {}
+        self._retries: Dict[Tuple[str, ...], int] = {}
+        self._dropped: Dict[str, int] = {}
+        self._by_site: Dict[str, _Usage] = {}
+        self._by_language: Dict[str, _Usage] = {}
+        self._by_user: Dict[str, _Usage] = {}
+        self._by_provider: Dict[str, _Usage] = {}
+
+    def cost_of(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        """Estimated USD cost of a call, 0 for models without a price"""
+        prompt_price, completion_price = self.prices.get(model, (0.0, 0.0))
+        return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+    def record(self, provider: str, model: str, cache: str, latency: float, attempts: int = 1,
+               completion: Optional[Completion] = None, error: Optional[BaseException] = None,
+               labels: Optional[Dict[str, str]] = None) -> None:
+        """Record one LLM call, labelled with ``labels`` or else the current llm_call_context.
+
+        ``cache`` is the cache outcome: ``hit`` and ``coalesced`` calls were
+        answered without the provider, ``miss`` and ``bypass`` ones called
+        it ``attempts`` times.
+        """
+        if labels is None:
+            labels = current_labels()
+        site = labels.get("site", "unknown")
+        language = labels.get("language", "none")
+        user = labels.get("user")
+        prompt_tokens = completion.prompt_tokens if completion is not None else 0
+        completion_tokens = completion.completion_tokens if completion is not None else 0
+        cost = self.cost_of(model, prompt_tokens, completion_tokens)
+        retries = max(0, attempts - 1)
+        outcome = "ok" if error is None else "error"
+        cached = cache in ("hit", "coalesced")
+        key = (site, provider, model)
+
+        with self._lock:
+            call_key = key + (cache, outcome)
+            self._calls[call_key] = self._calls.get(call_key, 0) + 1
+            if not cached:
+                histogram = self._latency.setdefault(key, [0.0] * (len(LATENCY_BUCKETS) + 2))
+                for index, bound in enumerate(LATENCY_BUCKETS):
+                    if latency <= bound:
+                        histogram[index] += 1
+                histogram[-2] += latency
+                histogram[-1] += 1
+            for kind, count in (("prompt", prompt_tokens), ("completion", completion_tokens)):
+                if count:
+                    self._tokens[key + (kind,)] = self._tokens.get(key + (kind,), 0) + count
+            if cost:
+                self._cost[key] = self._cost.get(key, 0.0) + cost
+            if retries:
+                self._retries[key] = self._retries.get(key, 0) + retries
+            usages = [
+                self._by_site.setdefault(site, _Usage()),
+                self._by_language.setdefault(language, _Usage()),
+                self._by_provider.setdefault(provider, _Usage()),
+            ]
+            if user is not None:
+                if user not in self._by_user and len(self._by_user) >= MAX_USERS:
+                    user = "other"
+                usages.append(self._by_user.setdefault(user, _Usage()))
+            for usage in usages:
+                usage.add(cached, prompt_tokens, completion_tokens, cost)
+
+        if self.log_calls:
+            call_log.info(json.dumps({
+                "site": site, "provider": provider, "model": model, "cache": cache, "outcome": outcome,
+                "latency_ms": round(latency * 1000, 1), "attempts": attempts,
+                "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "cost_usd": round(cost, 6), "user": user, "language": labels.get("language"),
+                "error": type(error).__name__ if error is not None else None,
+            }))
+
+    def record_dropped(self, count: int = 1) -> None:
+        """Count outputs given up on as still unusable after every attempt, by the current call site"""
+        site = current_labels().get("site", "unknown")
+        with self._lock:
+            self._dropped[site] = self._dropped.get(site, 0) + count
+
+    def provider_usage(self, provider: str) -> Dict[str, Any]:
+        """Token and cost totals of a provider"""
+        with self._lock:
+            usage = self._by_provider.get(provider) or _Usage()
+            return {
+                "prompt_tokens": usage.prompt_tokens,
+                "completion_tokens": usage.completion_tokens,
+                "cost_usd": round(usage.cost, 6),
+            }
+
+    def usage(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """Calls, cache hits, tokens and cost by call site, language and user, for capacity planning"""
+        with self._lock:
+            return {
+                dimension: {name: usage.to_dict() for name, usage in sorted(totals.items())}
+                for dimension, totals in (
+                    ("sites", self._by_site), ("languages", self._by_language), ("users", self._by_user)
+                )
+            }
+
+    def render(self) -> List[str]:
+        """The metrics in the Prometheus text exposition format, one line per entry"""
+        lines = []
+        with self._lock:
+            lines += [
+                "# HELP tandem_llm_calls_total LLM calls by call site, provider, model, cache outcome and result.",
+                "# TYPE tandem_llm_calls_total counter",
+            ]
+            for (site, provider, model, cache, outcome), count in sorted(self._calls.items()):
+                lines.append(_series("tandem_llm_calls_total", {
+                    "site": site, "provider": provider, "model": model, "cache": cache, "outcome": outcome
+                }, count))
+
+            lines += [
+                "# HELP tandem_llm_call_duration_seconds Latency of the LLM calls that reached the provider, retries included.",
+                "# TYPE tandem_llm_call_duration_seconds histogram",
+            ]
+            for (site, provider, model), histogram in sorted(self._latency.items()):
+                labels = {"site": site, "provider": provider, "model": model}
+                for bound, count in zip(LATENCY_BUCKETS, histogram):
+                    lines.append(_series("tandem_llm_call_duration_seconds_bucket", {**labels, "le": f"{bound:g}"}, count))
+                lines.append(_series("tandem_llm_call_duration_seconds_bucket", {**labels, "le": "+Inf"}, histogram[-1]))
+                lines.append(_series("tandem_llm_call_duration_seconds_sum", labels, histogram[-2]))
+                lines.append(_series("tandem_llm_call_duration_seconds_count", labels, histogram[-1]))
+
+            lines += [
+                "# HELP tandem_llm_tokens_total Prompt and completion tokens of LLM calls.",
+                "# TYPE tandem_llm_tokens_total counter",
+            ]
+            for (site, provider, model, kind), count in sorted(self._tokens.items()):
+                lines.append(_series("tandem_llm_tokens_total", {
+                    "site": site, "provider": provider, "model": model, "kind": kind
+                }, count))
+
+            lines += [
+                "# HELP tandem_llm_cost_usd_total Estimated cost of LLM calls in US dollars.",
+                "# TYPE tandem_llm_cost_usd_total counter",
+            ]
+            for (site, provider, model), cost in sorted(self._cost.items()):
+                lines.append(_series("tandem_llm_cost_usd_total", {"site": site, "provider": provider, "model": model}, cost))
+
+            lines += [
+                "# HELP tandem_llm_retries_total Retried attempts of LLM calls.",
+                "# TYPE tandem_llm_retries_total counter",
+            ]
+            for (site, provider, model), count in sorted(self._retries.items()):
+                lines.append(_series("tandem_llm_retries_total", {"site": site, "provider": provider, "model": model}, count))
+
+            lines += [
+                "# HELP tandem_llm_dropped_outputs_total Generated outputs left out as unusable after every attempt.",
+                "# TYPE tandem_llm_dropped_outputs_total counter",
+            ]
+            for site, count in sorted(self._dropped.items()):
+                lines.append(_series("tandem_llm_dropped_outputs_total", {"site": site}, count))
+
+            for name, help_text, field in (
+                ("tandem_llm_language_calls_total", "LLM calls by content language.", "calls"),
+                ("tandem_llm_language_tokens_total", "Prompt and completion tokens by content language.", None),
+                ("tandem_llm_language_cost_usd_total", "Estimated LLM cost in US dollars by content language.", "cost"),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for language, usage in sorted(self._by_language.items()):
+                    if field is None:
+                        lines.append(_series(name, {"language": language, "kind": "prompt"}, usage.prompt_tokens))
+                        lines.append(_series(name, {"language": language, "kind": "completion"}, usage.completion_tokens))
+                    else:
+                        lines.append(_series(name, {"language": language}, getattr(usage, field)))
+        return lines
+
+
+def render_provider_stats(stats: Dict[str, Dict[str, Any]]) -> List[str]:
+    """Prometheus gauges of the provider schedulers, from their stats() by provider"""
+    lines = []
+    for name, help_text, field in (
+        ("tandem_llm_provider_concurrency_limit", "Adaptive concurrency limit of the provider.", "limit"),
+        ("tandem_llm_provider_in_flight", "Provider calls in flight.", "in_flight"),
+        ("tandem_llm_provider_waiting", "Calls waiting for a provider slot.", "waiting"),
+        ("tandem_llm_provider_breaker_open", "1 while the provider's circuit breaker is open.", "breaker"),
+        ("tandem_llm_provider_rate_limited_total", "Rate-limited provider attempts.", "rate_limited"),
+        ("tandem_llm_provider_rejected_total", "Calls rejected while the circuit breaker was open.", "rejected"),
+    ):
+        kind = "counter" if name.endswith("_total") else "gauge"
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for provider, provider_stats in sorted(stats.items()):
+            value = provider_stats[field]
+            if field == "breaker":
+                value = int(value == "open")
+            lines.append(_series(name, {"provider": provider}, value))
+    return lines
@@ -0,0 +1,219 @@
+import logging
+from typing import Any, AsyncIterator, Dict, List, NamedTuple, Optional, Tuple
+import httpx
+
+Messages = List[Dict[str, Any]]
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of a text, about four characters per token"""
+    return len(text) // 4 + 1
+
+
+class ProviderNotConfiguredError(Exception):
+    """Raised when a call needs a provider whose API key is not set"""
+
+    def __init__(self, provider: str, variable: str):
+        super().__init__(f"{provider} is not configured, set {variable}")
+        self.provider = provider
+
+
+class Completion(NamedTuple):
+    """Text and token usage of one provider call"""
+    text: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class LLMProvider:
+    """Sends calls to one LLM API.
+
+    Messages use the OpenAI chat format: dicts with a ``role`` (system, user
+    or assistant) and a ``content``. Each provider translates them to its own
+    API. With ``json_mode`` the provider is asked to answer with JSON.
+    """
+
+    name = "provider"
+
+    def complete(self, messages: Messages, model: str, json_mode: bool = False) -> Completion:
+        raise NotImplementedError
+
+    async def acomplete(self, messages: Messages, model: str, json_mode: bool = False) -> Completion:
+        raise NotImplementedError
+
+    def astream(self, messages: Messages, model: str, json_mode: bool = False) -> AsyncIterator[str]:
+        """Yield the response text as it is generated"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    async def aclose(self) -> None:
+        pass
+
+
+class OpenAIProvider(LLMProvider):
+    """OpenAI chat completions over shared keep-alive HTTP clients"""
+
+    name = "openai"
+
+    def __init__(self, api_key: str, http_client: httpx.Client, async_http_client: httpx.AsyncClient):
+        # Imported here so that other backends, such as the fake one, run without the SDK
+        from openai import AsyncOpenAI, OpenAI
+
+        # Retries are made by the provider schedulers, not inside the SDK
+        self.client = OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+        self.async_client = AsyncOpenAI(api_key=api_key, http_client=async_http_client, max_retries=0)
+
+    @staticmethod
+    def _options(json_mode: bool) -> Dict[str, Any]:
+        return {"response_format": {"type": "json_object"}} if json_mode else {}
+
+    @staticmethod
+    def _completion(completion: Any) -> Completion:
+        usage = getattr(completion, "usage", None)
+        return Completion(
+            completion.choices[0].message.content,
+            getattr(usage, "prompt_tokens", 0) or 0,
+            getattr(usage, "completion_tokens", 0) or 0,
+        )
+
+    def complete(self, messages: Messages, model: str, json_mode: bool = False) -> Completion:
+        try:
+            completion = self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                store=True,
+                **self._options(json_mode)
+            )
+            return self._completion(completion)
+        except Exception as e:
+            logging.error(f"Error calling OpenAI API: {str(e)}")
+            raise e
+
+    async def acomplete(self, messages: Messages, model: str, json_mode: bool = False) -> Completion:
+        try:
+            completion = await self.async_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                store=True,
+                **self._options(json_mode)
+            )
+            return self._completion(completion)
+        except Exception as e:
+            logging.error(f"Error calling OpenAI API: {str(e)}")
+            raise e
+
+    async def astream(self, messages: Messages, model: str, json_mode: bool = False) -> AsyncIterator[str]:
+        try:
+            stream = await self.async_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                store=True,
+                stream=True,
+                **self._options(json_mode)
+            )
+            async for chunk in stream:
+                # The final chunk of a stream may carry no choices
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except Exception as e:
+            logging.error(f"Error streaming from OpenAI API: {str(e)}")
+            raise e
+
+    def close(self) -> None:
+        self.client.close()
+
+    async def aclose(self) -> None:
+        await self.async_client.close()
+
+
+class GeminiProvider(LLMProvider):
+    """Google Gemini through the google-genai client"""
+
+    name = "gemini"
+
+    def __init__(self, api_key: str, timeout: float):
+        # Imported here so that other backends, such as the fake one, run without the SDK
+        from google import genai
+
+        self.client = genai.Client(api_key=api_key, http_options={"timeout": int(timeout * 1000)})
+
+    @staticmethod
+    def _request(messages: Messages, json_mode: bool) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """Turn chat messages into Gemini contents and config.
+
+        Gemini calls the assistant ``model`` and takes system messages as the
+        system instruction; consecutive messages of the same role are merged
+        into one turn.
+        """
+        contents: List[Dict[str, Any]] = []
+        system = []
+        for message in messages:
+            if message["role"] == "system":
+                system.append(message["content"])
+                continue
+            role = "model" if message["role"] in ("assistant", "model") else "user"
+            if contents and contents[-1]["role"] == role:
+                contents[-1]["parts"].append({"text": message["content"]})
+            else:
+                contents.append({"role": role, "parts": [{"text": message["content"]}]})
+
+        config: Dict[str, Any] = {}
+        if system:
+            config["system_instruction"] = "\n\n".join(system)
+        if json_mode:
+            config["response_mime_type"] = "application/json"
+        return contents, config or None
+
+    @staticmethod
+    def _completion(response: Any) -> Completion:
+        usage = getattr(response, "usage_metadata", None)
+        return Completion(
+            response.text,
+            getattr(usage, "prompt_token_count", 0) or 0,
+            getattr(usage, "candidates_token_count", 0) or 0,
+        )
+
+    def complete(self, messages: Messages, model: str, json_mode: bool = False) -> Completion:
+        contents, config = self._request(messages, json_mode)
+        try:
+            response = self.client.models.generate_content(model=model, contents=contents, config=config)
+            return self._completion(response)
+        except Exception as e:
+            logging.error(f"Error calling Gemini API: {str(e)}")
+            raise e
+
+    async def acomplete(self, messages: Messages, model: str, json_mode: bool = False) -> Completion:
+        contents, config = self._request(messages, json_mode)
+        try:
+            response = await self.client.aio.models.generate_content(model=model, contents=contents, config=config)
+            return self._completion(response)
+        except Exception as e:
+            logging.error(f"Error calling Gemini API: {str(e)}")
+            raise e
+
+    async def astream(self, messages: Messages, model: str, json_mode: bool = False) -> AsyncIterator[str]:
+        contents, config = self._request(messages, json_mode)
+        try:
+            async for chunk in await self.client.aio.models.generate_content_stream(
+                model=model,
+                contents=contents,
+                config=config
+            ):
+                if chunk.text:
+                    yield chunk.text
+        except Exception as e:
+            logging.error(f"Error streaming from Gemini API: {str(e)}")
+            raise e
+
+    def close(self) -> None:
+        # Older google-genai releases have no close(); their pool is released with the client
+        close = getattr(self.client, "close", None)
+        if close is not None:
+            close()
+
+    async def aclose(self) -> None:
+        close = getattr(self.client.aio, "aclose", None)
+        if close is not None:
+            await close()
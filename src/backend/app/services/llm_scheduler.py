@@ -0,0 +1,413 @@
+import asyncio
+import random
+import threading
+import time
+import logging
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Optional, TypeVar
+import os
+import httpx
+
+R = TypeVar('R')
+
+# Status codes worth retrying: timeouts, conflicts, rate limits and server errors
+TRANSIENT_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class ProviderUnavailableError(Exception):
+    """Raised without calling a provider while its circuit breaker is open"""
+
+    def __init__(self, provider: str, retry_after: float):
+        super().__init__(f"{provider} is unavailable, retry in {retry_after:.0f}s")
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+def status_code_of(error: BaseException) -> Optional[int]:
+    """Get the HTTP status of a provider error (OpenAI ``status_code``, Gemini ``code``)"""
+    for attribute in ("status_code", "code"):
+        value = getattr(error, attribute, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, "response", None)
+    value = getattr(response, "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def is_rate_limited(error: BaseException) -> bool:
+    return status_code_of(error) == 429 or "RESOURCE_EXHAUSTED" in str(error)
+
+
+def is_transient(error: BaseException) -> bool:
+    """Whether a call that failed with ``error`` may succeed if made again"""
+    if isinstance(error, (httpx.TimeoutException, httpx.TransportError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    # openai.APIConnectionError and APITimeoutError carry no status
+    if type(error).__name__ in ("APIConnectionError", "APITimeoutError"):
+        return True
+    return status_code_of(error) in TRANSIENT_STATUS_CODES or is_rate_limited(error)
+
+
+def retry_after_of(error: BaseException) -> Optional[float]:
+    """Read the Retry-After header of a rate-limit response, if any"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimit:
+    """Concurrency limit adjusted by additive increase / multiplicative decrease.
+
+    Each call that completes close to the usual latency of its kind raises
+    the limit by 1/limit, so it grows by about one per round of calls. A
+    rate-limited call halves it and a call much slower than usual shrinks it
+    slightly, at most once per ``cooldown`` seconds. The usual latency of a
+    kind is a moving average weighted by ``baseline_weight``, so short and
+    long calls are each judged against their own kind and a single fast
+    call does not lower the bar for good. Sync and async callers share the
+    same slots and are served in arrival order.
+    """
+
+    def __init__(self, initial: float = 8, min_limit: float = 1, max_limit: float = 64,
+                 latency_tolerance: float = 2.0, backoff: float = 0.5, cooldown: float = 1.0,
+                 baseline_weight: float = 0.1):
+        self.limit = float(initial)
+        self.min_limit = float(min_limit)
+        self.max_limit = float(max_limit)
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.baseline_weight = baseline_weight
+        self.baselines: Dict[str, float] = {}
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+        self._waiters: Deque[Any] = deque()
+
+    def _has_slot(self) -> bool:
+        return self.in_flight < max(1, int(self.limit))
+
+    def acquire(self) -> None:
+        """Wait for a slot on the calling thread"""
+        with self._lock:
+            if not self._waiters and self._has_slot():
+                self.in_flight += 1
+                return
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+        # The releasing caller hands its slot over before setting the event
+        waiter.wait()
+
+    async def aacquire(self) -> None:
+        """Wait for a slot without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if not self._waiters and self._has_slot():
+                self.in_flight += 1
+                return
+            future = loop.create_future()
+            self._waiters.append((loop, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                try:
+                    self._waiters.remove((loop, future))
+                    handed_over = False
+                except ValueError:
+                    handed_over = True
+            # A slot handed over with set_result is ours to return; if the
+            # future was cancelled first, _resolve returns it instead
+            if handed_over and future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def _resolve(self, future: asyncio.Future) -> None:
+        if future.done():
+            # Cancelled before the slot arrived
+            self.release()
+        else:
+            future.set_result(None)
+
+    def _wake(self) -> None:
+        """Hand free slots to waiters (lock held)"""
+        while self._waiters and self._has_slot():
+            waiter = self._waiters.popleft()
+            self.in_flight += 1
+            if isinstance(waiter, threading.Event):
+                waiter.set()
+            else:
+                loop, future = waiter
+                loop.call_soon_threadsafe(self._resolve, future)
+
+    def release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            self._wake()
+
+    def on_success(self, latency: Optional[float] = None, kind: str = "default") -> None:
+        """Grow the limit after a call that completed without queuing up at the provider.
+
+        Without a ``latency`` (a stream, whose duration depends on its reader)
+        the limit grows unchecked.
+        """
+        with self._lock:
+            if latency is not None:
+                baseline = self.baselines.get(kind, latency)
+                self.baselines[kind] = baseline + self.baseline_weight * (latency - baseline)
+                if latency > baseline * self.latency_tolerance:
+                    self._decrease(0.9)
+                    return
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._wake()
+
+    def on_overload(self) -> None:
+        """Shrink the limit after the provider rejected a call for rate limiting"""
+        with self._lock:
+            self._decrease(self.backoff)
+
+    def _decrease(self, factor: float) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * factor)
+
+
+class CircuitBreaker:
+    """Fails calls fast after ``failure_threshold`` consecutive transient failures.
+
+    After ``reset_timeout`` seconds one trial call is let through: if it
+    succeeds the breaker closes again, otherwise it stays open for another
+    ``reset_timeout``. A trial that ends without an outcome, such as a
+    cancelled call, lets the next call be the trial; one that has not ended
+    after ``reset_timeout`` is given up on the same way.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_started = 0.0
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        """Whether a call may be made now"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            stalled = self.state == self.HALF_OPEN and time.monotonic() - self.trial_started >= self.reset_timeout
+            if (self.state == self.OPEN and self.retry_after() == 0) or stalled:
+                # Let one trial call through
+                self.state = self.HALF_OPEN
+                self.trial_started = time.monotonic()
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def record_abandoned(self) -> None:
+        """Note a call that ended without an outcome, e.g. cancelled, so a trial call is let through again"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record_neutral(self) -> None:
+        """Note a call that failed for a reason unrelated to provider health"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.CLOSED
+            self.failures = 0
+
+
+class ProviderScheduler:
+    """Runs the calls to one LLM provider under an adaptive limit, retries and a circuit breaker.
+
+    Transient failures (timeouts, connection errors, 429 and 5xx) are retried
+    up to ``max_attempts`` times with full-jitter exponential backoff, or after
+    the provider's Retry-After. They count towards the circuit breaker; other
+    errors are raised at once.
+    """
+
+    def __init__(self, provider: str, limit: Optional[AdaptiveLimit] = None,
+                 breaker: Optional[CircuitBreaker] = None, max_attempts: int = 3,
+                 base_delay: float = 0.5, max_delay: float = 8.0):
+        self.provider = provider
+        self.limit = limit or AdaptiveLimit()
+        self.breaker = breaker or CircuitBreaker()
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.rejected = 0
+
+    def _check_breaker(self) -> None:
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise ProviderUnavailableError(self.provider, self.breaker.retry_after())
+
+    def _backoff(self, attempt: int, error: BaseException) -> float:
+        retry_after = retry_after_of(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _on_success(self, started: Optional[float], kind: str) -> None:
+        self.limit.on_success(time.monotonic() - started if started is not None else None, kind)
+        self.breaker.record_success()
+
+    def _on_failure(self, error: Exception, attempt: int) -> bool:
+        """Record a failed attempt and tell whether to retry it"""
+        if not is_transient(error):
+            self.breaker.record_neutral()
+            return False
+        self.failures += 1
+        if is_rate_limited(error):
+            self.rate_limited += 1
+            self.limit.on_overload()
+        self.breaker.record_failure()
+        if attempt + 1 >= self.max_attempts:
+            return False
+        self.retries += 1
+        logging.warning(f"Retrying {self.provider} call after {type(error).__name__}: {str(error)}")
+        return True
+
+    def call(self, func: Callable[[], R], kind: str = "default") -> R:
+        """Make a blocking provider call; its latency is compared with earlier calls of the same ``kind``"""
+        self.calls += 1
+        for attempt in range(self.max_attempts):
+            self._check_breaker()
+            self.limit.acquire()
+            started = time.monotonic()
+            try:
+                result = func()
+            except Exception as e:
+                self.limit.release()
+                if not self._on_failure(e, attempt):
+                    raise
+                time.sleep(self._backoff(attempt, e))
+                continue
+            except BaseException:
+                self.limit.release()
+                self.breaker.record_abandoned()
+                raise
+            self.limit.release()
+            self._on_success(started, kind)
+            return result
+
+    async def acall(self, func: Callable[[], Awaitable[R]], kind: str = "default") -> R:
+        """Make an async provider call"""
+        self.calls += 1
+        for attempt in range(self.max_attempts):
+            self._check_breaker()
+            await self.limit.aacquire()
+            started = time.monotonic()
+            try:
+                result = await func()
+            except Exception as e:
+                self.limit.release()
+                if not self._on_failure(e, attempt):
+                    raise
+                await asyncio.sleep(self._backoff(attempt, e))
+                continue
+            except BaseException:
+                self.limit.release()
+                self.breaker.record_abandoned()
+                raise
+            self.limit.release()
+            self._on_success(started, kind)
+            return result
+
+    async def astream(self, stream: Callable[[], AsyncIterator[R]]) -> AsyncIterator[R]:
+        """Make a streaming provider call; it is only retried if it fails before the first chunk"""
+        self.calls += 1
+        for attempt in range(self.max_attempts):
+            self._check_breaker()
+            await self.limit.aacquire()
+            streamed = False
+            try:
+                async for chunk in stream():
+                    if not streamed:
+                        # The time to the first chunk is not comparable with whole calls
+                        self._on_success(None, "stream")
+                        streamed = True
+                    yield chunk
+            except Exception as e:
+                if streamed or not self._on_failure(e, attempt):
+                    raise
+                retry_in = self._backoff(attempt, e)
+            except BaseException:
+                # Cancelled, or closed by the consumer
+                if not streamed:
+                    self.breaker.record_abandoned()
+                raise
+            else:
+                if not streamed:
+                    self._on_success(None, "stream")
+                return
+            finally:
+                self.limit.release()
+            await asyncio.sleep(retry_in)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": round(self.limit.limit, 2),
+            "in_flight": self.limit.in_flight,
+            "waiting": len(self.limit._waiters),
+            "latency_baselines": {kind: round(latency, 3) for kind, latency in self.limit.baselines.items()},
+            "breaker": self.breaker.state,
+            "breaker_trips": self.breaker.trips,
+            "calls": self.calls,
+            "retries": self.retries,
+            "failures": self.failures,
+            "rate_limited": self.rate_limited,
+            "rejected": self.rejected,
+        }
+
+
+def create_provider_scheduler(provider: str, max_concurrency: Optional[int] = None) -> ProviderScheduler:
+    """Create a provider scheduler configured by the LLM_* environment variables"""
+    if max_concurrency is None:
+        max_concurrency = int(os.environ.get("LLM_MAX_CONCURRENCY", 16))
+    initial = float(os.environ.get("LLM_INITIAL_CONCURRENCY", min(8, max_concurrency)))
+    return ProviderScheduler(
+        provider,
+        limit=AdaptiveLimit(initial=min(initial, max_concurrency), max_limit=max_concurrency),
+        breaker=CircuitBreaker(
+            failure_threshold=int(os.environ.get("LLM_BREAKER_THRESHOLD", 5)),
+            reset_timeout=float(os.environ.get("LLM_BREAKER_RESET", 30)),
+        ),
+        max_attempts=int(os.environ.get("LLM_RETRY_ATTEMPTS", 3)),
+        base_delay=float(os.environ.get("LLM_RETRY_BASE_DELAY", 0.5)),
+        max_delay=float(os.environ.get("LLM_RETRY_MAX_DELAY", 8)),
+    )
@@ -1,44 +1,491 @@
+import asyncio
 import logging
-from typing import List, Optional, Dict, Any
-from openai import OpenAI
-from google import genai
+import os
+import threading
+import time
+from functools import partial
+from typing import AsyncIterator, Awaitable, Callable, Iterable, List, Optional, Dict, Any, Tuple, TypeVar
+import httpx
 from ..models.visitor import ChatMessage
+from .llm_cache import LLMCache, create_llm_cache
+from .llm_metrics import LLMMetrics, current_labels, render_provider_stats
+from .llm_providers import (
+    Completion, GeminiProvider, LLMProvider, Messages, OpenAIProvider, ProviderNotConfiguredError, estimate_tokens
+)
+from .llm_scheduler import ProviderScheduler, create_provider_scheduler
+from .single_flight import SingleFlight
+
+R = TypeVar('R')
+
+# Generations started by a single request run at most this many LLM calls at once
+REQUEST_CONCURRENCY = int(os.environ.get("LLM_REQUEST_CONCURRENCY", 3))
+
+# Ask the providers for JSON output when callers want it; turn off for models without a JSON mode
+JSON_MODE = os.environ.get("LLM_JSON_MODE", "1").lower() not in ("0", "false", "no")
+
+
+async def gather_limited(calls: Iterable[Awaitable[R]], limit: int = REQUEST_CONCURRENCY) -> List[R]:
+    """Await calls concurrently, at most ``limit`` at a time, and return their results in order"""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(call: Awaitable[R]) -> R:
+        async with semaphore:
+            return await call
+
+    return await asyncio.gather(*(run(call) for call in calls))
 
-class LLMService:
-    def __init__(self, openai_api_key: str, gemini_api_key: str):
-        self.openai_client = OpenAI(api_key=openai_api_key)
-        self.gemini_client = genai.Client(api_key=gemini_api_key)
 
-    def call_gemini_flash(self, prompt: str, model: str = "gemini-2.0-flash") -> str:
+async def merge_limited(streams: Iterable[AsyncIterator[R]],
+                        limit: int = REQUEST_CONCURRENCY) -> AsyncIterator[Tuple[int, R]]:
+    """Consume streams concurrently, at most ``limit`` at a time, yielding (stream index, item) as items arrive"""
+    semaphore = asyncio.Semaphore(limit)
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    async def pump(index: int, stream: AsyncIterator[R]) -> None:
         try:
-            response = self.gemini_client.models.generate_content(
-                model=model,
-                contents=[prompt]
-            )
-            return response.text
+            async with semaphore:
+                async for item in stream:
+                    await queue.put((index, item, None))
         except Exception as e:
-            logging.error(f"Error calling Gemini API: {str(e)}")
-            raise e
+            await queue.put((index, done, e))
+            return
+        await queue.put((index, done, None))
+
+    tasks = [asyncio.create_task(pump(index, stream)) for index, stream in enumerate(streams)]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            index, item, error = await queue.get()
+            if error is not None:
+                raise error
+            if item is done:
+                remaining -= 1
+                continue
+            yield index, item
+    finally:
+        # The consumer stopped early or a stream failed: stop the others
+        for task in tasks:
+            task.cancel()
+
+
+def _http_client_options(
+    max_connections: Optional[int] = None,
+    max_keepalive_connections: Optional[int] = None,
+    timeout: Optional[float] = None,
+    connect_timeout: Optional[float] = None,
+) -> Dict[str, Any]:
+    if max_connections is None:
+        max_connections = int(os.environ.get("LLM_HTTP_MAX_CONNECTIONS", 20))
+    if max_keepalive_connections is None:
+        max_keepalive_connections = int(os.environ.get("LLM_HTTP_MAX_KEEPALIVE", 10))
+    if timeout is None:
+        timeout = float(os.environ.get("LLM_HTTP_TIMEOUT", 60))
+    if connect_timeout is None:
+        connect_timeout = float(os.environ.get("LLM_HTTP_CONNECT_TIMEOUT", 5))
+    return {
+        "limits": httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+        ),
+        "timeout": httpx.Timeout(timeout, connect=connect_timeout),
+    }
+
+
+def create_http_client(**options: Any) -> httpx.Client:
+    """Create a keep-alive HTTP client for LLM provider calls, configured from the environment"""
+    return httpx.Client(**_http_client_options(**options))
+
+
+def create_async_http_client(**options: Any) -> httpx.AsyncClient:
+    """Create the asyncio counterpart of create_http_client"""
+    return httpx.AsyncClient(**_http_client_options(**options))
+
+
+class LLMService:
+    def __init__(self, openai_api_key: str, gemini_api_key: str,
+                 http_client: Optional[httpx.Client] = None, cache: Optional[LLMCache] = None,
+                 async_http_client: Optional[httpx.AsyncClient] = None,
+                 max_concurrency: Optional[int] = None,
+                 providers: Optional[Dict[str, LLMProvider]] = None,
+                 metrics: Optional[LLMMetrics] = None):
+        """Create the provider clients.
+
+        The service is meant to live as long as the app: the clients keep
+        their connections open between calls. Pass ``http_client`` to share a
+        configured connection pool; otherwise one is created and owned here.
+        ``providers`` replaces the OpenAI and Gemini backends, for instance
+        with fakes (see create_llm_service). The OpenAI and Gemini clients
+        are built on first use, so the app runs without API keys and only
+        the calls to a provider without one fail, with
+        ProviderNotConfiguredError.
+        With a ``cache``, identical calls are answered without the network.
+        Calls to each provider go through a scheduler that adapts the number
+        in flight (up to ``max_concurrency``), retries transient errors and
+        fails fast while the provider is down. Every call is recorded in
+        ``metrics``, labelled with its llm_call_context.
+        """
+        self.cache = cache
+        self._owns_http_client = http_client is None
+        self.http_client = http_client if http_client is not None else create_http_client()
+        self._owns_async_http_client = async_http_client is None
+        self.async_http_client = async_http_client if async_http_client is not None else create_async_http_client()
+        self._provider_factories: Dict[str, Callable[[], LLMProvider]] = {}
+        if providers is None:
+            providers = {}
+            self._provider_factories = {
+                "openai": lambda: OpenAIProvider(
+                    self._api_key("openai", openai_api_key, "OPENAI_API_KEY"), self.http_client, self.async_http_client
+                ),
+                "gemini": lambda: GeminiProvider(
+                    self._api_key("gemini", gemini_api_key, "GEMINI_API_KEY"), self.http_client.timeout.read
+                ),
+            }
+        # Providers built so far
+        self.providers: Dict[str, LLMProvider] = dict(providers)
+        self._providers_lock = threading.Lock()
+        if max_concurrency is None:
+            max_concurrency = int(os.environ.get("LLM_MAX_CONCURRENCY", 16))
+        self.max_concurrency = max_concurrency
+        self.schedulers: Dict[str, ProviderScheduler] = {
+            provider: create_provider_scheduler(provider, max_concurrency)
+            for provider in {**self.providers, **self._provider_factories}
+        }
+        # Identical calls in flight at the same time share one upstream call
+        self.flights = SingleFlight()
+        # Responses of the streams in flight by event loop and flight key, for identical streams started meanwhile
+        self._streams: Dict[Tuple[asyncio.AbstractEventLoop, Tuple[str, bool]], asyncio.Future] = {}
+        self.metrics = metrics if metrics is not None else LLMMetrics()
+
+    @staticmethod
+    def _api_key(provider: str, api_key: Optional[str], variable: str) -> str:
+        if not api_key:
+            raise ProviderNotConfiguredError(provider, variable)
+        return api_key
+
+    def _provider(self, name: str) -> LLMProvider:
+        """Get a provider, building its client on first use"""
+        provider = self.providers.get(name)
+        if provider is None:
+            with self._providers_lock:
+                provider = self.providers.get(name)
+                if provider is None:
+                    provider = self.providers[name] = self._provider_factories[name]()
+        return provider
+
+    def close(self) -> None:
+        """Close the provider clients and their connection pools"""
+        for provider in list(self.providers.values()):
+            provider.close()
+        if self._owns_http_client:
+            self.http_client.close()
+
+    async def aclose(self) -> None:
+        """Close the async and sync provider clients"""
+        for provider in list(self.providers.values()):
+            await provider.aclose()
+        if self._owns_async_http_client:
+            await self.async_http_client.aclose()
+        self.close()
+
+    def cache_stats(self) -> Optional[Dict[str, Any]]:
+        """Get hit/miss counters of the response cache, None if caching is off"""
+        return self.cache.stats() if self.cache is not None else None
+
+    def provider_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Get the concurrency limit, retry and circuit breaker state, token usage and cost of each provider, and the coalesced calls"""
+        stats = {
+            provider: {**scheduler.stats(), **self.metrics.provider_usage(provider)}
+            for provider, scheduler in self.schedulers.items()
+        }
+        stats["coalescing"] = self.flights.stats()
+        return stats
+
+    def usage_stats(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """Get LLM calls, tokens and estimated cost by call site, language and user"""
+        return self.metrics.usage()
+
+    def render_metrics(self) -> str:
+        """Get the LLM call metrics and provider state in the Prometheus text format"""
+        lines = self.metrics.render()
+        lines += render_provider_stats({provider: scheduler.stats() for provider, scheduler in self.schedulers.items()})
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _json_params(json_mode: bool) -> Optional[Dict[str, Any]]:
+        """Cache key parameters of a call"""
+        return {"json": True} if json_mode and JSON_MODE else None
+
+    def _complete(self, provider: str, messages: Messages, model: str, json_mode: bool) -> Completion:
+        return self._provider(provider).complete(messages, model, json_mode and JSON_MODE)
+
+    async def _acomplete(self, provider: str, messages: Messages, model: str, json_mode: bool) -> Completion:
+        return await self._provider(provider).acomplete(messages, model, json_mode and JSON_MODE)
+
+    def _astream(self, provider: str, messages: Messages, model: str, json_mode: bool) -> AsyncIterator[str]:
+        return self._provider(provider).astream(messages, model, json_mode and JSON_MODE)
 
-    def call_gemini_with_history(self, history: List[ChatMessage], prompt: str, model: str = "gemini-2.0-flash") -> str:
+    @staticmethod
+    def _call_kind(model: str) -> str:
+        """Kind of a call for the adaptive limit, as calls of one site and model take about as long"""
+        return f"{current_labels().get('site', 'unknown')}/{model}"
+
+    def _scheduled(self, provider: str, model: str, call: Callable[[], Completion], cache: str) -> str:
+        """Make a call through the provider's scheduler and record its latency, attempts and usage"""
+        attempts = 0
+
+        def attempt() -> Completion:
+            nonlocal attempts
+            attempts += 1
+            return call()
+
+        started = time.perf_counter()
         try:
-            chat = self.gemini_client.chats.create(model=model)
-            for msg in history:
-                chat.send_message(msg.content)
-            response = chat.send_message(prompt)
-            return response.text
+            completion = self.schedulers[provider].call(attempt, self._call_kind(model))
         except Exception as e:
-            logging.error(f"Error calling Gemini API with history: {str(e)}")
-            raise e
+            self.metrics.record(provider, model, cache, time.perf_counter() - started, attempts, error=e)
+            raise
+        self.metrics.record(provider, model, cache, time.perf_counter() - started, attempts, completion)
+        return completion.text
+
+    async def _ascheduled(self, provider: str, model: str, call: Callable[[], Awaitable[Completion]], cache: str) -> str:
+        """Async variant of _scheduled"""
+        attempts = 0
 
-    def call_openai_llm(self, messages: List[Dict[str, Any]], model: str = "gpt-4o-mini") -> str:
+        def attempt() -> Awaitable[Completion]:
+            nonlocal attempts
+            attempts += 1
+            return call()
+
+        started = time.perf_counter()
         try:
-            completion = self.openai_client.chat.completions.create(
-                model=model,
-                messages=messages,
-                store=True
-            )
-            return completion.choices[0].message.content
+            completion = await self.schedulers[provider].acall(attempt, self._call_kind(model))
         except Exception as e:
-            logging.error(f"Error calling OpenAI API: {str(e)}")
-            raise e
\ No newline at end of file
+            self.metrics.record(provider, model, cache, time.perf_counter() - started, attempts, error=e)
+            raise
+        self.metrics.record(provider, model, cache, time.perf_counter() - started, attempts, completion)
+        return completion.text
+
+    def _cached(self, provider: str, model: str, payload: Any, use_cache: bool, variant: int,
+                call: Callable[[], Completion], json_mode: bool = False) -> str:
+        """Answer a call from the response cache, or make it through the provider's scheduler and cache the response.
+
+        Calls with a different ``variant`` are cached separately, so callers
+        that want several distinct answers to one prompt ask for slots 0..n-1,
+        and so are calls in JSON mode. Identical calls made while one is in
+        flight share its response, whether or not they ``use_cache``; that
+        only decides whether the cache is read and written.
+        """
+        key = LLMCache.make_key(model, payload, self._json_params(json_mode), variant=variant)
+        led = False
+
+        def lead() -> str:
+            nonlocal led
+            led = True
+            return self._cached_call(provider, model, key if use_cache else None, call)
+
+        started = time.perf_counter()
+        # A call that bypasses the cache does not take the answer of one that may come from it
+        response = self.flights.do((key, use_cache), lead)
+        if not led:
+            self.metrics.record(provider, model, "coalesced", time.perf_counter() - started)
+        return response
+
+    def _cached_call(self, provider: str, model: str, key: Optional[str], call: Callable[[], Completion]) -> str:
+        if self.cache is None or key is None:
+            return self._scheduled(provider, model, call, "bypass")
+        started = time.perf_counter()
+        response = self.cache.get(key)
+        if response is not None:
+            self.metrics.record(provider, model, "hit", time.perf_counter() - started)
+            return response
+        response = self._scheduled(provider, model, call, "miss")
+        if response:
+            self.cache.put(key, response, model)
+        return response
+
+    async def _acached(self, provider: str, model: str, payload: Any, use_cache: bool, variant: int,
+                       call: Callable[[], Awaitable[Completion]], json_mode: bool = False) -> str:
+        """Async variant of _cached"""
+        key = LLMCache.make_key(model, payload, self._json_params(json_mode), variant=variant)
+        led = False
+
+        def lead() -> Awaitable[str]:
+            nonlocal led
+            led = True
+            return self._acached_call(provider, model, key if use_cache else None, call)
+
+        started = time.perf_counter()
+        response = await self.flights.ado((key, use_cache), lead)
+        if not led:
+            self.metrics.record(provider, model, "coalesced", time.perf_counter() - started)
+        return response
+
+    async def _acached_call(self, provider: str, model: str, key: Optional[str],
+                            call: Callable[[], Awaitable[Completion]]) -> str:
+        if self.cache is None or key is None:
+            return await self._ascheduled(provider, model, call, "bypass")
+        started = time.perf_counter()
+        response = await asyncio.to_thread(self.cache.get, key)
+        if response is not None:
+            self.metrics.record(provider, model, "hit", time.perf_counter() - started)
+            return response
+        response = await self._ascheduled(provider, model, call, "miss")
+        if response:
+            await asyncio.to_thread(self.cache.put, key, response, model)
+        return response
+
+    async def _astreamed(self, provider: str, model: str, payload: Any, use_cache: bool, variant: int,
+                         messages: Messages, json_mode: bool = False,
+                         labels: Optional[Dict[str, str]] = None) -> AsyncIterator[str]:
+        """Streaming variant of _acached; a cached response arrives as a single chunk.
+
+        A stream started while an identical one is in flight waits for it and
+        gets its whole response as a single chunk too, unless it fails or is
+        closed early, in which case it makes its own call. Streams report no
+        token usage, so theirs is estimated from the text. ``labels`` are the
+        call labels of the caller, as a generator runs in the context of
+        whoever iterates it.
+        """
+        record = partial(self.metrics.record, provider, model, labels=labels)
+        flight_key = (LLMCache.make_key(model, payload, self._json_params(json_mode), variant=variant), use_cache)
+        key = flight_key[0] if self.cache is not None and use_cache else None
+        started = time.perf_counter()
+        if key is not None:
+            response = await asyncio.to_thread(self.cache.get, key)
+            if response is not None:
+                record("hit", time.perf_counter() - started)
+                yield response
+                return
+        loop = asyncio.get_running_loop()
+        flight = (loop, flight_key)
+        running = self._streams.get(flight)
+        if running is not None:
+            response = await asyncio.shield(running)
+            if response is not None:
+                record("coalesced", time.perf_counter() - started)
+                yield response
+                return
+        leading = flight not in self._streams
+        if leading:
+            self._streams[flight] = loop.create_future()
+        cache = "miss" if key is not None else "bypass"
+        attempts = 0
+
+        def stream() -> AsyncIterator[str]:
+            nonlocal attempts
+            attempts += 1
+            return self._astream(provider, messages, model, json_mode)
+
+        parts = []
+        response = None
+        try:
+            try:
+                async for delta in self.schedulers[provider].astream(stream):
+                    parts.append(delta)
+                    yield delta
+            except BaseException as e:
+                # Failed, or closed early by the consumer
+                record(cache, time.perf_counter() - started, attempts, error=e)
+                raise
+            response = "".join(parts)
+        finally:
+            if leading:
+                # Streams that waited for this one make their own call if it did not complete
+                self._streams.pop(flight).set_result(response)
+        prompt_tokens = sum(estimate_tokens(str(message["content"])) for message in messages)
+        record(cache, time.perf_counter() - started, attempts,
+                Completion(response, prompt_tokens, estimate_tokens(response)))
+        if key is not None and response:
+            await asyncio.to_thread(self.cache.put, key, response, model)
+
+    def call_gemini_flash(self, prompt: str, model: str = "gemini-2.0-flash",
+                          use_cache: bool = True, variant: int = 0, json_mode: bool = False) -> str:
+        """Call Gemini; with ``json_mode`` the response is constrained to JSON"""
+        messages = [{"role": "user", "content": prompt}]
+        return self._cached(
+            "gemini", model, prompt, use_cache, variant,
+            lambda: self._complete("gemini", messages, model, json_mode), json_mode
+        )
+
+    async def acall_gemini_flash(self, prompt: str, model: str = "gemini-2.0-flash",
+                                 use_cache: bool = True, variant: int = 0, json_mode: bool = False) -> str:
+        messages = [{"role": "user", "content": prompt}]
+        return await self._acached(
+            "gemini", model, prompt, use_cache, variant,
+            lambda: self._acomplete("gemini", messages, model, json_mode), json_mode
+        )
+
+    def astream_gemini_flash(self, prompt: str, model: str = "gemini-2.0-flash",
+                             use_cache: bool = True, variant: int = 0, json_mode: bool = False) -> AsyncIterator[str]:
+        """Stream the response text of a Gemini call as it is generated"""
+        messages = [{"role": "user", "content": prompt}]
+        return self._astreamed("gemini", model, prompt, use_cache, variant, messages, json_mode, current_labels())
+
+    @staticmethod
+    def _history_messages(history: List[ChatMessage], prompt: str, summary: Optional[str]) -> Messages:
+        """Turn a chat history, its summary and the new prompt into chat messages"""
+        messages = []
+        if summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+        for message in history:
+            role = "assistant" if message.role in ("assistant", "model") else "user"
+            messages.append({"role": role, "content": message.content})
+        messages.append({"role": "user", "content": prompt})
+        return messages
+
+    def call_gemini_with_history(self, history: List[ChatMessage], prompt: str, model: str = "gemini-2.0-flash",
+                                 summary: Optional[str] = None) -> str:
+        """Answer a prompt in the context of a chat history with a single Gemini call.
+
+        ``summary`` stands in for the turns left out of ``history`` (see ChatContextManager).
+        """
+        messages = self._history_messages(history, prompt, summary)
+        return self._scheduled("gemini", model, lambda: self._complete("gemini", messages, model, False), "bypass")
+
+    async def acall_gemini_with_history(self, history: List[ChatMessage], prompt: str,
+                                        model: str = "gemini-2.0-flash", summary: Optional[str] = None) -> str:
+        messages = self._history_messages(history, prompt, summary)
+        return await self._ascheduled("gemini", model, lambda: self._acomplete("gemini", messages, model, False), "bypass")
+
+    def call_openai_llm(self, messages: List[Dict[str, Any]], model: str = "gpt-4o-mini",
+                        use_cache: bool = True, variant: int = 0, json_mode: bool = False) -> str:
+        """Call OpenAI; with ``json_mode`` the response is a JSON object (the messages must mention JSON)"""
+        return self._cached(
+            "openai", model, messages, use_cache, variant,
+            lambda: self._complete("openai", messages, model, json_mode), json_mode
+        )
+
+    async def acall_openai_llm(self, messages: List[Dict[str, Any]], model: str = "gpt-4o-mini",
+                               use_cache: bool = True, variant: int = 0, json_mode: bool = False) -> str:
+        return await self._acached(
+            "openai", model, messages, use_cache, variant,
+            lambda: self._acomplete("openai", messages, model, json_mode), json_mode
+        )
+
+    def astream_openai_llm(self, messages: List[Dict[str, Any]], model: str = "gpt-4o-mini",
+                           use_cache: bool = True, variant: int = 0, json_mode: bool = False) -> AsyncIterator[str]:
+        """Stream the response text of an OpenAI call as it is generated"""
+        return self._astreamed("openai", model, messages, use_cache, variant, messages, json_mode, current_labels())
+
+
+def create_llm_service() -> LLMService:
+    """Create the LLM service with the backend (LLM_BACKEND), API keys and response cache settings from the environment"""
+    backend = os.environ.get("LLM_BACKEND", "live")
+    providers = None
+    if backend == "fake":
+        from .fake_llm_provider import create_fake_provider
+        providers = {provider: create_fake_provider(provider) for provider in ("openai", "gemini")}
+        logging.info("Using the fake LLM backend")
+    elif backend != "live":
+        raise ValueError(f"Unknown LLM backend: {backend}")
+    else:
+        for variable in ("OPENAI_API_KEY", "GEMINI_API_KEY"):
+            if not os.environ.get(variable):
+                logging.warning(f"{variable} is not set; LLM calls that need it will fail")
+    return LLMService(
+        openai_api_key=os.environ.get("OPENAI_API_KEY"),
+        gemini_api_key=os.environ.get("GEMINI_API_KEY"),
+        cache=create_llm_cache(),
+        providers=providers,
+    )
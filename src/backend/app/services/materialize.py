@@ -0,0 +1,156 @@
+import os
+import threading
+from datetime import date, datetime, time, timedelta
+from enum import Enum
+from typing import Any, Callable, Dict, Generic, Type, TypeVar, Union, get_args, get_origin
+from pydantic import BaseModel, ValidationError
+from pydantic.datetime_parse import parse_date, parse_datetime, parse_duration, parse_time
+from pydantic.fields import ModelField, SHAPE_DICT, SHAPE_LIST, SHAPE_MAPPING, SHAPE_SINGLETON
+from pydantic.utils import lenient_issubclass
+
+T = TypeVar('T', bound=BaseModel)
+
+# Debug switch: validate every record read from storage like the write path does
+VALIDATE_READS = os.environ.get("STORAGE_VALIDATE_READS", "").lower() in ("1", "true", "yes")
+
+_PLAIN_TYPES = (str, int, float, bool, dict, list, Any, type(None))
+_PARSERS = {datetime: parse_datetime, date: parse_date, time: parse_time, timedelta: parse_duration}
+
+
+def _is_plain(tp: Any) -> bool:
+    """Whether values of a type are stored exactly as they are used"""
+    if tp in _PLAIN_TYPES:
+        return True
+    origin = get_origin(tp)
+    if origin in (list, dict, Union):
+        return all(_is_plain(arg) for arg in get_args(tp))
+    return False
+
+
+def _clone(value: Any) -> Any:
+    """Copy the containers of a JSON value so models never share them with the cache"""
+    if isinstance(value, dict):
+        return {k: _clone(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_clone(v) for v in value]
+    return value
+
+
+def _identity(value: Any) -> Any:
+    return value
+
+
+class Materializer(Generic[T]):
+    """Builds models from trusted stored documents without validating them.
+
+    Everything in storage was validated when it was written, so documents
+    are turned into models with ``construct()``. Each field gets a converter
+    chosen once per model: enums and datetimes are parsed back from their
+    JSON form, nested models are materialized recursively and containers are
+    copied. Fields of any other type fall back to pydantic's own validation.
+    """
+
+    def __init__(self, model_class: Type[T]):
+        self.model_class = model_class
+        self.fields: Dict[str, ModelField] = model_class.__fields__
+        self.required = tuple(name for name, field in self.fields.items() if field.required)
+        self.converters: Dict[str, Callable[[Any], Any]] = {
+            name: self._converter(field) for name, field in self.fields.items()
+        }
+
+    def _converter(self, field: ModelField) -> Callable[[Any], Any]:
+        type_ = field.type_
+
+        def validate(value: Any) -> Any:
+            return self._validate(field, value)
+
+        if field.shape == SHAPE_SINGLETON and field.sub_fields:
+            # Unions need pydantic to pick the matching type
+            return validate
+        if lenient_issubclass(type_, BaseModel):
+            if field.shape == SHAPE_SINGLETON:
+                return lambda value: materializer(type_)(value)
+            if field.shape == SHAPE_LIST:
+                return lambda value: [materializer(type_)(v) for v in value]
+        elif field.shape == SHAPE_SINGLETON:
+            if lenient_issubclass(type_, Enum):
+                members = type_._value2member_map_
+                return lambda value: members[value] if value in members else type_(value)
+            if type_ in _PARSERS:
+                return _PARSERS[type_]
+            if type_ in (str, int, float, bool, Any):
+                return _identity
+            if _is_plain(type_):
+                return _clone
+        elif field.shape in (SHAPE_LIST, SHAPE_DICT, SHAPE_MAPPING) and _is_plain(type_):
+            return _clone
+        return validate
+
+    def _validate(self, field: ModelField, value: Any) -> Any:
+        value, errors = field.validate(value, {}, loc=field.name, cls=self.model_class)
+        if errors:
+            raise ValidationError([errors], self.model_class)
+        return value
+
+    def field_value(self, name: str, doc: Dict[str, Any]) -> Any:
+        """Get the model value of one field of a stored document"""
+        if name not in doc:
+            return self.fields[name].get_default()
+        value = doc[name]
+        return self.converters[name](value) if value is not None else None
+
+    def __call__(self, doc: Dict[str, Any]) -> T:
+        if VALIDATE_READS or any(name not in doc for name in self.required):
+            # Missing required fields get pydantic's usual error
+            return self.model_class(**doc)
+        values = {
+            name: convert(doc[name]) if doc[name] is not None else None
+            for name, convert in self.converters.items() if name in doc
+        }
+        return self.model_class.construct(**values)
+
+
+_materializers: Dict[type, Materializer] = {}
+_materializers_lock = threading.Lock()
+
+
+def materializer(model_class: Type[T]) -> Materializer[T]:
+    """Get the shared materializer of a model class"""
+    result = _materializers.get(model_class)
+    if result is None:
+        with _materializers_lock:
+            result = _materializers.get(model_class)
+            if result is None:
+                result = _materializers[model_class] = Materializer(model_class)
+    return result
+
+
+def materialize(model_class: Type[T], doc: Dict[str, Any]) -> T:
+    """Build a model from a stored document"""
+    return materializer(model_class)(doc)
+
+
+class LazyRecord:
+    """Read-only attribute view of a stored document.
+
+    Filters can test records through it as if they were models; a field is
+    only converted when it is accessed and no model is built.
+    """
+
+    __slots__ = ("_doc", "_materializer", "_values")
+
+    def __init__(self, doc: Dict[str, Any], model_materializer: Materializer):
+        self._doc = doc
+        self._materializer = model_materializer
+        self._values: Dict[str, Any] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        values = self._values
+        if name not in values:
+            if name not in self._materializer.fields:
+                raise AttributeError(name)
+            values[name] = self._materializer.field_value(name, self._doc)
+        return values[name]
+
+    def __repr__(self) -> str:
+        return f"LazyRecord({self._materializer.model_class.__name__}, {self._doc!r})"
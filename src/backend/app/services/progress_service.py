@@ -1,10 +1,16 @@
-from typing import List, Optional
+from typing import Callable, List, Optional, TypeVar
 from datetime import datetime, timedelta
+import logging
 import uuid
-from .storage_service import StorageService
+from .storage_service import StorageService, VersionConflictError
 from ..models.progress import UserProgress, Achievement
 from ..models.exercise import Exercise, ExerciseStatus
 
+R = TypeVar('R')
+
+# How often a progress update is retried when another worker changed the record first
+MAX_CONFLICT_RETRIES = 5
+
 class ProgressService:
     """Service to handle user progress and gamification"""
     
@@ -16,13 +22,40 @@ class ProgressService:
         progress = self.storage.get_item("progress", user_id, UserProgress)
         if not progress:
             progress = UserProgress(user_id=user_id)
-            self.storage.save_item("progress", progress)
+            try:
+                self.storage.save_item("progress", progress, expected_version=0)
+            except VersionConflictError:
+                # Another worker created the record first
+                progress = self.storage.get_item("progress", user_id, UserProgress)
         return progress
     
+    def _retry_on_conflict(self, update: Callable[[], R]) -> R:
+        """Run a read-modify-write of progress again if it lost a compare-and-swap"""
+        for attempt in range(MAX_CONFLICT_RETRIES):
+            try:
+                return update()
+            except VersionConflictError as e:
+                if attempt == MAX_CONFLICT_RETRIES - 1:
+                    raise
+                logging.info(f"Retrying progress update after conflict: {str(e)}")
+    
+    def _load_progress(self, user_id: str):
+        """Get progress and its stored version, with a fresh record if not found"""
+        progress, version = self.storage.get_item_with_version("progress", user_id, UserProgress)
+        return progress or UserProgress(user_id=user_id), version
+    
     def update_streak(self, user_id: str) -> UserProgress:
         """Update user streak based on last activity date"""
-        progress = self.get_user_progress(user_id)
-        
+        return self._retry_on_conflict(lambda: self._update_streak(user_id))
+    
+    def _update_streak(self, user_id: str) -> UserProgress:
+        progress, version = self._load_progress(user_id)
+        self._advance_streak(progress)
+        self.storage.save_item("progress", progress, expected_version=version)
+        return progress
+    
+    def _advance_streak(self, progress: UserProgress) -> None:
+        """Advance the streak of a progress record for activity happening now"""
         today = datetime.now().date()
         last_date = progress.last_activity_date.date() if progress.last_activity_date else None
         
@@ -41,16 +74,18 @@ class ProgressService:
             progress.streak = 1
         
         progress.last_activity_date = datetime.now()
-        self.storage.save_item("progress", progress)
         
         # Check for streak achievements
         self._check_streak_achievements(progress)
-        
-        return progress
     
     def complete_exercise(self, user_id: str, exercise: Exercise) -> UserProgress:
         """Mark an exercise as completed and update progress"""
-        progress = self.get_user_progress(user_id)
+        return self._retry_on_conflict(lambda: self._complete_exercise(user_id, exercise))
+    
+    def _complete_exercise(self, user_id: str, exercise: Exercise) -> UserProgress:
+        # One compare-and-swap write: it fails if another worker updated this
+        # user's progress since it was read, and the whole update is retried
+        progress, version = self._load_progress(user_id)
         
         # Add to completed exercises if not already there
         if exercise.id not in progress.completed_exercises:
@@ -97,12 +132,12 @@ class ProgressService:
                 stats["listening"] += len(exercise.content.get("items", []))
                 
             # Update streak
-            self.update_streak(user_id)
+            self._advance_streak(progress)
             
             # Check for achievements
             self._check_completion_achievements(progress)
             
-            self.storage.save_item("progress", progress)
+            self.storage.save_item("progress", progress, expected_version=version)
         
         return progress
     
@@ -0,0 +1,173 @@
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import logging
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from .codecs import decode, json_codec
+from .collection_cache import FileStamp, file_stamp
+
+# Snapshot layout:
+#   MAGIC
+#   records        length (u32) + encoded document, one per item
+#   slots          position (u64) of each index entry, sorted by id
+#   index entries  record offset (u64), record length (u32), id length (u16), id (utf-8)
+#   footer         source stamp (3 x u64), slots position (u64), count (u32), MAGIC
+MAGIC = b"TRS1"
+_LENGTH = struct.Struct("<I")
+_SLOT = struct.Struct("<Q")
+_ENTRY = struct.Struct("<QIH")
+_FOOTER = struct.Struct("<QQQQI4s")
+
+
+class RecordSnapshot:
+    """Read-only, memory-mapped snapshot of a collection.
+
+    Looking up an id is a binary search over the sorted slot table followed
+    by decoding a single record, so the rest of the file is never parsed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.file_stamp = file_stamp(path)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < len(MAGIC) + _FOOTER.size or self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a record snapshot")
+        ino, mtime_ns, size, self._slots, self.count, magic = _FOOTER.unpack_from(
+            self._map, len(self._map) - _FOOTER.size
+        )
+        if magic != MAGIC:
+            raise ValueError(f"{path} is truncated")
+        self.source_stamp: FileStamp = (ino, mtime_ns, size)
+
+    def _entry(self, index: int) -> Tuple[bytes, int, int]:
+        (position,) = _SLOT.unpack_from(self._map, self._slots + index * _SLOT.size)
+        offset, length, id_length = _ENTRY.unpack_from(self._map, position)
+        start = position + _ENTRY.size
+        return self._map[start:start + id_length], offset, length
+
+    def find(self, item_id: str) -> Optional[bytes]:
+        """Get the encoded record of an id, or None if it is not in the snapshot"""
+        key = item_id.encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            entry_id, offset, length = self._entry(middle)
+            if entry_id < key:
+                low = middle + 1
+            elif entry_id > key:
+                high = middle
+            else:
+                return self._map[offset:offset + length]
+        return None
+
+    def get(self, item_id: str) -> Optional[Dict[str, Any]]:
+        """Decode the record of an id"""
+        raw = self.find(item_id)
+        return decode(raw) if raw is not None else None
+
+    def records(self) -> Iterator[Tuple[str, bytes]]:
+        """Iterate over (id, encoded record) pairs in id order"""
+        for index in range(self.count):
+            entry_id, offset, length = self._entry(index)
+            yield entry_id.decode('utf-8'), self._map[offset:offset + length]
+
+
+def write_snapshot(path: str, source_stamp: FileStamp, records: Iterable[Tuple[str, bytes]]) -> None:
+    """Write encoded records as a snapshot next to ``path`` and move it into place"""
+    keyed = sorted((item_id.encode('utf-8'), raw) for item_id, raw in records)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=os.path.basename(path), suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            position = len(MAGIC)
+            offsets: List[int] = []
+            for _, raw in keyed:
+                f.write(_LENGTH.pack(len(raw)))
+                f.write(raw)
+                offsets.append(position + _LENGTH.size)
+                position += _LENGTH.size + len(raw)
+
+            slots_position = position
+            entry_position = slots_position + len(keyed) * _SLOT.size
+            for key, _ in keyed:
+                f.write(_SLOT.pack(entry_position))
+                entry_position += _ENTRY.size + len(key)
+            for (key, raw), offset in zip(keyed, offsets):
+                f.write(_ENTRY.pack(offset, len(raw), len(key)))
+                f.write(key)
+            f.write(_FOOTER.pack(*source_stamp, slots_position, len(keyed), MAGIC))
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class SnapshotStore:
+    """Opens and maintains the record snapshots of a storage directory.
+
+    A snapshot records the stamp of the collection file it was built from
+    and is only used while that file is unchanged, so a stale snapshot is
+    never served; it is rebuilt instead.
+    """
+
+    def __init__(self):
+        self._open: Dict[str, RecordSnapshot] = {}
+        self._lock = threading.Lock()
+
+    def open(self, path: str) -> Optional[RecordSnapshot]:
+        """Get the current snapshot at ``path``, reopening it if the file was replaced"""
+        stamp = file_stamp(path)
+        if stamp is None:
+            return None
+        snapshot = self._open.get(path)
+        if snapshot is not None and snapshot.file_stamp == stamp:
+            return snapshot
+        try:
+            snapshot = RecordSnapshot(path)
+        except (OSError, ValueError, struct.error) as e:
+            logging.warning(f"Ignoring unreadable snapshot {path}: {str(e)}")
+            return None
+        # Replaced maps are not closed: readers may still hold slices of them
+        with self._lock:
+            self._open[path] = snapshot
+        return snapshot
+
+    def lookup(self, path: str, source_stamp: FileStamp) -> Optional[RecordSnapshot]:
+        """Get the snapshot at ``path`` if it was built from the given source file"""
+        snapshot = self.open(path)
+        if snapshot is None or snapshot.source_stamp != source_stamp:
+            return None
+        return snapshot
+
+    def rebuild(self, path: str, source_stamp: FileStamp, data: Dict[str, Dict],
+                previous_stamp: Optional[FileStamp] = None,
+                changed: Optional[Iterable[str]] = None) -> None:
+        """Write the snapshot of a collection.
+
+        If the snapshot on disk was built from ``previous_stamp``, only the
+        ``changed`` records are encoded again and the others are copied over
+        as they are.
+        """
+        previous = self.lookup(path, previous_stamp) if previous_stamp and changed is not None else None
+        if previous is None:
+            records = [(item_id, json_codec.dumps(doc)) for item_id, doc in data.items()]
+        else:
+            changed = set(changed)
+            records = [
+                (item_id, raw) for item_id, raw in previous.records()
+                if item_id not in changed and item_id in data
+            ]
+            records.extend(
+                (item_id, json_codec.dumps(data[item_id])) for item_id in changed if item_id in data
+            )
+        write_snapshot(path, source_stamp, records)
+
+
+# Process-wide snapshot store used by StorageService unless another one is injected
+shared_snapshots = SnapshotStore()
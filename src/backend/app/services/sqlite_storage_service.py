@@ -0,0 +1,271 @@
+import argparse
+import glob
+import os
+import re
+import sqlite3
+import threading
+import logging
+from typing import Dict, List, Optional, Type, Any, Iterable, Tuple
+from pydantic import BaseModel
+from .codecs import KNOWN_EXTENSIONS, json_codec
+from .storage_service import StorageService, Changes, ExpectedVersions, T, check_versions, versioned
+from .materialize import materializer
+from .indexing import matches, normalize_value, normalize_where, sort_key
+
+# Hot fields stored as indexed columns next to the JSON document
+INDEXED_COLUMNS: Dict[str, Tuple[str, ...]] = {
+    "exercises": ("language", "type", "status", "difficulty"),
+    "cultural_notes": ("language",),
+    "idioms": ("language",),
+    "fun_facts": ("language",),
+}
+
+_COLLECTION_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+# One connection per (thread, database file)
+_local = threading.local()
+_schema_lock = threading.Lock()
+_created_tables: Dict[str, set] = {}
+
+
+class SQLiteStorageService(StorageService):
+    """Storage engine backed by a SQLite database.
+
+    Each collection is a table holding the full document as JSON plus the
+    hot fields from INDEXED_COLUMNS as indexed columns. The database runs in
+    WAL mode so readers never block the writer, and every thread gets its own
+    connection.
+    """
+
+    def __init__(self, storage_dir: str = "data", database_path: Optional[str] = None):
+        super().__init__(storage_dir)
+        self.database_path = os.path.abspath(
+            database_path or os.environ.get("SQLITE_DATABASE") or os.path.join(storage_dir, "tandem.db")
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        """Get the connection of the current thread"""
+        connections = getattr(_local, "connections", None)
+        if connections is None:
+            connections = _local.connections = {}
+        conn = connections.get(self.database_path)
+        if conn is None:
+            conn = sqlite3.connect(self.database_path, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            connections[self.database_path] = conn
+        return conn
+
+    def _table(self, collection: str) -> str:
+        """Get the quoted table name of a collection, creating the table if needed"""
+        if not _COLLECTION_NAME.match(collection):
+            raise ValueError(f"Invalid collection name: {collection}")
+
+        created = _created_tables.setdefault(self.database_path, set())
+        if collection not in created:
+            with _schema_lock:
+                if collection not in created:
+                    self._create_table(collection)
+                    created.add(collection)
+        return f'"{collection}"'
+
+    def _create_table(self, collection: str) -> None:
+        columns = INDEXED_COLUMNS.get(collection, ())
+        column_defs = "".join(f", {column} TEXT" for column in columns)
+        conn = self._connection()
+        conn.execute(
+            f'CREATE TABLE IF NOT EXISTS "{collection}" '
+            f'(id TEXT PRIMARY KEY, doc TEXT NOT NULL{column_defs})'
+        )
+        for column in columns:
+            conn.execute(
+                f'CREATE INDEX IF NOT EXISTS "idx_{collection}_{column}" '
+                f'ON "{collection}" ({column})'
+            )
+
+    def _row(self, collection: str, item_id: str, item_dict: Dict[str, Any]) -> Tuple[Any, ...]:
+        columns = INDEXED_COLUMNS.get(collection, ())
+        doc = json_codec.dumps(item_dict).decode('utf-8')
+        return (item_id, doc) + tuple(normalize_value(item_dict.get(column)) for column in columns)
+
+    def _upsert_sql(self, collection: str) -> str:
+        table = self._table(collection)
+        columns = ("id", "doc") + INDEXED_COLUMNS.get(collection, ())
+        placeholders = ", ".join("?" for _ in columns)
+        updates = ", ".join(f"{column} = excluded.{column}" for column in columns[1:])
+        return (
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders}) "
+            f"ON CONFLICT(id) DO UPDATE SET {updates}"
+        )
+
+    def _upsert(self, collection: str, rows: Iterable[Tuple[Any, ...]], replace: bool = False) -> None:
+        """Insert or update rows in one transaction, optionally clearing the table first"""
+        table = self._table(collection)
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if replace:
+                conn.execute(f"DELETE FROM {table}")
+            conn.executemany(self._upsert_sql(collection), rows)
+
+    def _load_collection(self, collection: str) -> Dict:
+        """Load a collection as a dict of documents"""
+        table = self._table(collection)
+        rows = self._connection().execute(f"SELECT id, doc FROM {table}")
+        return {item_id: json_codec.loads(doc) for item_id, doc in rows}
+
+    def _save_collection(self, collection: str, data: Dict) -> None:
+        """Replace the contents of a collection"""
+        rows = [self._row(collection, item_id, item) for item_id, item in data.items()]
+        self._upsert(collection, rows, replace=True)
+
+    def _get_document(self, collection: str, item_id: str) -> Optional[Dict]:
+        table = self._table(collection)
+        row = self._connection().execute(
+            f"SELECT doc FROM {table} WHERE id = ?", (item_id,)
+        ).fetchone()
+        return json_codec.loads(row[0]) if row is not None else None
+
+    def _all_documents(self, collection: str) -> List[Dict]:
+        table = self._table(collection)
+        rows = self._connection().execute(f"SELECT doc FROM {table}")
+        return [json_codec.loads(doc) for (doc,) in rows]
+
+    def _commit_changes(self, changes: Changes, expected: Optional[ExpectedVersions] = None) -> None:
+        """Write changes to one or more collections in a single transaction.
+
+        BEGIN IMMEDIATE takes the database write lock up front, so version
+        checks and writes cannot interleave with another process.
+        """
+        expected = expected or {}
+        tables = {collection: self._table(collection) for collection in changes}
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for collection, collection_changes in changes.items():
+                table = tables[collection]
+                item_ids = set(collection_changes) | set(expected.get(collection, {}))
+                current = {item_id: self._get_document(collection, item_id) for item_id in item_ids}
+                check_versions(collection, current, expected.get(collection))
+
+                rows = [
+                    self._row(collection, item_id, versioned(doc, current[item_id]))
+                    for item_id, doc in collection_changes.items() if doc is not None
+                ]
+                deleted = [(item_id,) for item_id, doc in collection_changes.items() if doc is None]
+                if rows:
+                    conn.executemany(self._upsert_sql(collection), rows)
+                if deleted:
+                    conn.executemany(f"DELETE FROM {table} WHERE id = ?", deleted)
+
+    def _select(self, collection: str, where: Dict[str, Any], sort_by: Optional[str] = None,
+                descending: bool = False, limit: Optional[int] = None, offset: int = 0) -> List[Dict]:
+        """Select documents, pushing conditions on indexed columns into SQL.
+
+        Any other condition, and sorting on a non-column field, is applied to
+        the decoded documents.
+        """
+        table = self._table(collection)
+        columns = set(INDEXED_COLUMNS.get(collection, ())) | {"id"}
+        sql_where = {field: value for field, value in where.items() if field in columns}
+        doc_where = {field: value for field, value in where.items() if field not in columns}
+
+        sql = f"SELECT doc FROM {table}"
+        params: List[Any] = []
+        if sql_where:
+            sql += " WHERE " + " AND ".join(f"{field} = ?" for field in sql_where)
+            params.extend(sql_where.values())
+
+        sort_in_sql = sort_by is None or sort_by in columns
+        if sort_by and sort_in_sql:
+            sql += f" ORDER BY {sort_by} IS NULL, {sort_by} {'DESC' if descending else 'ASC'}"
+        if not doc_where and sort_in_sql and (limit is not None or offset):
+            sql += " LIMIT ? OFFSET ?"
+            params.extend([limit if limit is not None else -1, offset])
+            offset, limit = 0, None
+
+        docs = (json_codec.loads(doc) for (doc,) in self._connection().execute(sql, params))
+        if doc_where:
+            docs = (doc for doc in docs if matches(doc, doc_where))
+        docs = list(docs)
+        if sort_by and not sort_in_sql:
+            docs.sort(key=sort_key(sort_by), reverse=descending)
+        end = offset + limit if limit is not None else None
+        return docs[offset:end]
+
+    def _find_documents(self, collection: str, model_class: Type[BaseModel],
+                        where: Dict[str, Any]) -> List[Dict]:
+        return self._select(collection, where)
+
+    def _page_documents(self, collection: str, model_class: Type[BaseModel],
+                        where: Dict[str, Any], limit: int, after: Optional[str]) -> List[Dict]:
+        """Select a page ordered by the primary key, seeking past ``after`` in SQL"""
+        if self._pending(collection):
+            return super()._page_documents(collection, model_class, where, limit, after)
+        table = self._table(collection)
+        columns = set(INDEXED_COLUMNS.get(collection, ()))
+        sql_where = {field: value for field, value in where.items() if field in columns}
+        doc_where = {field: value for field, value in where.items() if field not in columns}
+
+        conditions = [f"{field} = ?" for field in sql_where]
+        params: List[Any] = list(sql_where.values())
+        if after is not None:
+            conditions.append("id > ?")
+            params.append(after)
+        sql = f"SELECT doc FROM {table}"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY id"
+
+        docs = []
+        for (doc,) in self._connection().execute(sql, params):
+            doc = json_codec.loads(doc)
+            if matches(doc, doc_where):
+                docs.append(doc)
+                if len(docs) == limit:
+                    break
+        return docs
+
+    def find_items(self, collection: str, model_class: Type[T],
+                   where: Optional[Dict[str, Any]] = None,
+                   sort_by: Optional[str] = None, descending: bool = False,
+                   limit: Optional[int] = None, offset: int = 0) -> List[T]:
+        """Find items whose fields equal the values in ``where``, sorting and paging in SQL"""
+        if self._pending(collection):
+            return super().find_items(collection, model_class, where, sort_by, descending, limit, offset)
+        docs = self._select(collection, normalize_where(where), sort_by, descending, limit, offset)
+        build = materializer(model_class)
+        return [build(doc) for doc in docs]
+
+    def migrate_json_collections(self, source_dir: str) -> Dict[str, int]:
+        """Import every collection file of a JSON storage directory, whatever its codec"""
+        source = StorageService(source_dir)
+        imported = {}
+        file_paths = sorted(
+            path for extension in KNOWN_EXTENSIONS
+            for path in glob.glob(os.path.join(source_dir, f"*{extension}"))
+        )
+        for file_path in file_paths:
+            collection = os.path.splitext(os.path.basename(file_path))[0]
+            if collection in imported:
+                continue
+            if not _COLLECTION_NAME.match(collection):
+                logging.warning(f"Skipping {file_path}: not a valid collection name")
+                continue
+            data = source._load_collection(collection)
+            self._upsert(collection, (self._row(collection, item_id, item) for item_id, item in data.items()))
+            imported[collection] = len(data)
+            logging.info(f"Imported {len(data)} items into {collection}")
+        return imported
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import JSON collections into SQLite storage")
+    parser.add_argument("--source", default="data", help="directory holding the <collection>.json files")
+    parser.add_argument("--database", default=None, help="SQLite database file (default: <source>/tandem.db)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    storage = SQLiteStorageService(args.source, database_path=args.database)
+    counts = storage.migrate_json_collections(args.source)
+    print(f"Imported {sum(counts.values())} items from {len(counts)} collections into {storage.database_path}")
@@ -1,81 +1,518 @@
-import json
+import heapq
 import os
-from typing import Dict, List, TypeVar, Type, Optional, Union, Any
+import tempfile
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, TypeVar, Type, Optional, Union, Any, Iterable, Iterator, Tuple
 from pydantic import BaseModel
 import logging
+from .codecs import Codec, KNOWN_EXTENSIONS, decode, get_codec
+from .collection_cache import CollectionCache, FileStamp, file_stamp, shared_cache
+from .record_snapshot import SnapshotStore, shared_snapshots
+from .file_lock import file_locks
+from .materialize import LazyRecord, materialize, materializer
+from .indexing import (
+    CollectionIndexes, indexed_fields, matches, normalize_where, page_documents, select_documents, sort_key
+)
 
 # Define a generic type for our models
 T = TypeVar('T', bound=BaseModel)
 
+# Pending changes per collection: item id -> document, None marks a deletion
+Changes = Dict[str, Dict[str, Optional[Dict]]]
+# Versions items must still have when changes commit: collection -> item id -> version
+ExpectedVersions = Dict[str, Dict[str, int]]
+
+# Stored documents carry a version that is bumped on every save
+VERSION_FIELD = "_version"
+
+# Read-heavy collections that keep a memory-mapped snapshot for single-record reads
+DEFAULT_SNAPSHOT_COLLECTIONS = "users,exercises,cultural_notes"
+
+
+class StorageError(Exception):
+    """Raised when stored data cannot be read or written"""
+
+
+class VersionConflictError(StorageError):
+    """Raised when an item changed since the version a writer expected"""
+
+
+def item_id_of(item_dict: Dict[str, Any]) -> str:
+    """Get the storage key of an item"""
+    item_id = item_dict.get('id', None) or item_dict.get('user_id', None)
+    if not item_id:
+        raise ValueError("Item must have 'id' or 'user_id' field")
+    return item_id
+
+
+def version_of(doc: Optional[Dict[str, Any]]) -> int:
+    """Get the version of a stored document, 0 if it does not exist"""
+    if doc is None:
+        return 0
+    return doc.get(VERSION_FIELD, 1)
+
+
+def check_versions(collection: str, current: Dict[str, Optional[Dict]],
+                   expected: Optional[Dict[str, int]]) -> None:
+    """Compare stored versions with the expected ones"""
+    for item_id, version in (expected or {}).items():
+        actual = version_of(current.get(item_id))
+        if actual != version:
+            raise VersionConflictError(
+                f"{collection}/{item_id} is at version {actual}, expected {version}"
+            )
+
+
+def versioned(doc: Dict[str, Any], previous: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Copy a document with its version bumped past the previous one"""
+    return dict(doc, **{VERSION_FIELD: version_of(previous) + 1})
+
+
+class StorageBatch:
+    """Changes buffered by StorageService.batch() until the batch commits"""
+
+    def __init__(self, storage: "StorageService"):
+        self.storage = storage
+        self.changes: Changes = {}
+        self.expected: ExpectedVersions = {}
+
+    def pending(self, collection: str) -> Optional[Dict[str, Optional[Dict]]]:
+        return self.changes.get(collection)
+
+
+_active_batch: ContextVar[Optional[StorageBatch]] = ContextVar("storage_batch", default=None)
+
+
 class StorageService:
     """Service to handle local storage for the application"""
-    
-    def __init__(self, storage_dir: str = "data"):
+
+    def __init__(self, storage_dir: str = "data", cache: Optional[CollectionCache] = None,
+                 codec: Optional[Codec] = None, snapshot_collections: Optional[Iterable[str]] = None,
+                 snapshots: Optional[SnapshotStore] = None):
         """Initialize storage service with directory path"""
         self.storage_dir = storage_dir
+        self.cache = cache if cache is not None else shared_cache
+        self.codec = codec if codec is not None else get_codec()
+        if snapshot_collections is None:
+            names = os.environ.get("STORAGE_SNAPSHOT_COLLECTIONS", DEFAULT_SNAPSHOT_COLLECTIONS)
+            snapshot_collections = [name.strip() for name in names.split(",") if name.strip()]
+        self.snapshot_collections = frozenset(snapshot_collections)
+        self.snapshots = snapshots if snapshots is not None else shared_snapshots
         os.makedirs(storage_dir, exist_ok=True)
         logging.info(f"Storage initialized at {storage_dir}")
-    
+
     def _get_file_path(self, collection: str) -> str:
         """Get the file path for a collection"""
-        return os.path.join(self.storage_dir, f"{collection}.json")
-    
+        return os.path.join(self.storage_dir, f"{collection}{self.codec.extension}")
+
+    def _get_snapshot_path(self, collection: str) -> str:
+        """Get the path of the record snapshot of a collection"""
+        return os.path.join(self.storage_dir, f"{collection}.records")
+
+    def _get_lock_path(self, collection: str) -> str:
+        """Get the lock file guarding writes to a collection, whatever its codec"""
+        return os.path.join(self.storage_dir, f"{collection}.lock")
+
+    def _other_file_paths(self, collection: str) -> List[str]:
+        """Get existing files of a collection written with a different codec"""
+        paths = []
+        for extension in KNOWN_EXTENSIONS:
+            if extension != self.codec.extension:
+                path = os.path.join(self.storage_dir, f"{collection}{extension}")
+                if os.path.exists(path):
+                    paths.append(path)
+        return paths
+
     def _load_collection(self, collection: str) -> Dict:
-        """Load a collection from file"""
+        """Load a collection from the cache or from file.
+
+        The returned dict may be shared with other readers and must not be
+        mutated; copy it before making changes.
+        """
         file_path = self._get_file_path(collection)
-        if not os.path.exists(file_path):
-            return {}
-        
+        stamp = file_stamp(file_path)
+        if stamp is None:
+            # Fall back to a file written with another codec; it is converted on the next write
+            for other_path in self._other_file_paths(collection):
+                file_path, stamp = other_path, file_stamp(other_path)
+                break
+            if stamp is None:
+                return {}
+
+        data = self.cache.get(file_path, stamp)
+        if data is not None:
+            return data
+        return self._read_collection_file(collection, file_path, stamp)
+
+    def _read_collection_file(self, collection: str, file_path: str, stamp: FileStamp) -> Dict:
+        """Parse a collection file and cache its contents"""
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except json.JSONDecodeError:
+            with open(file_path, 'rb') as f:
+                data = decode(f.read())
+        except ValueError as e:
+            # Never treat a damaged file as empty: the next write would wipe the collection
             logging.error(f"Error decoding {file_path}")
-            return {}
-    
+            raise StorageError(f"Collection {collection} is corrupt") from e
+
+        self.cache.put(file_path, stamp, data)
+        return data
+
+    def _write_temp_file(self, file_path: str, data: Dict) -> str:
+        """Write a collection next to its file and return the temporary path"""
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(file_path) or ".", prefix=os.path.basename(file_path), suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.codec.dumps(data))
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return tmp_path
+
+    def _install_file(self, file_path: str, tmp_path: str, data: Dict) -> None:
+        """Move a written temporary file into place and cache its contents"""
+        os.replace(tmp_path, file_path)
+        stamp = file_stamp(file_path)
+        if stamp is not None:
+            self.cache.put(file_path, stamp, data)
+
     def _save_collection(self, collection: str, data: Dict) -> None:
         """Save a collection to file"""
         file_path = self._get_file_path(collection)
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    
+        self._install_file(file_path, self._write_temp_file(file_path, data), data)
+
+    def cache_stats(self) -> Dict[str, int]:
+        """Get hit/miss counters of the collection cache"""
+        return self.cache.stats()
+
+    # Engine primitives. Subclasses override these; the public API below adds
+    # batching on top of them.
+
+    def _get_document(self, collection: str, item_id: str) -> Optional[Dict]:
+        """Read one raw document.
+
+        Collections with a record snapshot are served from memory when cached
+        and otherwise from the snapshot, which decodes only the one record.
+        """
+        file_path = self._get_file_path(collection)
+        stamp = file_stamp(file_path) if collection in self.snapshot_collections else None
+        if stamp is None:
+            return self._load_collection(collection).get(item_id)
+
+        data = self.cache.get(file_path, stamp)
+        if data is not None:
+            return data.get(item_id)
+        snapshot = self.snapshots.lookup(self._get_snapshot_path(collection), stamp)
+        if snapshot is not None:
+            return snapshot.get(item_id)
+
+        data = self._read_collection_file(collection, file_path, stamp)
+        self._rebuild_snapshot(collection, stamp, data)
+        return data.get(item_id)
+
+    def _rebuild_snapshot(self, collection: str, stamp: FileStamp, data: Dict,
+                          previous_stamp: Optional[FileStamp] = None,
+                          changed: Optional[Iterable[str]] = None) -> None:
+        """Bring the record snapshot of a collection up to date; failures only cost speed"""
+        try:
+            self.snapshots.rebuild(self._get_snapshot_path(collection), stamp, data, previous_stamp, changed)
+        except Exception as e:
+            logging.warning(f"Error writing snapshot of {collection}: {str(e)}")
+
+    def _all_documents(self, collection: str) -> List[Dict]:
+        """Read all raw documents of a collection"""
+        return list(self._load_collection(collection).values())
+
+    def _find_documents(self, collection: str, model_class: Type[BaseModel],
+                        where: Dict[str, Any]) -> List[Dict]:
+        """Select raw documents matching normalized conditions"""
+        data = self._load_collection(collection)
+        return select_documents(data, where, self._indexes(collection, model_class, data, where))
+
+    def _indexes(self, collection: str, model_class: Type[BaseModel], data: Dict,
+                 where: Dict[str, Any]) -> Optional[CollectionIndexes]:
+        """Get the cached indexes that can answer conditions on a collection, if any"""
+        fields = indexed_fields(model_class)
+        if not any(field in where for field in fields):
+            return None
+        indexes = self.cache.indexes(self._get_file_path(collection), data)
+        if indexes is not None:
+            indexes.ensure(fields, data)
+        return indexes
+
+    def _page_documents(self, collection: str, model_class: Type[BaseModel],
+                        where: Dict[str, Any], limit: int, after: Optional[str]) -> List[Dict]:
+        """Select up to ``limit`` matching documents ordered by id, after the id ``after``.
+
+        Cached collections keep their ids sorted, so a page seeks to ``after``
+        instead of sorting the collection again.
+        """
+        if not self._pending(collection):
+            data = self._load_collection(collection)
+            sorted_ids = self.cache.sorted_ids(self._get_file_path(collection), data)
+            if sorted_ids is not None:
+                indexes = self._indexes(collection, model_class, data, where)
+                return page_documents(data, sorted_ids, where, limit, after, indexes)
+        return self._smallest_documents(collection, model_class, where, limit, after)
+
+    def _smallest_documents(self, collection: str, model_class: Type[BaseModel],
+                            where: Dict[str, Any], limit: int, after: Optional[str]) -> List[Dict]:
+        """Select a page from all matching documents, for collections without sorted ids"""
+        docs = self._overlay(collection, self._find_documents(collection, model_class, where), where)
+        if after is not None:
+            docs = [doc for doc in docs if item_id_of(doc) > after]
+        return heapq.nsmallest(limit, docs, key=item_id_of)
+
+    def _commit_changes(self, changes: Changes, expected: Optional[ExpectedVersions] = None) -> None:
+        """Durably write changes to one or more collections, all or nothing.
+
+        The collections are locked against other threads and processes for
+        the read-modify-write, so concurrent writers of different items never
+        lose each other's updates. Every changed collection is written to a
+        temporary file first; the files are only renamed into place once all
+        of them were written, so readers never see a partial file.
+        """
+        expected = expected or {}
+        lock_paths = [self._get_lock_path(collection) for collection in changes]
+        with file_locks(lock_paths):
+            prepared = []
+            try:
+                for collection, collection_changes in changes.items():
+                    file_path = self._get_file_path(collection)
+                    previous_stamp = file_stamp(file_path)
+                    current = self._load_collection(collection)
+                    check_versions(collection, current, expected.get(collection))
+                    data = dict(current)
+                    for item_id, doc in collection_changes.items():
+                        if doc is None:
+                            data.pop(item_id, None)
+                        else:
+                            data[item_id] = versioned(doc, current.get(item_id))
+                    tmp_path = self._write_temp_file(file_path, data)
+                    prepared.append((collection, file_path, previous_stamp, tmp_path, current, data,
+                                     collection_changes))
+            except Exception:
+                for _, _, _, tmp_path, _, _, _ in prepared:
+                    os.remove(tmp_path)
+                raise
+
+            for collection, file_path, previous_stamp, tmp_path, current, data, collection_changes in prepared:
+                indexes = self.cache.indexes(file_path, current)
+                self._install_file(file_path, tmp_path, data)
+
+                # Carry the secondary indexes over to the new version of the collection
+                if indexes is not None:
+                    for item_id in collection_changes:
+                        if item_id in current:
+                            indexes.remove(item_id, current[item_id])
+                        if item_id in data:
+                            indexes.add(item_id, data[item_id])
+                    self.cache.attach_indexes(file_path, data, indexes)
+
+                stamp = file_stamp(file_path)
+                if collection in self.snapshot_collections and stamp is not None:
+                    self._rebuild_snapshot(collection, stamp, data, previous_stamp, collection_changes)
+
+            for collection in changes:
+                for other_path in self._other_file_paths(collection):
+                    os.remove(other_path)
+                    self.cache.invalidate(other_path)
+                    logging.info(f"Converted {other_path} to {self.codec.name}")
+
+    # Batching
+
+    @contextmanager
+    def batch(self) -> Iterator[StorageBatch]:
+        """Buffer writes and commit them once per collection when the block exits.
+
+        Reads inside the block see the buffered changes. If the block raises,
+        nothing is written. Nested batches join the outermost one.
+        """
+        current = _active_batch.get()
+        if current is not None and current.storage is self:
+            yield current
+            return
+
+        batch = StorageBatch(self)
+        token = _active_batch.set(batch)
+        try:
+            yield batch
+        finally:
+            _active_batch.reset(token)
+        if batch.changes:
+            self._commit_changes(batch.changes, batch.expected)
+
+    def _pending(self, collection: str) -> Optional[Dict[str, Optional[Dict]]]:
+        """Get the changes buffered for a collection by the active batch"""
+        batch = _active_batch.get()
+        if batch is None or batch.storage is not self:
+            return None
+        return batch.pending(collection)
+
+    def _write(self, collection: str, changes: Dict[str, Optional[Dict]],
+               expected: Optional[Dict[str, int]] = None) -> None:
+        """Buffer changes in the active batch or commit them right away"""
+        batch = _active_batch.get()
+        if batch is not None and batch.storage is self:
+            batch.changes.setdefault(collection, {}).update(changes)
+            # The first expectation wins: it describes the state the batch started from
+            collection_expected = batch.expected.setdefault(collection, {})
+            for item_id, version in (expected or {}).items():
+                collection_expected.setdefault(item_id, version)
+        else:
+            self._commit_changes({collection: changes}, {collection: expected} if expected else None)
+
+    def _read_document(self, collection: str, item_id: str) -> Optional[Dict]:
+        pending = self._pending(collection)
+        if pending is not None and item_id in pending:
+            return pending[item_id]
+        return self._get_document(collection, item_id)
+
+    def _overlay(self, collection: str, docs: List[Dict], where: Dict[str, Any]) -> List[Dict]:
+        """Apply the active batch's changes to documents read from the engine"""
+        pending = self._pending(collection)
+        if not pending:
+            return docs
+        merged = [doc for doc in docs if item_id_of(doc) not in pending]
+        merged.extend(doc for doc in pending.values() if doc is not None and matches(doc, where))
+        return merged
+
+    # Public API
+
     def get_item(self, collection: str, item_id: str, model_class: Type[T]) -> Optional[T]:
         """Get an item from a collection"""
-        data = self._load_collection(collection)
-        if item_id in data:
-            return model_class(**data[item_id])
+        doc = self._read_document(collection, item_id)
+        if doc is not None:
+            return materialize(model_class, doc)
         return None
-    
+
     def get_all_items(self, collection: str, model_class: Type[T]) -> List[T]:
         """Get all items from a collection"""
-        data = self._load_collection(collection)
-        return [model_class(**item) for item in data.values()]
-    
-    def save_item(self, collection: str, item: BaseModel) -> None:
-        """Save an item to a collection"""
-        data = self._load_collection(collection)
+        docs = self._overlay(collection, self._all_documents(collection), {})
+        build = materializer(model_class)
+        return [build(item) for item in docs]
+
+    def get_item_version(self, collection: str, item_id: str) -> int:
+        """Get the stored version of an item, 0 if it does not exist"""
+        return version_of(self._get_document(collection, item_id))
+
+    def get_item_with_version(self, collection: str, item_id: str,
+                              model_class: Type[T]) -> Tuple[Optional[T], int]:
+        """Get an item together with its stored version for a later compare-and-swap"""
+        doc = self._get_document(collection, item_id)
+        pending = self._pending(collection)
+        if pending is not None and item_id in pending:
+            item_doc = pending[item_id]
+        else:
+            item_doc = doc
+        item = materialize(model_class, item_doc) if item_doc is not None else None
+        return item, version_of(doc)
+
+    def save_item(self, collection: str, item: BaseModel,
+                  expected_version: Optional[int] = None) -> None:
+        """Save an item to a collection.
+
+        With ``expected_version`` the save only succeeds if the stored item is
+        still at that version (0 meaning it must not exist yet); otherwise
+        VersionConflictError is raised.
+        """
         item_dict = item.dict()
-        item_id = item_dict.get('id', None) or item_dict.get('user_id', None)
-        
-        if not item_id:
-            raise ValueError("Item must have 'id' or 'user_id' field")
-            
-        data[item_id] = item_dict
-        self._save_collection(collection, data)
-    
+        item_id = item_id_of(item_dict)
+        expected = {item_id: expected_version} if expected_version is not None else None
+        self._write(collection, {item_id: item_dict}, expected)
+
+    def save_items(self, collection: str, items: Iterable[BaseModel]) -> None:
+        """Save several items to a collection with a single write"""
+        changes = {}
+        for item in items:
+            item_dict = item.dict()
+            changes[item_id_of(item_dict)] = item_dict
+        if changes:
+            self._write(collection, changes)
+
     def delete_item(self, collection: str, item_id: str) -> bool:
         """Delete an item from a collection"""
-        data = self._load_collection(collection)
-        if item_id in data:
-            del data[item_id]
-            self._save_collection(collection, data)
-            return True
-        return False
-    
-    def query_items(self, collection: str, model_class: Type[T], 
+        if self._read_document(collection, item_id) is None:
+            return False
+        self._write(collection, {item_id: None})
+        return True
+
+    def delete_items(self, collection: str, item_ids: Iterable[str]) -> int:
+        """Delete several items from a collection with a single write"""
+        changes = {
+            item_id: None for item_id in item_ids
+            if self._read_document(collection, item_id) is not None
+        }
+        if changes:
+            self._write(collection, changes)
+        return len(changes)
+
+    def query_items(self, collection: str, model_class: Type[T],
                    query_func=None) -> List[T]:
-        """Query items from a collection using a filter function"""
-        items = self.get_all_items(collection, model_class)
+        """Query items from a collection using a filter function.
+
+        The filter gets a LazyRecord with the model's attributes, converted on
+        access, so only matching records are turned into models.
+        """
+        docs = self._overlay(collection, self._all_documents(collection), {})
+        build = materializer(model_class)
         if query_func:
-            return [item for item in items if query_func(item)]
-        return items 
\ No newline at end of file
+            docs = [doc for doc in docs if query_func(LazyRecord(doc, build))]
+        return [build(doc) for doc in docs]
+
+    def find_items(self, collection: str, model_class: Type[T],
+                   where: Optional[Dict[str, Any]] = None,
+                   sort_by: Optional[str] = None, descending: bool = False,
+                   limit: Optional[int] = None, offset: int = 0) -> List[T]:
+        """Find items whose fields equal the values in ``where``.
+
+        Conditions on fields listed in the model's ``Config.indexes`` are
+        answered from secondary hash indexes, so only matching records are
+        read and turned into models.
+        """
+        where = normalize_where(where)
+        docs = self._overlay(collection, self._find_documents(collection, model_class, where), where)
+        if sort_by:
+            docs.sort(key=sort_key(sort_by), reverse=descending)
+        end = offset + limit if limit is not None else None
+        build = materializer(model_class)
+        return [build(doc) for doc in docs[offset:end]]
+
+    def page_items(self, collection: str, model_class: Type[T],
+                   where: Optional[Dict[str, Any]] = None, limit: int = 100,
+                   after: Optional[str] = None) -> Tuple[List[T], Optional[str]]:
+        """Get one page of items ordered by id.
+
+        Returns the items with an id greater than ``after`` and the id to pass
+        as ``after`` for the next page, or None on the last page.
+        """
+        docs = self._page_documents(collection, model_class, normalize_where(where), limit + 1, after)
+        next_after = item_id_of(docs[limit - 1]) if len(docs) > limit else None
+        build = materializer(model_class)
+        return [build(doc) for doc in docs[:limit]], next_after
+
+    def iter_items(self, collection: str, model_class: Type[T],
+                   where: Optional[Dict[str, Any]] = None, page_size: int = 100,
+                   after: Optional[str] = None) -> Iterator[T]:
+        """Iterate over matching items page by page, ordered by id"""
+        while True:
+            items, after = self.page_items(collection, model_class, where, page_size, after)
+            yield from items
+            if after is None:
+                return
+
+
+def create_storage_service(storage_dir: str = "data") -> StorageService:
+    """Create the storage engine selected by the STORAGE_ENGINE environment variable"""
+    engine = os.environ.get("STORAGE_ENGINE", "json")
+    if engine == "json":
+        return StorageService(storage_dir)
+    if engine == "journal":
+        from .journal_storage_service import JournalStorageService
+        return JournalStorageService(storage_dir)
+    if engine == "sqlite":
+        from .sqlite_storage_service import SQLiteStorageService
+        return SQLiteStorageService(storage_dir)
+    raise ValueError(f"Unknown storage engine: {engine}")
@@ -0,0 +1,271 @@
+import json
+import logging
+import os
+import re
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple, Type, TypeVar
+from pydantic import BaseModel, ValidationError
+
+M = TypeVar('M', bound=BaseModel)
+
+# Re-asks made for the items of an answer that fail validation
+REPAIR_ATTEMPTS = int(os.environ.get("STRUCTURED_REPAIR_ATTEMPTS", 2))
+
+_FENCE = re.compile(r"```(?:json|JSON)?\s*\n?(.*?)```", re.S)
+_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_QUOTES = str.maketrans({"“": '"', "”": '"'})
+
+
+class StructuredOutputError(ValueError):
+    """Raised when a model answer holds no usable JSON"""
+
+
+class RepairRequest(NamedTuple):
+    """An item of a model answer that failed validation.
+
+    ``data`` is what the model gave (None if nothing could be parsed),
+    ``errors`` the message of each failing field and ``fixed`` the fields set
+    by the caller rather than by the model, such as ids.
+    """
+    ref: str
+    model: Type[BaseModel]
+    data: Any
+    errors: Dict[str, str]
+    fixed: Dict[str, Any] = {}
+    hint: str = ""
+
+
+def _json_span(text: str, start: int) -> int:
+    """End of the JSON value opening at ``start``, or the end of the text if it is cut off"""
+    depth = 0
+    in_string = escaped = False
+    for index in range(start, len(text)):
+        char = text[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            depth += 1
+        elif char in "}]":
+            depth -= 1
+            if depth == 0:
+                return index + 1
+    return len(text)
+
+
+def _drop_trailing_comma(out: List[str]) -> None:
+    index = len(out) - 1
+    while index >= 0 and out[index].isspace():
+        index -= 1
+    if index >= 0 and out[index] == ",":
+        del out[index]
+
+
+def repair_json(text: str) -> str:
+    """Fix the slips models make in JSON.
+
+    Drops trailing commas, turns Python literals into JSON ones, escapes raw
+    newlines in strings and closes strings, arrays and objects left open by
+    a cut-off answer.
+    """
+    out: List[str] = []
+    closers: List[str] = []
+    in_string = escaped = False
+    index = 0
+    while index < len(text):
+        char = text[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            elif char == "\n":
+                char = "\\n"
+            out.append(char)
+        elif char == '"':
+            in_string = True
+            out.append(char)
+        elif char in "{[":
+            closers.append("}" if char == "{" else "]")
+            out.append(char)
+        elif char in "}]":
+            _drop_trailing_comma(out)
+            if closers and closers[-1] == char:
+                closers.pop()
+                out.append(char)
+        elif char.isalpha():
+            end = index
+            while end < len(text) and text[end].isalnum():
+                end += 1
+            word = text[index:end]
+            out.append(_LITERALS.get(word, word))
+            index = end
+            continue
+        else:
+            out.append(char)
+        index += 1
+
+    if in_string:
+        out.append('"')
+    _drop_trailing_comma(out)
+    out.extend(reversed(closers))
+    return "".join(out)
+
+
+def extract_json(text: Optional[str]) -> Any:
+    """Parse the JSON in a model answer, tolerating code fences, surrounding prose and common slips"""
+    if not text:
+        raise StructuredOutputError("empty response")
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+
+    candidates = [match.group(1) for match in _FENCE.finditer(text)] + [text]
+    for candidate in candidates:
+        candidate = candidate.translate(_QUOTES)
+        starts = [index for index in (candidate.find("{"), candidate.find("[")) if index >= 0]
+        if not starts:
+            continue
+        start = min(starts)
+        piece = candidate[start:_json_span(candidate, start)]
+        for attempt in (piece, repair_json(piece)):
+            try:
+                return json.loads(attempt)
+            except ValueError:
+                continue
+    raise StructuredOutputError("no JSON found in the response")
+
+
+def validate(model: Type[M], data: Any, fixed: Optional[Dict[str, Any]] = None) -> Tuple[Optional[M], Dict[str, str]]:
+    """Validate model data, returning the instance or the error message of each failing field"""
+    if not isinstance(data, dict):
+        return None, {"__root__": "expected a JSON object"}
+    try:
+        return model.parse_obj({**data, **(fixed or {})}), {}
+    except ValidationError as e:
+        errors: Dict[str, str] = {}
+        for error in e.errors():
+            errors.setdefault(str(error["loc"][0]), error["msg"])
+        return None, errors
+
+
+def parse_item(model: Type[M], response: Optional[str], ref: str, fixed: Optional[Dict[str, Any]] = None,
+               defaults: Optional[Dict[str, Any]] = None, hint: str = "") -> Tuple[Optional[M], Optional[RepairRequest]]:
+    """Parse a single-object answer, returning the item or the request to repair it"""
+    try:
+        data = extract_json(response)
+    except StructuredOutputError:
+        data = None
+    if isinstance(data, dict) and defaults:
+        data = {**defaults, **{key: value for key, value in data.items() if value is not None}}
+    item, errors = validate(model, data, fixed)
+    if item is not None:
+        return item, None
+    return None, RepairRequest(ref, model, data, errors, fixed or {}, hint)
+
+
+def describe_fields(model: Type[BaseModel], exclude: Tuple[str, ...] = ()) -> str:
+    """List the fields of a model and their JSON types for a prompt"""
+    schema = model.schema()
+    required = set(schema.get("required", []))
+    fields = []
+    for name, prop in schema["properties"].items():
+        if name in exclude:
+            continue
+        kind = prop.get("type", "any")
+        if kind == "array":
+            kind = f"array of {prop.get('items', {}).get('type', 'any')}"
+        fields.append(f'"{name}" ({kind}{"" if name in required else ", optional"})')
+    return ", ".join(fields)
+
+
+def repair_prompt(requests: List[RepairRequest], context: str = "") -> str:
+    """Ask for corrected versions of the failing fields, or whole items when nothing usable came back"""
+    lines = []
+    for request in requests:
+        fields = describe_fields(request.model, exclude=tuple(request.fixed))
+        hint = f" ({request.hint})" if request.hint else ""
+        if isinstance(request.data, dict) and "__root__" not in request.errors:
+            problems = "; ".join(f"{field}: {message}" for field, message in request.errors.items())
+            lines.append(
+                f'- ref "{request.ref}"{hint}: {json.dumps(request.data, ensure_ascii=False)}\n'
+                f"  Invalid fields: {problems}. Return only these fields. Item fields: {fields}"
+            )
+        else:
+            lines.append(f'- ref "{request.ref}"{hint}: missing or unreadable. Return the whole item with fields: {fields}')
+    return (
+        (f"{context}\n\n" if context else "")
+        + "Some items of a previous answer were invalid:\n"
+        + "\n".join(lines)
+        + '\n\nReturn as JSON in this format, one entry per ref: {"items": [{"ref": "...", ...corrected fields}]}'
+    )
+
+
+def apply_repairs(requests: List[RepairRequest], response: Optional[str]) -> Tuple[Dict[str, BaseModel], List[RepairRequest]]:
+    """Merge a repair answer into the failing items, returning the ones now valid and the ones still failing"""
+    try:
+        entries = extract_json(response)
+    except StructuredOutputError:
+        entries = None
+    if isinstance(entries, dict):
+        entries = entries.get("items", [entries])
+    fixes = {
+        str(entry.get("ref")): entry for entry in (entries if isinstance(entries, list) else [])
+        if isinstance(entry, dict)
+    }
+
+    repaired: Dict[str, BaseModel] = {}
+    failing = []
+    for request in requests:
+        fix = fixes.get(request.ref)
+        if fix is None:
+            failing.append(request)
+            continue
+        fix = {key: value for key, value in fix.items() if key != "ref"}
+        data = {**request.data, **fix} if isinstance(request.data, dict) else fix
+        item, errors = validate(request.model, data, request.fixed)
+        if item is not None:
+            repaired[request.ref] = item
+        else:
+            failing.append(request._replace(data=data, errors=errors))
+    return repaired, failing
+
+
+def repair(call: Callable[[str, int], str], requests: List[RepairRequest], context: str = "",
+           attempts: int = REPAIR_ATTEMPTS) -> Dict[str, BaseModel]:
+    """Re-ask the model for the failing items until they validate, returning the repaired ones by ref.
+
+    ``call`` makes an LLM call for a prompt and a cache variant. Items that
+    are still invalid after ``attempts`` calls are left out.
+    """
+    repaired: Dict[str, BaseModel] = {}
+    for attempt in range(attempts):
+        if not requests:
+            break
+        fixed, requests = apply_repairs(requests, call(repair_prompt(requests, context), attempt))
+        repaired.update(fixed)
+    if requests:
+        logging.warning(f"Could not repair {len(requests)} invalid items: {', '.join(r.ref for r in requests)}")
+    return repaired
+
+
+async def arepair(call: Callable[[str, int], Awaitable[str]], requests: List[RepairRequest], context: str = "",
+                  attempts: int = REPAIR_ATTEMPTS) -> Dict[str, BaseModel]:
+    """Async variant of repair"""
+    repaired: Dict[str, BaseModel] = {}
+    for attempt in range(attempts):
+        if not requests:
+            break
+        fixed, requests = apply_repairs(requests, await call(repair_prompt(requests, context), attempt))
+        repaired.update(fixed)
+    if requests:
+        logging.warning(f"Could not repair {len(requests)} invalid items: {', '.join(r.ref for r in requests)}")
+    return repaired
@@ -0,0 +1,100 @@
+"""Compare storage codecs and response encoders on a synthetic exercises collection.
+
+Run from src/backend:
+
+    python -m benchmarks.codec_benchmark --items 5000
+"""
+import argparse
+import json
+import time
+import uuid
+from typing import Callable, Dict, List
+from fastapi.encoders import jsonable_encoder
+from pydantic.json import pydantic_encoder
+from app.models.exercise import Exercise
+from app.routers.pagination import json_list_response
+from app.services.codecs import Codec, JsonCodec, MsgpackCodec, OrjsonCodec, msgpack, orjson
+
+
+def make_exercises(count: int) -> List[Exercise]:
+    languages = ["english", "french", "spanish", "german", "italian"]
+    return [
+        Exercise(
+            id=str(uuid.uuid4()),
+            title=f"Flashcards {i}",
+            description="Practice everyday vocabulary",
+            type="flashcard",
+            language=languages[i % len(languages)],
+            difficulty="beginner",
+            content={
+                "items": [
+                    {"term": f"term {i}-{j}", "definition": "a word", "example": "Use it in a sentence."}
+                    for j in range(10)
+                ]
+            },
+        )
+        for i in range(count)
+    ]
+
+
+def timed(func: Callable[[], object], repeat: int) -> float:
+    """Best wall time of ``repeat`` runs in milliseconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+class PrettyJsonCodec(JsonCodec):
+    """The previous on-disk format: indented stdlib JSON"""
+
+    name = "json (indent=2)"
+
+    def __init__(self):
+        super().__init__(indent=2)
+
+
+def bench_codecs(collection: Dict[str, Dict], repeat: int) -> None:
+    codecs: List[Codec] = [PrettyJsonCodec(), JsonCodec()]
+    if orjson is not None:
+        codecs.append(OrjsonCodec())
+    if msgpack is not None:
+        codecs.append(MsgpackCodec())
+
+    print(f"{'codec':<18}{'size KB':>10}{'encode ms':>12}{'decode ms':>12}")
+    for codec in codecs:
+        raw = codec.dumps(collection)
+        encode_ms = timed(lambda: codec.dumps(collection), repeat)
+        decode_ms = timed(lambda: codec.loads(raw), repeat)
+        print(f"{codec.name:<18}{len(raw) / 1024:>10.1f}{encode_ms:>12.2f}{decode_ms:>12.2f}")
+
+
+def bench_responses(items: List[Exercise], repeat: int) -> None:
+    def fastapi_default() -> bytes:
+        return json.dumps(jsonable_encoder(items), ensure_ascii=False).encode("utf-8")
+
+    def fast_path() -> bytes:
+        return json_list_response(items).body
+
+    print(f"\n{'response encoder':<28}{'ms':>10}")
+    print(f"{'jsonable_encoder + json':<28}{timed(fastapi_default, repeat):>10.2f}")
+    print(f"{'json_list_response':<28}{timed(fast_path, repeat):>10.2f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark storage codecs and response encoding")
+    parser.add_argument("--items", type=int, default=5000, help="number of exercises in the collection")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per measurement, the best is reported")
+    args = parser.parse_args()
+
+    items = make_exercises(args.items)
+    collection = json.loads(json.dumps({item.id: item.dict() for item in items}, default=pydantic_encoder))
+    print(f"{args.items} exercises\n")
+    bench_codecs(collection, args.repeat)
+    bench_responses(items, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
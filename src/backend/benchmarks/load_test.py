@@ -0,0 +1,171 @@
+"""Drive the generation endpoints at a target request rate and report latency percentiles and throughput.
+
+By default the app runs in this process on the fake LLM backend, with its
+data in a temporary directory and the response cache off, so no API calls
+are made. Run from src/backend:
+
+    python -m benchmarks.load_test --rps 20 --duration 30
+    python -m benchmarks.load_test --rps 50 --latency lognormal:1.5:0.6 --error-rate 0.02
+
+Or point it at a running server (start that one with LLM_BACKEND=fake):
+
+    python -m benchmarks.load_test --url http://localhost:8000 --rps 10
+"""
+import argparse
+import asyncio
+import math
+import os
+import random
+import tempfile
+import time
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Tuple
+import httpx
+
+LANGUAGES = ["english", "french", "german", "italian", "spanish"]
+INTERESTS = ["music", "travel", "food", "sports", "movies", "books"]
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile of a list of values"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+@asynccontextmanager
+async def in_process_client(args: argparse.Namespace) -> AsyncIterator[httpx.AsyncClient]:
+    """Start the app with the fake LLM backend in this process and yield a client talking to it"""
+    os.environ["LLM_BACKEND"] = "fake"
+    os.environ["FAKE_LLM_LATENCY"] = args.latency
+    os.environ["FAKE_LLM_ERROR_RATE"] = str(args.error_rate)
+    os.environ["FAKE_LLM_INVALID_RATE"] = str(args.invalid_rate)
+    os.environ["FAKE_LLM_SEED"] = str(args.seed)
+    if args.completion_tokens:
+        os.environ["FAKE_LLM_COMPLETION_TOKENS"] = str(args.completion_tokens)
+    if not args.cache:
+        os.environ["LLM_CACHE_ENABLED"] = "0"
+    os.chdir(tempfile.mkdtemp(prefix="tandem-load-"))
+    from app.main import app
+
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(app=app, base_url="http://load-test", timeout=args.timeout) as client:
+            yield client
+
+
+@asynccontextmanager
+async def remote_client(args: argparse.Namespace) -> AsyncIterator[httpx.AsyncClient]:
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=100)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        yield client
+
+
+async def create_users(client: httpx.AsyncClient, pairs: int) -> List[Tuple[str, str]]:
+    """Create ``pairs`` tandem pairs learning each other's language"""
+    result = []
+    for index in range(pairs):
+        native = LANGUAGES[index % len(LANGUAGES)]
+        target = LANGUAGES[(index + 1) % len(LANGUAGES)]
+        interests = [INTERESTS[(index + offset) % len(INTERESTS)] for offset in range(3)]
+        for user_id, (own, learning) in ((f"load-{index}-a", (native, target)), (f"load-{index}-b", (target, native))):
+            response = await client.post("/users/", json={
+                "id": user_id, "name": user_id, "native_language": own, "target_language": learning,
+                "proficiency_level": "beginner", "interests": interests,
+            })
+            response.raise_for_status()
+        result.append((f"load-{index}-a", f"load-{index}-b"))
+    return result
+
+
+def build_request(rng: random.Random, endpoints: List[str], pairs: List[Tuple[str, str]],
+                  count: int) -> Tuple[str, str, Dict[str, object]]:
+    """Pick the next request: (endpoint name, path, query parameters)"""
+    endpoint = rng.choice(endpoints)
+    if endpoint == "exercises":
+        user_id, partner_id = rng.choice(pairs)
+        return endpoint, "/exercises/generate", {"user_id": user_id, "partner_id": partner_id, "count": count}
+    return endpoint, f"/cultural/generate/{rng.choice(LANGUAGES)}", {}
+
+
+async def run_load(client: httpx.AsyncClient, args: argparse.Namespace) -> Tuple[Dict[str, list], float]:
+    """Send requests open-loop at the target rate for the duration, returning the results by endpoint"""
+    rng = random.Random(args.seed)
+    pairs = await create_users(client, args.pairs)
+    results: Dict[str, list] = defaultdict(list)
+
+    async def send(endpoint: str, path: str, params: Dict[str, object]) -> None:
+        sent = time.perf_counter()
+        try:
+            response = await client.post(path, params=params)
+            status = str(response.status_code)
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        results[endpoint].append((status, time.perf_counter() - sent))
+
+    tasks = []
+    start = time.perf_counter()
+    due = 0.0
+    while due < args.duration:
+        delay = start + due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(*build_request(rng, args.endpoints, pairs, args.count))))
+        # Open loop: requests are sent on schedule whether or not earlier ones have finished
+        due += rng.expovariate(args.rps) if args.poisson else 1 / args.rps
+    await asyncio.gather(*tasks)
+    return results, time.perf_counter() - start
+
+
+def report(results: Dict[str, list], elapsed: float) -> None:
+    print(f"{'endpoint':<12}{'sent':>7}{'ok':>7}{'ok/s':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    rows = sorted(results.items()) + [("all", [result for rows in results.values() for result in rows])]
+    for endpoint, rows in rows:
+        latencies = [latency * 1000 for status, latency in rows if status == "200"]
+        if latencies:
+            stats = "".join(f"{percentile(latencies, p):>10.0f}" for p in (50, 95, 99)) + f"{max(latencies):>10.0f}"
+        else:
+            stats = f"{'-':>10}" * 4
+        print(f"{endpoint:<12}{len(rows):>7}{len(latencies):>7}{len(latencies) / elapsed:>8.1f}{stats}")
+
+    statuses = Counter(status for rows in results.values() for status, _ in rows)
+    print(f"\nelapsed {elapsed:.1f}s, responses: " + ", ".join(f"{status}: {n}" for status, n in sorted(statuses.items())))
+
+
+async def main_async(args: argparse.Namespace) -> None:
+    client_context = remote_client(args) if args.url else in_process_client(args)
+    async with client_context as client:
+        results, elapsed = await run_load(client, args)
+        report(results, elapsed)
+        response = await client.get("/admin/llm-providers")
+        if response.status_code == 200:
+            print("\nprovider   calls  retries  failures  prompt tokens  completion tokens  cost usd")
+            for provider, stats in response.json().items():
+                if "calls" in stats and "prompt_tokens" in stats:
+                    print(f"{provider:<10}{stats['calls']:>6}{stats['retries']:>9}{stats['failures']:>10}"
+                          f"{stats['prompt_tokens']:>15}{stats['completion_tokens']:>19}{stats['cost_usd']:>10.4f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load-test the exercise and cultural generation endpoints")
+    parser.add_argument("--url", help="base URL of a running server; by default the app runs in process")
+    parser.add_argument("--rps", type=float, default=10, help="target requests per second")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to send requests for")
+    parser.add_argument("--endpoints", nargs="+", choices=["exercises", "cultural"],
+                        default=["exercises", "cultural"], help="endpoints to drive, picked at random")
+    parser.add_argument("--count", type=int, default=3, help="exercises per generation request")
+    parser.add_argument("--pairs", type=int, default=20, help="tandem pairs to spread exercise requests over")
+    parser.add_argument("--poisson", action="store_true", help="Poisson arrivals instead of a fixed interval")
+    parser.add_argument("--timeout", type=float, default=120, help="request timeout in seconds")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the request mix and the fake backend")
+    fake = parser.add_argument_group("fake backend (in-process runs)")
+    fake.add_argument("--latency", default="lognormal:0.8:0.5", help="latency distribution of each LLM call")
+    fake.add_argument("--error-rate", type=float, default=0.0, help="share of LLM calls failing with 429/5xx")
+    fake.add_argument("--invalid-rate", type=float, default=0.0, help="share of answers with an invalid item")
+    fake.add_argument("--completion-tokens", type=int, help="pad LLM answers to about this many tokens")
+    fake.add_argument("--cache", action="store_true", help="keep the LLM response cache on")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
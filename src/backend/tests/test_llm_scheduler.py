@@ -0,0 +1,105 @@
+import asyncio
+import time
+import pytest
+from app.services.llm_scheduler import AdaptiveLimit, CircuitBreaker, ProviderScheduler, ProviderUnavailableError
+
+
+class Unavailable(Exception):
+    status_code = 503
+
+
+def open_scheduler(reset_timeout: float = 0.05) -> ProviderScheduler:
+    """A scheduler whose breaker has just tripped"""
+    scheduler = ProviderScheduler(
+        "test", breaker=CircuitBreaker(failure_threshold=1, reset_timeout=reset_timeout), max_attempts=1
+    )
+    scheduler.breaker.record_failure()
+    assert scheduler.breaker.state == CircuitBreaker.OPEN
+    return scheduler
+
+
+async def answer() -> str:
+    return "ok"
+
+
+def test_cancelled_trial_call_lets_the_next_call_through():
+    async def run():
+        scheduler = open_scheduler()
+        await asyncio.sleep(0.06)
+        trial = asyncio.create_task(scheduler.acall(lambda: asyncio.sleep(10)))
+        await asyncio.sleep(0.01)
+        assert scheduler.breaker.state == CircuitBreaker.HALF_OPEN
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        assert await scheduler.acall(answer) == "ok"
+        assert scheduler.breaker.state == CircuitBreaker.CLOSED
+
+    asyncio.run(run())
+
+
+def test_closed_trial_stream_lets_the_next_call_through():
+    async def never():
+        await asyncio.sleep(10)
+        yield "late"
+
+    async def run():
+        scheduler = open_scheduler()
+        await asyncio.sleep(0.06)
+        stream = scheduler.astream(never)
+        trial = asyncio.create_task(stream.__anext__())
+        await asyncio.sleep(0.01)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        assert await scheduler.acall(answer) == "ok"
+
+    asyncio.run(run())
+
+
+def test_half_open_breaker_gives_up_on_a_stalled_trial():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+
+
+def test_open_breaker_rejects_calls():
+    async def run():
+        scheduler = open_scheduler(reset_timeout=30)
+        with pytest.raises(ProviderUnavailableError):
+            await scheduler.acall(answer)
+
+    asyncio.run(run())
+
+
+def test_limit_holds_under_mixed_call_sizes():
+    limit = AdaptiveLimit(initial=8, cooldown=0)
+    for i in range(50):
+        limit.on_success(0.2 + 0.01 * (i % 3), kind="exercise_repair")
+        limit.on_success(3.0 + 0.1 * (i % 5), kind="exercise_batch")
+        limit.on_success(None, kind="stream")
+    assert limit.limit > 8
+
+
+def test_one_fast_call_does_not_lower_the_bar():
+    limit = AdaptiveLimit(initial=8, cooldown=0)
+    for _ in range(20):
+        limit.on_success(2.0)
+    limit.on_success(0.05)
+    grown = limit.limit
+    for _ in range(20):
+        limit.on_success(2.0)
+    assert limit.limit > grown
+
+
+def test_slow_calls_shrink_the_limit():
+    limit = AdaptiveLimit(initial=8, cooldown=0)
+    for _ in range(20):
+        limit.on_success(1.0)
+    grown = limit.limit
+    limit.on_success(5.0)
+    assert limit.limit < grown